@@ -319,7 +319,7 @@ L0119:
     jmp     L0110       ; and start over
 
 L0122:
-    jmp     L004D       ; return to main loop
+    jmp     MainLoop    ; return to main loop
     nop
 
 L0125:
@@ -438,6 +438,10 @@ L0187:
 ; loop to continue with the column of the last processed event so that
 ; the scanning order will be broken.
 ; ---------------------------------------------------------------------------
+    org     00255H
+
+L0318   equ     00318H  ; not disassembled yet
+
 L0255:
     mov     r0,#025H    ;
     mov     a,@r0       ;
@@ -461,7 +465,7 @@ L0266:
     mov     r5,a        ; copy bit number to rb0.R5 for the loop at L0271
     mov     a,r0        ;
     mov     r6,a        ; rb0.R6 points to the current queue event
-    call    L00BB       ; rescan the same column again
+    call    ReadKeys    ; rescan the same column again
     mov     a,r4        ; A/rb0.R4 - recent bitmap for the current column
 
 L0271:
@@ -541,7 +545,7 @@ L02BC:
     mov     @r0,#000H
 
 L02C8:
-    jmp     L004D
+    jmp     MainLoop
 
 L02CA:
     jmp     L02CE
@@ -578,7 +582,7 @@ L02D8:
     mov     a,@r0
     orl     a,#002H
     mov     @r0,a
-    jmp     L004D
+    jmp     MainLoop
 
 L02F3: ;-------------- dead code ? -------------------
     inc     @r0
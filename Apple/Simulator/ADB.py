@@ -13,6 +13,39 @@ ADB_STATE_SEND_CMD = 4
 ADB_STATE_STOP     = 5
 ADB_STATE_TLT      = 6
 ADB_STATE_DATA     = 7
+ADB_STATE_LISTEN   = 13 # send Listen data to device
+
+# ADB timing in CPU cycles (2.5 usecs each)
+ADB_ATT_CYCLES   = 320 # attention, 800 usecs
+ADB_SYNC_CYCLES  = 28  # sync, 70 usecs
+ADB_BIT_CELL     = 40  # bit cell, 100 usecs
+ADB_BIT1_LOW     = 14  # low phase of a "1" bit, 35 usecs
+ADB_BIT0_LOW     = 26  # low phase of a "0" bit, 65 usecs
+ADB_STOP_LOW     = 28  # low phase of the command stop bit, 70 usecs
+ADB_TLT_CYCLES   = 58  # stop-to-start time (Tlt) used by host, 145 usecs
+ADB_TALK_TIMEOUT = 46  # max. wait for device's start bit after Tlt
+ADB_MIN_CELL     = 15  # min. length of a device bit cell
+ADB_MAX_CELL     = 52  # max. length of a device bit cell, 130 usecs
+
+# reasons for ending a transaction, see ADBSim.xact_counts
+END_DONE          = 0 # completed normally
+END_ABORTED       = 1 # aborted by the host
+END_TLT_TIMEOUT   = 2 # no response to a Talk command
+END_TIMING_ERROR  = 3 # device bit cell too short
+END_CELL_TIMEOUT  = 4 # device bit cell too long
+END_INVALID_START = 5 # device start bit was "0"
+END_INVALID_STOP  = 6 # device stop bit was "1"
+END_UNSUPPORTED   = 7 # command not supported by the host model
+
+END_REASON_NAMES = ('completed', 'aborted', 'tlt_timeout', 'timing_error',
+                    'bit_cell_timeout', 'invalid_start_bit',
+                    'invalid_stop_bit', 'unsupported_command')
+
+# ADBSim attributes making up the bus state, see save_state()
+STATE_FIELDS = ('adb_state', 'adb_next_state', 'adb_cyc_cnt', 'adb_cmd',
+                'adb_bit', 'adb_low_time', 'adb_high_time', 'adb_phase',
+                'adb_byte', 'adb_bit_pos', 'adb_srq', 'adb_timeout',
+                'adb_data', 'adb_listen_data', 'adb_listen_bits')
 
 class ADBSim:
     def __init__(self, cpu_obj):
@@ -29,16 +62,99 @@ class ADBSim:
         self.adb_bit = 0
         self.adb_bit_pos = 0
         self.adb_data = bytearray()
+        self.adb_listen_data = bytes()
+        self.adb_listen_bits = []
+        self.adb_srq = False # SRQ seen during the current transaction
+        self.adb_timeout = False # no response to the current Talk command
         self.cpu_obj.set_t1_line(1) # pull ADB-out line high (ADB idle)
         self.adb_in_cb = None
         self.adb_in_mask = 0x80
-        print("ADB bus sucessfully initialized...")
+        self.xact_done_cb = None
+        self.xact_listeners = []
+        self.muted = False # no callbacks/counting while history is replayed
+        self.journal = None
+        self.xact_counts = [0] * len(END_REASON_NAMES) # per END_XXX reason
+        self.adb_end_reason = END_DONE # how the last transaction ended
+        self.num_srq = 0 # transactions during which SRQ was seen
+        self.verbose = True
+        self.cpu_obj.add_event_source(self.next_event)
+        self._log("ADB bus sucessfully initialized...")
 
-    def adb_send(self, adb_cmd):
+    def adb_send(self, adb_cmd, listen_data=None):
+        ''' Start a new ADB transaction.
+            listen_data contains the bytes to be sent to the device
+            when adb_cmd is a Listen command.
+        '''
+        if self.journal is not None:
+            self.journal.log_adb_cmd(adb_cmd, listen_data)
         self.adb_cmd = adb_cmd
         self.adb_data = bytearray()
+        self.adb_listen_data = bytes(listen_data) if listen_data else bytes()
+        self.adb_srq = False
+        self.adb_timeout = False
         self.adb_state = ADB_STATE_START
 
+    def is_idle(self):
+        return self.adb_state == ADB_STATE_IDLE
+
+    def set_xact_done_cb(self, cb):
+        ''' Set callback to be invoked when an ADB transaction is over '''
+        self.xact_done_cb = cb
+
+    def set_journal(self, journal):
+        ''' Install an input journal. Its log_adb_cmd(cmd, listen_data)
+            and log_adb_abort() methods will be called for each
+            transaction started or aborted from outside.
+        '''
+        self.journal = journal
+
+    def add_xact_listener(self, cb):
+        ''' Register an additional callback invoked with the ADBSim object
+            when an ADB transaction is over.
+        '''
+        self.xact_listeners.append(cb)
+
+    def remove_xact_listener(self, cb):
+        self.xact_listeners.remove(cb)
+
+    def set_muted(self, flag):
+        ''' Suppress transaction callbacks and statistics while already
+            executed instructions are re-executed by the execution history.
+        '''
+        self.muted = flag
+
+    def adb_abort(self):
+        ''' Abort current transaction and release the bus '''
+        if self.journal is not None:
+            self.journal.log_adb_abort()
+        self.cpu_obj.set_t1_line(1)
+        self._end_transaction(END_ABORTED)
+
+    def _end_transaction(self, reason=END_DONE):
+        self.adb_state = ADB_STATE_IDLE
+        self.adb_end_reason = reason
+        if self.muted:
+            return
+        self.xact_counts[reason] += 1
+        if self.xact_done_cb:
+            self.xact_done_cb(self)
+        for cb in self.xact_listeners:
+            cb(self)
+
+    def save_state(self):
+        ''' Return an immutable snapshot of the bus state '''
+        return (tuple(getattr(self, name) for name in STATE_FIELDS[:-3]) +
+                (bytes(self.adb_data), self.adb_listen_data,
+                 tuple(self.adb_listen_bits)))
+
+    def restore_state(self, state):
+        ''' Restore bus state saved by save_state() '''
+        for name, val in zip(STATE_FIELDS[:-3], state):
+            setattr(self, name, val)
+        self.adb_data = bytearray(state[-3])
+        self.adb_listen_data = state[-2]
+        self.adb_listen_bits = list(state[-1])
+
     def set_adb_in_line(self, cb, mask):
         self.adb_in_cb = cb
         self.adb_in_mask = mask
@@ -47,80 +163,164 @@ class ADBSim:
         if self.adb_in_cb:
             return (self.adb_in_cb() & self.adb_in_mask) != 0
 
+    def _drive_line(self, level):
+        ''' Drive the ADB line to the given level as host.
+            The device can still pull the line low (wired-AND).
+            Returns resulting line state.
+        '''
+        if level and self._read_adb_in():
+            level = 0
+        self.cpu_obj.set_t1_line(level)
+        return level
+
+    def set_verbose(self, flag):
+        ''' Enable/disable logging of ADB bus events '''
+        self.verbose = flag
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def next_event(self, cycles):
+        ''' Return the cycle at which the ADB FSM will change the bus state
+            next assuming the device doesn't touch its ADB output until then.
+            Returns None if the bus is idle.
+        '''
+        state = self.adb_state
+        if state == ADB_STATE_IDLE:
+            return None
+        elif state == ADB_STATE_ATT:
+            return self.adb_cyc_cnt + ADB_ATT_CYCLES
+        elif state == ADB_STATE_SYNC:
+            return self.adb_cyc_cnt + ADB_SYNC_CYCLES
+        elif state == ADB_STATE_SEND_CMD or state == ADB_STATE_LISTEN:
+            for delta in (ADB_BIT1_LOW, ADB_BIT0_LOW, ADB_BIT_CELL):
+                if self.adb_cyc_cnt + delta > cycles:
+                    return self.adb_cyc_cnt + delta
+        elif state == ADB_STATE_STOP:
+            return self.adb_cyc_cnt + ADB_STOP_LOW
+        elif state == ADB_STATE_TLT:
+            return self.adb_cyc_cnt + ADB_TLT_CYCLES
+        elif state == 8: # waiting for the device's start bit
+            if not self._read_adb_in():
+                return self.adb_cyc_cnt + ADB_TALK_TIMEOUT
+        elif state == 9: # receiving a bit from the device
+            # only the timeout is due as long as the line level
+            # matches the current bit phase
+            if bool(self._read_adb_in()) != bool(self.adb_phase):
+                return self.adb_cyc_cnt + ADB_MAX_CELL + 1
+        # any other state needs servicing right away
+        return cycles
+
     def adb_transact(self, cycles):
         if self.adb_state == ADB_STATE_START: # start ADB transaction
-            print("ADB transaction start")
+            self._log("ADB transaction start")
             self.adb_cyc_cnt = cycles
             self.cpu_obj.set_t1_line(0) # pull ADB-in line low
             self.adb_state = ADB_STATE_ATT
         elif self.adb_state == ADB_STATE_ATT:
             # generate attention (T1 low for 800 usecs)
-            if (cycles - self.adb_cyc_cnt) >= 320:
-                print("ADB attention ended")
+            if (cycles - self.adb_cyc_cnt) >= ADB_ATT_CYCLES:
+                self._log("ADB attention ended")
                 self.adb_cyc_cnt = cycles
                 self.cpu_obj.set_t1_line(1) # pull ADB-in line high
                 self.adb_state = ADB_STATE_SYNC
         elif self.adb_state == ADB_STATE_SYNC: # Sync (T1 high for 70 usecs)
-            if (cycles - self.adb_cyc_cnt) >= 28:
-                print("ADB Sync ended")
+            if (cycles - self.adb_cyc_cnt) >= ADB_SYNC_CYCLES:
+                self._log("ADB Sync ended")
                 self.adb_bit = 7
                 self.adb_cyc_cnt = cycles
                 self.cpu_obj.set_t1_line(0) # each bit cell starts low
                 self.adb_state = ADB_STATE_SEND_CMD
         elif self.adb_state == ADB_STATE_SEND_CMD: # send command byte
             if self.adb_bit >= 0:
-                if (cycles - self.adb_cyc_cnt) < 40: # 100 usecs cells
+                if (cycles - self.adb_cyc_cnt) < ADB_BIT_CELL: # 100 usecs cells
                     if (self.adb_cmd & (1 << self.adb_bit)): # bit=1
-                        if (cycles - self.adb_cyc_cnt) >= 14:
+                        if (cycles - self.adb_cyc_cnt) >= ADB_BIT1_LOW:
                             self.cpu_obj.set_t1_line(1) # go high after 35 usecs
                     else: # bit=0
-                        if (cycles - self.adb_cyc_cnt) >= 26:
+                        if (cycles - self.adb_cyc_cnt) >= ADB_BIT0_LOW:
                             self.cpu_obj.set_t1_line(1) # go high after 65 usecs
                 else:
-                    print("Sending next ADB bit")
+                    self._log("Sending next ADB bit")
                     self.cpu_obj.set_t1_line(0) # each bit cell starts low
                     self.adb_bit -= 1
                     if self.adb_bit < 0:
-                        print("Sending ADB byte completed")
-                        print("Sending STOP bit")
+                        self._log("Sending ADB byte completed")
+                        self._log("Sending STOP bit")
                         self.adb_state = ADB_STATE_STOP
                     self.adb_cyc_cnt = cycles
             else:
-                print("ADB command byte already completed")
-                self.adb_state = ADB_STATE_IDLE # abort transaction
+                self._log("ADB command byte already completed")
+                self._end_transaction(END_ABORTED) # abort transaction
         elif self.adb_state == ADB_STATE_STOP: # stop bit
-            if (cycles - self.adb_cyc_cnt) >= 28:
-                self.cpu_obj.set_t1_line(1) # go high after 70 usecs
-                print("ADB stop bit completed")
+            if (cycles - self.adb_cyc_cnt) >= ADB_STOP_LOW:
+                self._drive_line(1) # go high after 70 usecs
+                self._log("ADB stop bit completed")
                 self.adb_cyc_cnt = cycles
                 self.adb_state = ADB_STATE_TLT
-        elif self.adb_state == ADB_STATE_TLT: # Tlt (T1 low for 140 usecs)
-            if self.cpu_obj.get_t1_line() == 0:
-                print("ADB: looks like we got a SRQ!")
+        elif self.adb_state == ADB_STATE_TLT: # Tlt (T1 high for 140 usecs)
+            if self._drive_line(1) == 0:
+                # a device extends the stop bit by holding the line low
+                if not self.adb_srq:
+                    self._log("ADB: looks like we got a SRQ!")
+                    if not self.muted:
+                        self.num_srq += 1
+                self.adb_srq = True
+                self.adb_cyc_cnt = cycles # Tlt starts when line is released
             else:
-                if (cycles - self.adb_cyc_cnt) >= 58:
-                    print("ADB: Tlt completed")
+                if (cycles - self.adb_cyc_cnt) >= ADB_TLT_CYCLES:
+                    self._log("ADB: Tlt completed")
                     self.adb_state = ADB_STATE_DATA
                     self.adb_cyc_cnt = cycles
         elif self.adb_state == ADB_STATE_DATA: # init data transfer
             if (self.adb_cmd & 0xC) == 0xC: # ADB Talk
                 self.adb_state = 8
                 self.adb_cyc_cnt = cycles
-                print("ADB Talk started")
+                self._log("ADB Talk started")
             elif (self.adb_cmd & 0xC) == 0x8: # ADB Listen
-                print("ADB Listen not supported yet")
-                self.adb_state = ADB_STATE_IDLE
+                self._log("ADB Listen started")
+                # start bit "1", data bits MSB first, stop bit "0"
+                self.adb_listen_bits = [1]
+                for byte in self.adb_listen_data:
+                    for bit in range(7, -1, -1):
+                        self.adb_listen_bits.append((byte >> bit) & 1)
+                self.adb_listen_bits.append(0)
+                self.adb_bit_pos = 0
+                self.adb_cyc_cnt = cycles
+                self.cpu_obj.set_t1_line(0) # each bit cell starts low
+                self.adb_state = ADB_STATE_LISTEN
+            elif (self.adb_cmd & 0xF) == 0x1: # ADB Flush
+                self._log("ADB Flush completed")
+                self._end_transaction()
+            else:
+                self._log("Unsupported ADB command 0x%01X" % self.adb_cmd)
+                self._end_transaction(END_UNSUPPORTED)
+        elif self.adb_state == ADB_STATE_LISTEN: # send data to device
+            if (cycles - self.adb_cyc_cnt) < ADB_BIT_CELL: # 100 usecs cells
+                if self.adb_listen_bits[self.adb_bit_pos]: # bit=1
+                    if (cycles - self.adb_cyc_cnt) >= ADB_BIT1_LOW:
+                        self.cpu_obj.set_t1_line(1) # go high after 35 usecs
+                else: # bit=0
+                    if (cycles - self.adb_cyc_cnt) >= ADB_BIT0_LOW:
+                        self.cpu_obj.set_t1_line(1) # go high after 65 usecs
             else:
-                print("Unsupported ADB command 0x%01X" % self.adb_cmd)
-                self.adb_state = ADB_STATE_IDLE
+                self.adb_bit_pos += 1
+                self.adb_cyc_cnt = cycles
+                if self.adb_bit_pos < len(self.adb_listen_bits):
+                    self.cpu_obj.set_t1_line(0) # each bit cell starts low
+                else:
+                    self._log("ADB Listen completed")
+                    self._end_transaction()
         elif self.adb_state == 8: # wait for start bit
             self.cpu_obj.set_t1_line(self._read_adb_in() ^ 1)
             if self.cpu_obj.get_t1_line():
-                if (cycles - self.adb_cyc_cnt) >= 46:
-                    print("ADB Tlt timeout reached")
-                    self.adb_state = ADB_STATE_IDLE
+                if (cycles - self.adb_cyc_cnt) >= ADB_TALK_TIMEOUT:
+                    self._log("ADB Tlt timeout reached")
+                    self.adb_timeout = True
+                    self._end_transaction(END_TLT_TIMEOUT)
             else:
-                print("Checking ADB start bit")
+                self._log("Checking ADB start bit")
                 self.adb_state = 9
                 self.adb_next_state = 10
                 self.adb_cyc_cnt = cycles
@@ -131,42 +331,48 @@ class ADBSim:
             self.cpu_obj.set_t1_line(self._read_adb_in() ^ 1)
             if self.cpu_obj.get_t1_line() == 0:
                 if self.adb_phase: # high-to-low transition
-                    if (cycles - self.adb_cyc_cnt) < 15:
-                        print("ADB timing error, high-to-low too short!")
-                        self.adb_state = ADB_STATE_IDLE
+                    if (cycles - self.adb_cyc_cnt) < ADB_MIN_CELL:
+                        self._log("ADB timing error, high-to-low too short!")
+                        self._end_transaction(END_TIMING_ERROR)
                     else:
                         self.adb_high_time = (cycles - self.adb_cyc_cnt - self.adb_low_time)
                         # simple heuristic for distinguishing between 0 and 1 bits
                         # if the low phase is greater than 35 usecs, then assume
                         # we got a "0" bit, otherwise it's a "1" bit
-                        if self.adb_low_time > 14:
+                        if self.adb_low_time > ADB_BIT1_LOW:
                             self.adb_bit = 0
                         else:
                             self.adb_bit = 1
-                        print("Got %d bit from ADB device" % self.adb_bit)
-                        print("low duration: %f usecs" % (self.adb_low_time * 2.5))
-                        print("high duration: %f usecs" % (self.adb_high_time * 2.5))
+                        self._log("Got %d bit from ADB device" % self.adb_bit)
+                        self._log("low duration: %f usecs" % (self.adb_low_time * 2.5))
+                        self._log("high duration: %f usecs" % (self.adb_high_time * 2.5))
                         self.adb_state = self.adb_next_state
                         self.adb_cyc_cnt = cycles
                 else:
-                    if (cycles - self.adb_cyc_cnt) > 52:
-                        print("ADB bit cell timeout 1 (greater than 130 usecs)")
-                        self.adb_state = ADB_STATE_IDLE
+                    if (cycles - self.adb_cyc_cnt) > ADB_MAX_CELL:
+                        self._log("ADB bit cell timeout 1 (greater than 130 usecs)")
+                        self._end_transaction(END_CELL_TIMEOUT)
                     else:
                         self.adb_low_time = (cycles - self.adb_cyc_cnt)
             else:
                 if self.adb_phase == 0:
                     self.adb_low_time = (cycles - self.adb_cyc_cnt)
-                    print("ADB line changed from low to high")
+                    self._log("ADB line changed from low to high")
+                    if self.adb_next_state == 12:
+                        # the stop bit isn't followed by a high-to-low
+                        # transition so decode it as soon as the line
+                        # goes high again
+                        self.adb_bit = 0 if self.adb_low_time > ADB_BIT1_LOW else 1
+                        self.adb_state = self.adb_next_state
                 self.adb_phase = 1
                 self.adb_high_time = (cycles - self.adb_cyc_cnt - self.adb_low_time)
-                if (cycles - self.adb_cyc_cnt) > 52:
-                    print("ADB bit cell timeout 2 (greater than 130 usecs)")
-                    self.adb_state = ADB_STATE_IDLE
+                if self.adb_state == 9 and (cycles - self.adb_cyc_cnt) > ADB_MAX_CELL:
+                    self._log("ADB bit cell timeout 2 (greater than 130 usecs)")
+                    self._end_transaction(END_CELL_TIMEOUT)
         elif self.adb_state == 10: # check start bit
             if self.adb_bit == 0:
-                print("Invalid ADB start bit. Aborting...")
-                self.adb_state = ADB_STATE_IDLE
+                self._log("Invalid ADB start bit. Aborting...")
+                self._end_transaction(END_INVALID_START)
             else:
                 self.adb_state = 9
                 self.adb_next_state = 11
@@ -186,7 +392,7 @@ class ADBSim:
                 self.adb_phase = 0 # always start with the low phase
             else:
                 self.adb_byte = (self.adb_byte << 1) | self.adb_bit
-                print("Got ADB byte 0x%01X from device" % self.adb_byte)
+                self._log("Got ADB byte 0x%01X from device" % self.adb_byte)
                 self.adb_data.append(self.adb_byte)
                 if len(self.adb_data) < 2:
                     self.adb_state = 9
@@ -205,7 +411,8 @@ class ADBSim:
                     self.adb_phase = 0 # always start with the low phase
         elif self.adb_state == 12:
             if self.adb_bit == 0:
-                print("Received ADB stop bit. Stopping...")
+                self._log("Received ADB stop bit. Stopping...")
             else:
-                print("Invalid ADB stop bit. Stopping...")
-            self.adb_state = ADB_STATE_IDLE
+                self._log("Invalid ADB stop bit. Stopping...")
+            self._end_transaction(END_DONE if self.adb_bit == 0 else
+                                  END_INVALID_STOP)
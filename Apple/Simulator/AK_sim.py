@@ -9,6 +9,28 @@ from argparse import ArgumentParser
 from emu8048 import MSC48_CPU
 from dasm8048 import Dasm8048
 from ADB import ADBSim
+from scheduler import SimScheduler
+from cov8048 import CodeCoverage
+from idle8048 import IdleLoopDetector
+from memo8048 import SubroutineMemo
+from history8048 import ExecHistory, DEF_MAX_UNDO
+from patch8048 import RomWatcher
+from journal8048 import JournalWriter, JournalReplayer
+from adb_keys import KeyboardDecoder
+from romcache8048 import load_cache, default_cache_dir
+
+def parse_addr(word, rom_cache):
+    ''' Accept a number or a label of the source listing '''
+    if rom_cache:
+        addr = rom_cache.find_label(word)
+        if addr is not None:
+            return addr
+    return int(word, 0)
+
+def print_label(addr, rom_cache):
+    label = rom_cache.label_at(addr) if rom_cache else None
+    if label:
+        print("%s:" % label)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -16,20 +38,59 @@ if __name__ == "__main__":
                         dest='rom_path',
                         help='path to 8048/8049 ROM file to process',
                         metavar='ROM_PATH', required=True)
+    parser.add_argument('--quiet', action='store_true',
+                        help='suppress logging of port and ADB bus events')
+    parser.add_argument('--coverage', type=str, dest='cov_path',
+                        help='collect code coverage and save it on exit',
+                        metavar='COV_PATH')
+    parser.add_argument('--fast-idle', action='store_true', dest='fast_idle',
+                        help='fast-forward idle loops during "run"')
+    parser.add_argument('--memo', action='store_true',
+                        help='memoize results of pure subroutines')
+    parser.add_argument('--memo-validate', action='store_true',
+                        dest='memo_validate',
+                        help='re-execute memoized subroutines and compare')
+    parser.add_argument('--history', action='store_true',
+                        help='record execution history for reverse stepping')
+    parser.add_argument('--history-size', type=int, default=DEF_MAX_UNDO,
+                        dest='history_size',
+                        help='number of instructions kept in the undo log')
+    parser.add_argument('--watch', action='store_true',
+                        help='reload the ROM (or --src) when the file changes')
+    parser.add_argument('--src', type=str, dest='src_path',
+                        help='assemble this source over the ROM at startup',
+                        metavar='SRC_PATH')
+    parser.add_argument('--record', type=str, dest='record_path',
+                        help='record all external inputs into a journal',
+                        metavar='JOURNAL_PATH')
+    parser.add_argument('--replay', type=str, dest='replay_path',
+                        help='replay inputs from a journal, see "replay"',
+                        metavar='JOURNAL_PATH')
+    parser.add_argument('--cache-dir', type=str, dest='cache_dir',
+                        help='directory of the ROM cache used with --src '
+                        '(default: %s)' % default_cache_dir())
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+                        help="always assemble --src, don't use the ROM cache")
 
     opts = parser.parse_args()
 
     cpu_obj = MSC48_CPU()
 
     with open(opts.rom_path, 'rb') as rom_file:
-        rom_file.seek(0, 2)
-        rom_size = rom_file.tell()
-        print("ROM file size %d bytes" % rom_size)
+        rom_data = bytearray(rom_file.read())
+    rom_size = len(rom_data)
+    print("ROM file size %d bytes" % rom_size)
+
+    # the cache provides labels and the assembled source
+    rom_cache = None
+    if opts.src_path and not opts.no_cache:
+        try:
+            rom_cache = load_cache(rom_data, opts.src_path, opts.cache_dir)
+        except (OSError, ValueError) as e: # AsmError is a ValueError
+            print("ROM cache disabled: %s" % e)
 
-        # load ROM image in the the CPU object
-        rom_file.seek(0, 0)
-        rom_data = rom_file.read();
-        cpu_obj.set_rom_data(rom_data, rom_size)
+    # load ROM image in the the CPU object
+    cpu_obj.set_rom_data(rom_data, rom_size)
 
     # instantiate the disassembler
     dasm = Dasm8048()
@@ -43,6 +104,61 @@ if __name__ == "__main__":
     else:
         adb.set_adb_in_line(cpu_obj.read_port1, 0x80) # AEKII
 
+    # decode key events from the replies
+    kbd = KeyboardDecoder(adb)
+
+    if opts.quiet:
+        cpu_obj.set_verbose(False)
+        adb.set_verbose(False)
+    else:
+        kbd.subscribe(lambda ev: print("Key %s: %s (0x%02X)" % (
+                      "down" if ev.down else "up", ev.name, ev.keycode)))
+
+    if opts.cov_path:
+        cov = CodeCoverage(rom_size)
+        cov.attach(cpu_obj)
+
+    if opts.history and (opts.fast_idle or opts.memo or opts.memo_validate):
+        # both skip instructions the history couldn't record
+        print("Execution history enabled, ignoring --fast-idle and --memo")
+        opts.fast_idle = opts.memo = opts.memo_validate = False
+
+    idle_det = IdleLoopDetector(cpu_obj) if opts.fast_idle else None
+
+    memo = None
+    if opts.memo or opts.memo_validate:
+        memo = SubroutineMemo(cpu_obj, validate=opts.memo_validate)
+
+    history = None
+    if opts.history:
+        history = ExecHistory(cpu_obj, adb, opts.history_size)
+
+    # instantiate the scheduler driving the CPU in slices of cycles
+    sched = SimScheduler(cpu_obj)
+
+    watcher = None
+    if opts.src_path:
+        watcher = RomWatcher(cpu_obj, opts.src_path, is_source=True)
+        if rom_cache:
+            cpu_obj.reload_rom(bytes(rom_cache.image))
+            print("Loaded %s from the ROM cache" % opts.src_path)
+        else:
+            watcher.reload()
+    elif opts.watch:
+        watcher = RomWatcher(cpu_obj, opts.rom_path)
+    if opts.watch:
+        sched.add_slice_cb(watcher.poll)
+
+    journal = None
+    if opts.record_path:
+        journal = JournalWriter(cpu_obj, adb, opts.record_path)
+        sched.add_slice_cb(journal.on_slice)
+
+    replayer = None
+    if opts.replay_path:
+        replayer = JournalReplayer(cpu_obj, adb, opts.replay_path,
+                                   history.note_input if history else None)
+
     print("Welcome to the ADB keyboard simulator.")
     print("Please enter a command or 'help'.")
 
@@ -52,6 +168,9 @@ if __name__ == "__main__":
     while cmd != "quit":
         inp_str = input("> ")
 
+        if opts.watch:
+            watcher.poll()
+
         if inp_str == "":
             if prev_cmd != "":
                 inp_str = prev_cmd
@@ -68,15 +187,17 @@ if __name__ == "__main__":
         elif cmd == "dasm":
             if len(words) == 1:
                 pc = cpu_obj.get_pc()
+                print_label(pc, rom_cache)
                 s,l = dasm.dasm_single(pc, bytes([rom_data[pc], rom_data[pc+1]]))
                 print(hex(pc).ljust(8), s)
             elif len(words) < 3:
                 print("Invalid command syntax")
                 continue
             else:
-                addr  = int(words[1], 0)
+                addr  = parse_addr(words[1], rom_cache)
                 count = int(words[2], 0)
                 for i in range(count):
+                    print_label(addr, rom_cache)
                     s,l = dasm.dasm_single(addr, bytes([rom_data[addr], rom_data[addr+1]]))
                     print(hex(addr).ljust(8), s)
                     addr += l
@@ -86,9 +207,64 @@ if __name__ == "__main__":
             if len(words) < 2:
                 print("Invalid command syntax")
                 continue
-            addr = int(words[1], 0)
+            addr = parse_addr(words[1], rom_cache)
             print("Execute until 0x%03X" % addr)
             cpu_obj.exec_until(addr)
+        elif cmd in ("rstep", "rsi", "runtil", "hist"):
+            if not history:
+                print("Execution history is disabled, use --history")
+                continue
+            if journal and cmd != "hist":
+                print("Can't execute backwards while recording a journal")
+                continue
+            if cmd == "hist":
+                history.print_stats()
+            elif cmd == "runtil":
+                if len(words) < 2:
+                    print("Invalid command syntax")
+                    continue
+                addr = parse_addr(words[1], rom_cache)
+                print("Reverse execute until 0x%03X" % addr)
+                if not history.reverse_continue({addr}):
+                    print("Reached the beginning of the recorded history")
+            else:
+                count = int(words[1], 0) if len(words) > 1 else 1
+                if history.reverse_step(count) < count:
+                    print("Reached the beginning of the recorded history")
+        elif cmd == "run":
+            if len(words) < 2:
+                print("Invalid command syntax")
+                continue
+            num_cycles = int(words[1], 0)
+            speed = float(words[2]) if len(words) > 2 else 0
+            sched.set_speed(speed)
+            try:
+                sched.run(num_cycles if num_cycles > 0 else None)
+            except KeyboardInterrupt:
+                print("\nInterrupted")
+            sched.print_report()
+            if idle_det:
+                idle_det.print_stats()
+            if memo:
+                memo.print_stats()
+        elif cmd in ("replay", "seek"):
+            if not replayer:
+                print("No journal to replay, use --replay")
+                continue
+            if cmd == "seek" and len(words) < 2:
+                print("Invalid command syntax")
+                continue
+            end_cycle = int(words[1], 0) if len(words) > 1 else None
+            try:
+                if cmd == "seek":
+                    replayer.seek(end_cycle)
+                elif replayer.run(end_cycle):
+                    print("Reached the end of the journal")
+            except ValueError as e:
+                print(e)
+            replayer.print_stats()
+        elif cmd == "keys":
+            kbd.print_state()
         elif cmd == "regs":
             cpu_obj.print_state()
         elif cmd == "dump":
@@ -104,24 +280,69 @@ if __name__ == "__main__":
             dst = args[0].upper()
             val = int(args[1], 0)
             cpu_obj.set_state(dst, val)
+            if history:
+                history.note_input()
         elif cmd == "adb_send":
             if len(words) < 2:
                 print("Invalid command syntax")
                 continue
             adb_cmd = int(words[1], 0)
+            listen_data = bytes([int(w, 0) & 0xFF for w in words[2:]])
             print("Sending ADB command 0x%01X" % adb_cmd)
-            adb.adb_send(adb_cmd)
+            adb.adb_send(adb_cmd, listen_data)
+            if history:
+                history.note_input()
+        elif cmd == "patch":
+            if len(words) < 3:
+                print("Invalid command syntax")
+                continue
+            addr = int(words[1], 0)
+            data = bytes([int(w, 0) & 0xFF for w in words[2:]])
+            try:
+                if cpu_obj.patch_rom(addr, data):
+                    print("Patched %d bytes at 0x%03X" % (len(data), addr))
+                else:
+                    print("ROM already contains these bytes")
+            except ValueError as e:
+                print(e)
+        elif cmd == "cov":
+            if not opts.cov_path:
+                print("Coverage collection is disabled, use --coverage")
+                continue
+            cov.print_summary(rom_data)
         elif cmd == "help":
             print("step        - execute single instruction")
             print("si          - execute single instruction")
             print("until addr  - execute until addr is reached")
+            print("              (addresses can be given as labels of --src)")
+            print("rstep [N]   - step N instructions backwards")
+            print("rsi [N]     - step N instructions backwards")
+            print("runtil addr - execute backwards until addr is reached")
+            print("hist        - print execution history statistics")
+            print("run N [S]   - execute N cycles (0 = until Ctrl-C)")
+            print("              unthrottled or paced to S times real time")
             print("regs        - print internal registers")
             print("dump        - dump internal memory")
             print("dasm [A N]] - disassemble N instructions at address A")
             print("              'dasm' without parameters disassembles one")
             print("              instruction at PC")
             print("set X=Y     - change value of register X to Y")
-            print("adb_send X  - send byte X over ADB")
+            print("adb_send X [D..] - send byte X over ADB followed by")
+            print("              Listen data bytes D")
+            print("patch A D.. - write bytes D to ROM at address A")
+            print("cov         - print code coverage summary")
+            print("keys        - print keyboard state and typed text")
+            print("replay [C]  - replay the journal until cycle C or its end")
+            print("seek C      - replay the journal from the nearest")
+            print("              snapshot before cycle C until C")
             print("quit        - shut down the simulator")
         else:
             print("Unknown command: %s" % cmd)
+
+    if journal:
+        journal.close()
+        journal.print_stats()
+
+    if opts.cov_path:
+        cov.save(opts.cov_path)
+        print("Code coverage saved to %s" % opts.cov_path)
@@ -0,0 +1,278 @@
+'''
+    Socket bridge between the simulated ADB keyboard and an external
+    host emulator.
+
+    The bridge listens on a Unix domain socket or on a localhost TCP port
+    and executes ADB transactions requested by the host. In between
+    requests, the CPU keeps running in real time driven by the scheduler.
+
+    Framing (all integers are little-endian):
+
+    request  := u16 payload_len, u8 count, count * transaction
+    transaction := u8 cmd, u8 listen_len, listen_len * u8 data
+
+    response := u16 payload_len, u8 count, count * reply
+    reply    := u8 status, u8 reply_len, reply_len * u8 data
+
+    Status bits:
+     - XACT_SRQ      - a device requested service during the command
+     - XACT_TIMEOUT  - no device responded to the Talk command
+     - XACT_ABORTED  - transaction didn't complete in time
+
+    Usage:
+    python3 adb_bridge.py --rom_path=[path to ROM] --socket=/tmp/adb.sock
+    python3 adb_bridge.py --rom_path=[path to ROM] --port=5050
+'''
+
+import asyncio
+import socket
+import struct
+
+from emu8048 import MSC48_CPU
+from ADB import ADBSim
+from scheduler import SimScheduler
+from journal8048 import JournalWriter
+from metrics import MetricsRegistry, COUNTER, GAUGE, DEF_UPDATE_INTERVAL
+
+XACT_SRQ     = 0x01
+XACT_TIMEOUT = 0x02
+XACT_ABORTED = 0x04
+
+XACT_MAX_CYCLES = 4000 # 10 ms, abort transactions taking longer than that
+XACT_STEP = 16 # granularity used for driving the CPU during transactions
+
+def pack_transactions(xacts):
+    ''' Build request frame from a list of (cmd, listen_data) tuples '''
+    payload = bytearray([len(xacts)])
+    for cmd, data in xacts:
+        data = data or b''
+        payload += bytes([cmd & 0xFF, len(data)]) + data
+    return struct.pack('<H', len(payload)) + payload
+
+def unpack_replies(payload):
+    ''' Decode response payload into a list of (status, reply_data) tuples '''
+    replies = []
+    pos = 1
+    for i in range(payload[0]):
+        status, length = payload[pos], payload[pos + 1]
+        replies.append((status, bytes(payload[pos + 2:pos + 2 + length])))
+        pos += 2 + length
+    return replies
+
+class ADBBridge:
+    def __init__(self, cpu_obj, adb_obj, sched):
+        self.cpu_obj = cpu_obj
+        self.adb_obj = adb_obj
+        self.sched = sched
+        self.num_xacts = 0
+        self.queue_depth = 0 # transactions of the current request not done yet
+
+    def do_transaction(self, cmd, listen_data):
+        ''' Execute a single ADB transaction synchronously.
+            Returns (status, reply_data).
+        '''
+        adb = self.adb_obj
+        adb.adb_send(cmd, listen_data)
+        start = self.cpu_obj.cycles
+        while not adb.is_idle():
+            if self.cpu_obj.cycles - start > XACT_MAX_CYCLES:
+                adb.adb_abort()
+                return (XACT_ABORTED, b'')
+            self.sched.run_slice(XACT_STEP)
+
+        self.num_xacts += 1
+        status = 0
+        if adb.adb_srq:
+            status |= XACT_SRQ
+        if adb.adb_timeout:
+            status |= XACT_TIMEOUT
+        return (status, bytes(adb.adb_data))
+
+    def parse_request(self, payload):
+        ''' Split a request payload into a list of (cmd, listen_data).
+            Raises ValueError if the frame is malformed.
+        '''
+        if not payload:
+            raise ValueError("Empty request")
+        count = payload[0]
+        pos = 1
+        xacts = []
+        for i in range(count):
+            if pos + 2 > len(payload):
+                raise ValueError("Request truncated at transaction %d" % i)
+            cmd, length = payload[pos], payload[pos + 1]
+            pos += 2
+            if pos + length > len(payload):
+                raise ValueError("Listen data of transaction %d truncated" % i)
+            xacts.append((cmd, payload[pos:pos + length]))
+            pos += length
+        if pos != len(payload):
+            raise ValueError("%d extra bytes in request" % (len(payload) - pos))
+        return xacts
+
+    def process_request(self, payload):
+        ''' Execute all transactions from a request payload
+            and return the response frame.
+        '''
+        xacts = self.parse_request(payload)
+        resp = bytearray([len(xacts)])
+        self.queue_depth = len(xacts)
+        for cmd, data in xacts:
+            status, reply = self.do_transaction(cmd, data)
+            self.queue_depth -= 1
+            resp += bytes([status, len(reply)]) + reply
+        return struct.pack('<H', len(resp)) + resp
+
+    async def handle_client(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print("Host connected")
+        try:
+            while True:
+                hdr = await reader.readexactly(2)
+                (length,) = struct.unpack('<H', hdr)
+                payload = await reader.readexactly(length)
+                writer.write(self.process_request(payload))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
+            print("Bad request: %s, dropping connection" % e)
+        finally:
+            writer.close()
+        print("Host disconnected")
+
+    async def run_cpu(self):
+        ''' Keep the CPU running in real time between requests '''
+        self.sched.start()
+        while True:
+            delay = self.sched.run_slice()
+            # yield to the event loop even when running behind
+            await asyncio.sleep(delay)
+
+    async def serve(self, sock_path=None, port=None):
+        if sock_path:
+            server = await asyncio.start_unix_server(self.handle_client,
+                                                     path=sock_path)
+            print("ADB bridge listening on %s" % sock_path)
+        else:
+            server = await asyncio.start_server(self.handle_client,
+                                                host='127.0.0.1', port=port)
+            print("ADB bridge listening on 127.0.0.1:%d" % port)
+        cpu_task = asyncio.ensure_future(self.run_cpu())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            cpu_task.cancel()
+
+class ADBBridgeClient:
+    ''' Minimal blocking client for talking to the ADB bridge '''
+    def __init__(self, sock_path=None, port=None):
+        if sock_path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(sock_path)
+        else:
+            self.sock = socket.create_connection(('127.0.0.1', port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _recv_exactly(self, length):
+        buf = bytearray()
+        while len(buf) < length:
+            chunk = self.sock.recv(length - len(buf))
+            if not chunk:
+                raise ConnectionError("ADB bridge closed the connection")
+            buf += chunk
+        return buf
+
+    def transact(self, xacts):
+        ''' Execute a batch of (cmd, listen_data) transactions.
+            Returns a list of (status, reply_data) tuples.
+        '''
+        self.sock.sendall(pack_transactions(xacts))
+        (length,) = struct.unpack('<H', self._recv_exactly(2))
+        return unpack_replies(self._recv_exactly(length))
+
+    def close(self):
+        self.sock.close()
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--rom_path', type=str,
+                        dest='rom_path',
+                        help='path to 8048/8049 ROM file to process',
+                        metavar='ROM_PATH', required=True)
+    parser.add_argument('--socket', type=str, dest='sock_path',
+                        help='path of the Unix domain socket to listen on')
+    parser.add_argument('--port', type=int, default=5050,
+                        help='localhost TCP port to listen on')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='simulation speed relative to real time')
+    parser.add_argument('--metrics-file', type=str, dest='metrics_path',
+                        help='periodically write metrics to this file',
+                        metavar='METRICS_PATH')
+    parser.add_argument('--metrics-port', type=int, dest='metrics_port',
+                        help='serve metrics over HTTP on this localhost port')
+    parser.add_argument('--metrics-interval', type=float,
+                        default=DEF_UPDATE_INTERVAL, dest='metrics_interval',
+                        help='seconds between metrics updates')
+    parser.add_argument('--record', type=str, dest='record_path',
+                        help='record all external inputs into a journal',
+                        metavar='JOURNAL_PATH')
+
+    opts = parser.parse_args()
+
+    cpu_obj = MSC48_CPU()
+    cpu_obj.set_verbose(False)
+
+    with open(opts.rom_path, 'rb') as rom_file:
+        rom_data = rom_file.read()
+        cpu_obj.set_rom_data(rom_data, len(rom_data))
+
+    adb = ADBSim(cpu_obj)
+    adb.set_verbose(False)
+    cpu_obj.set_post_instr_cb(adb.adb_transact)
+
+    if len(rom_data) < 2048:
+        adb.set_adb_in_line(cpu_obj.read_port2, 0x80) # AKII
+    else:
+        adb.set_adb_in_line(cpu_obj.read_port1, 0x80) # AEKII
+
+    sched = SimScheduler(cpu_obj, slice_cycles=1000)
+    sched.set_speed(opts.speed)
+
+    journal = None
+    if opts.record_path:
+        journal = JournalWriter(cpu_obj, adb, opts.record_path)
+        sched.add_slice_cb(journal.on_slice)
+
+    bridge = ADBBridge(cpu_obj, adb, sched)
+
+    metrics = None
+    if opts.metrics_path or opts.metrics_port:
+        metrics = MetricsRegistry(opts.metrics_interval)
+        metrics.add_scheduler(sched)
+        metrics.add_adb(adb)
+        metrics.add_metric('adb_bridge_transactions_total', COUNTER,
+                           lambda: bridge.num_xacts,
+                           'Transactions completed for the host')
+        metrics.add_metric('adb_bridge_queue_depth', GAUGE,
+                           lambda: bridge.queue_depth,
+                           'Transactions waiting in the current request')
+        if opts.metrics_path:
+            metrics.set_snapshot_file(opts.metrics_path)
+        if opts.metrics_port:
+            metrics.start_http(opts.metrics_port)
+
+    try:
+        asyncio.run(bridge.serve(opts.sock_path, opts.port))
+    except KeyboardInterrupt:
+        pass
+    if metrics:
+        metrics.stop_http()
+    if journal:
+        journal.close()
+        journal.print_stats()
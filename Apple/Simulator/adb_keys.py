@@ -0,0 +1,232 @@
+'''
+    Decoding of ADB keyboard replies into key events.
+
+    KeyboardDecoder turns the bytes returned by Talk Register 0 into
+    key-down/key-up events carrying Apple keycodes, key names and the
+    modifier state at the time of the event. It also keeps track of
+    Talk Register 2 (modifier keys and LEDs) and of the text typed
+    so far using the US layout.
+
+    Events are delivered to subscribed callables. queue() returns
+    a deque subscribed to the events, drain() turns it into a generator.
+
+    The decoder doesn't depend on ADBSim: decode_reply() can be fed with
+    replies from any source, e.g. the lanes of BatchADB.
+
+    Talk R0 reply: two key transitions, bit 7 - key released,
+    bits 6...0 - keycode, 0xFF - no key. 0x7F7F and 0xFFFF report
+    the Power key going down and up.
+
+    Talk R2 reply (active low): bit 14 - Delete, 13 - Caps Lock,
+    12 - Reset, 11 - Control, 10 - Shift, 9 - Option, 8 - Command,
+    7 - Num Lock/Clear, 6 - Scroll Lock, 2...0 - Scroll, Caps and
+    Num Lock LEDs.
+'''
+
+from collections import deque, namedtuple
+
+KeyEvent = namedtuple('KeyEvent', 'cycle keycode name down modifiers')
+
+KEY_NO_KEY = 0xFF
+KEY_POWER  = 0x7F
+
+# modifier state bits
+MOD_SHIFT   = 0x01
+MOD_CONTROL = 0x02
+MOD_OPTION  = 0x04
+MOD_COMMAND = 0x08
+MOD_CAPS    = 0x10
+
+MODIFIER_KEYS = {0x36: MOD_CONTROL, 0x37: MOD_COMMAND, 0x38: MOD_SHIFT,
+                 0x39: MOD_CAPS, 0x3A: MOD_OPTION, 0x7B: MOD_SHIFT,
+                 0x7C: MOD_OPTION, 0x7D: MOD_CONTROL}
+
+# LED bits in Register 2 (when cleared)
+LED_NUM_LOCK    = 0x01
+LED_CAPS_LOCK   = 0x02
+LED_SCROLL_LOCK = 0x04
+
+# Register 2 modifier bits (when cleared) and the matching state bits
+REG2_MODIFIERS = ((0x2000, MOD_CAPS), (0x0800, MOD_CONTROL),
+                  (0x0400, MOD_SHIFT), (0x0200, MOD_OPTION),
+                  (0x0100, MOD_COMMAND))
+
+_KEY_NAMES = {
+    0x00: 'A', 0x01: 'S', 0x02: 'D', 0x03: 'F', 0x04: 'H', 0x05: 'G',
+    0x06: 'Z', 0x07: 'X', 0x08: 'C', 0x09: 'V', 0x0A: 'ISO Section',
+    0x0B: 'B', 0x0C: 'Q', 0x0D: 'W', 0x0E: 'E', 0x0F: 'R', 0x10: 'Y',
+    0x11: 'T', 0x12: '1', 0x13: '2', 0x14: '3', 0x15: '4', 0x16: '6',
+    0x17: '5', 0x18: '=', 0x19: '9', 0x1A: '7', 0x1B: '-', 0x1C: '8',
+    0x1D: '0', 0x1E: ']', 0x1F: 'O', 0x20: 'U', 0x21: '[', 0x22: 'I',
+    0x23: 'P', 0x24: 'Return', 0x25: 'L', 0x26: 'J', 0x27: "'",
+    0x28: 'K', 0x29: ';', 0x2A: '\\', 0x2B: ',', 0x2C: '/', 0x2D: 'N',
+    0x2E: 'M', 0x2F: '.', 0x30: 'Tab', 0x31: 'Space', 0x32: '`',
+    0x33: 'Delete', 0x35: 'Escape', 0x36: 'Control', 0x37: 'Command',
+    0x38: 'Shift', 0x39: 'Caps Lock', 0x3A: 'Option', 0x3B: 'Left',
+    0x3C: 'Right', 0x3D: 'Down', 0x3E: 'Up', 0x41: 'Keypad .',
+    0x43: 'Keypad *', 0x45: 'Keypad +', 0x47: 'Clear', 0x4B: 'Keypad /',
+    0x4C: 'Keypad Enter', 0x4E: 'Keypad -', 0x51: 'Keypad =',
+    0x52: 'Keypad 0', 0x53: 'Keypad 1', 0x54: 'Keypad 2',
+    0x55: 'Keypad 3', 0x56: 'Keypad 4', 0x57: 'Keypad 5',
+    0x58: 'Keypad 6', 0x59: 'Keypad 7', 0x5B: 'Keypad 8',
+    0x5C: 'Keypad 9', 0x60: 'F5', 0x61: 'F6', 0x62: 'F7', 0x63: 'F3',
+    0x64: 'F8', 0x65: 'F9', 0x67: 'F11', 0x69: 'F13', 0x6B: 'F14',
+    0x6D: 'F10', 0x6F: 'F12', 0x71: 'F15', 0x72: 'Help', 0x73: 'Home',
+    0x74: 'Page Up', 0x75: 'Forward Delete', 0x76: 'F4', 0x77: 'End',
+    0x78: 'F2', 0x79: 'Page Down', 0x7A: 'F1', 0x7B: 'Right Shift',
+    0x7C: 'Right Option', 0x7D: 'Right Control', 0x7F: 'Power'
+}
+
+KEY_NAMES = [_KEY_NAMES.get(code, 'Key 0x%02X' % code)
+             for code in range(128)]
+
+# characters produced by each keycode without/with Shift (US layout)
+_UNSHIFTED = "asdfhgzxcv\xa7bqweryt123465=97-80]ou[ip\nlj'k;\\,/nm.\t `"
+_SHIFTED   = 'ASDFHGZXCV\xb1BQWERYT!@#$^%+(&_*)}OU{IP\nLJ"K:|<?NM>\t ~'
+
+KEY_CHARS = [None] * 128
+KEY_SHIFT_CHARS = [None] * 128
+for code in range(len(_UNSHIFTED)):
+    KEY_CHARS[code] = _UNSHIFTED[code]
+    KEY_SHIFT_CHARS[code] = _SHIFTED[code]
+for code, char in ((0x41, '.'), (0x43, '*'), (0x45, '+'), (0x4B, '/'),
+                   (0x4C, '\n'), (0x4E, '-'), (0x51, '='), (0x52, '0'),
+                   (0x53, '1'), (0x54, '2'), (0x55, '3'), (0x56, '4'),
+                   (0x57, '5'), (0x58, '6'), (0x59, '7'), (0x5B, '8'),
+                   (0x5C, '9')):
+    KEY_CHARS[code] = KEY_SHIFT_CHARS[code] = char
+
+KEY_DELETE = 0x33
+
+def drain(queue):
+    ''' Generator yielding and removing the events stored in queue '''
+    while queue:
+        yield queue.popleft()
+
+class KeyboardDecoder:
+    def __init__(self, adb_obj=None):
+        self.adb_obj = None
+        self.keys_down = set()
+        self.modifiers = 0 # MOD_XXX bits derived from key events
+        self.reg2 = None # last value of Talk Register 2
+        self.leds = 0 # LED_XXX bits of lit LEDs
+        self.num_events = 0
+        self.num_reg2_mismatches = 0 # R2 modifiers disagreeing with R0
+        self.subscribers = []
+        self.text = [] # typed characters
+        if adb_obj is not None:
+            self.attach(adb_obj)
+
+    def attach(self, adb_obj):
+        ''' Decode replies of all transactions executed by ADBSim '''
+        self.adb_obj = adb_obj
+        adb_obj.add_xact_listener(self._xact_done)
+
+    def detach(self):
+        self.adb_obj.remove_xact_listener(self._xact_done)
+        self.adb_obj = None
+
+    def subscribe(self, cb):
+        ''' cb(event) will be called with each KeyEvent '''
+        self.subscribers.append(cb)
+
+    def unsubscribe(self, cb):
+        self.subscribers.remove(cb)
+
+    def queue(self, maxlen=None):
+        ''' Return a deque receiving all subsequent KeyEvents '''
+        events = deque(maxlen=maxlen)
+        self.subscribe(events.append)
+        return events
+
+    def _xact_done(self, adb_obj):
+        if len(adb_obj.adb_data) == 2:
+            self.decode_reply(adb_obj.adb_cmd, adb_obj.adb_data,
+                              adb_obj.cpu_obj.cycles)
+
+    def decode_reply(self, cmd, data, cycle=0):
+        ''' Process the reply data of ADB command cmd '''
+        if (cmd & 0xC) != 0xC or len(data) != 2: # Talk only
+            return
+        reg = cmd & 3
+        if reg == 0:
+            if data[0] == data[1] == (KEY_POWER | 0x80):
+                self._key_event(cycle, KEY_POWER, False)
+            elif data[0] == data[1] == KEY_POWER:
+                self._key_event(cycle, KEY_POWER, True)
+            else:
+                for byte in data:
+                    if byte != KEY_NO_KEY:
+                        self._key_event(cycle, byte & 0x7F, not byte & 0x80)
+        elif reg == 2:
+            self._decode_reg2((data[0] << 8) | data[1])
+
+    def _decode_reg2(self, val):
+        self.reg2 = val
+        self.leds = ~val & 7
+        modifiers = 0
+        for bit, mod in REG2_MODIFIERS:
+            if not val & bit:
+                modifiers |= mod
+        if modifiers != self.modifiers:
+            self.num_reg2_mismatches += 1
+
+    def _key_event(self, cycle, keycode, down):
+        if down:
+            self.keys_down.add(keycode)
+        else:
+            self.keys_down.discard(keycode)
+
+        mod = MODIFIER_KEYS.get(keycode)
+        if mod:
+            # both Shift/Option/Control keys may be down at the same time
+            if down or not any(MODIFIER_KEYS.get(code) == mod
+                               for code in self.keys_down):
+                self.modifiers = (self.modifiers | mod if down else
+                                  self.modifiers & ~mod)
+        elif down:
+            self._type(keycode)
+
+        event = KeyEvent(cycle, keycode, KEY_NAMES[keycode], down,
+                         self.modifiers)
+        self.num_events += 1
+        for cb in self.subscribers:
+            cb(event)
+
+    def _type(self, keycode):
+        if self.modifiers & (MOD_COMMAND | MOD_CONTROL | MOD_OPTION):
+            return # shortcuts don't produce text
+        if keycode == KEY_DELETE:
+            if self.text:
+                self.text.pop()
+            return
+        if self.modifiers & MOD_SHIFT:
+            char = KEY_SHIFT_CHARS[keycode]
+        else:
+            char = KEY_CHARS[keycode]
+            if char and self.modifiers & MOD_CAPS and char.isalpha():
+                char = char.upper()
+        if char:
+            self.text.append(char)
+
+    def typed_text(self):
+        ''' Return the text typed so far. Delete removes the last char. '''
+        return ''.join(self.text)
+
+    def clear_text(self):
+        self.text = []
+
+    def print_state(self):
+        print("Keys down: %s" % ', '.join(KEY_NAMES[code]
+                                         for code in sorted(self.keys_down)))
+        print("Modifiers: %s" % ', '.join(name for mod, name in
+              ((MOD_SHIFT, 'Shift'), (MOD_CONTROL, 'Control'),
+               (MOD_OPTION, 'Option'), (MOD_COMMAND, 'Command'),
+               (MOD_CAPS, 'Caps Lock')) if self.modifiers & mod))
+        if self.reg2 is not None:
+            print("Register 2: 0x%04X, LEDs on: %s" % (self.reg2,
+                  ', '.join(name for led, name in
+                  ((LED_NUM_LOCK, 'Num Lock'), (LED_CAPS_LOCK, 'Caps Lock'),
+                   (LED_SCROLL_LOCK, 'Scroll Lock')) if self.leds & led)))
+        print("Key events: %d, typed text: %r" % (self.num_events,
+              self.typed_text()))
@@ -0,0 +1,556 @@
+'''
+    Simple two-pass assembler for the Intel MSC-48 instruction set.
+
+    It understands the syntax used by the commented firmware listings:
+     - labels followed by a colon,
+     - instructions using the mnemonics and operands of Dasm8048,
+     - directives org, db, equ and end,
+     - numbers in Intel (0FFH, 101B, 17Q) and C (0xFF) notation,
+       character constants ('A') and $ for the current address,
+     - expressions with + - * / % & | ^ ~ << >> and parentheses.
+
+    Instruction encodings are taken from the disassembler's OPCODE_TABLE
+    so both tools always agree.
+
+    Source text is split into sections at org directives. Sections are
+    cached: reassembling the same source after an edit only re-parses
+    and re-emits sections whose text or referenced symbols changed.
+
+    Usage:
+    python3 asm8048.py --src=[ASM] --out=[BIN] --verify=[ROM]
+'''
+
+import re
+
+from dasm8048 import OPCODE_TABLE, IMM, ADDR8, ADDR11
+
+DEF_ROM_SIZE = 2048
+FILL_BYTE = 0
+
+ADDR = '{addr}' # jump target of any kind in parsed operand patterns
+
+# Operands consisting of fixed text, e.g. a, r0, @r1, p2, bus
+FIXED_OPERANDS = frozenset(op for entry in OPCODE_TABLE if entry
+                           for op in entry[1].split(',') if op and '{' not in op)
+
+def _build_encode_table():
+    ''' Map (mnemonic, operand pattern) to opcode '''
+    table = {}
+    for opcode, entry in enumerate(OPCODE_TABLE):
+        if entry is None:
+            continue
+        mnem, ops = entry
+        ops = ops.replace(ADDR8, ADDR).replace(ADDR11, ADDR)
+        key = (mnem, tuple(ops.split(',')) if ops else ())
+        if key not in table: # JMP/CALL: keep the opcode for page 0
+            table[key] = opcode
+    return table
+
+ENCODE_TABLE = _build_encode_table()
+
+TOKEN_RE = re.compile(r"\s*(?:(0[xX][0-9A-Fa-f]+|[0-9][0-9A-Fa-f]*[HhQqOo]?)|"
+                      r"([A-Za-z_.?][\w.?]*)|('[^']')|(<<|>>|[-+*/%&|^~()$]))")
+
+BINARY_OPS = [('|',), ('^',), ('&',), ('<<', '>>'), ('+', '-'),
+              ('*', '/', '%')]
+
+class AsmError(ValueError):
+    def __init__(self, msg, line_num=None, file_name=None):
+        self.msg = msg
+        self.line_num = line_num
+        self.file_name = file_name
+        super().__init__(msg)
+
+    def __str__(self):
+        if self.line_num is None:
+            return self.msg
+        return "%s:%d: %s" % (self.file_name or "<source>", self.line_num,
+                              self.msg)
+
+def _parse_number(text):
+    s = text.lower()
+    if s.startswith('0x'):
+        return int(s[2:], 16)
+    if s.endswith('h'):
+        return int(s[:-1], 16)
+    if s.endswith(('q', 'o')):
+        return int(s[:-1], 8)
+    if s.endswith('b') and set(s[:-1]) <= set('01'):
+        return int(s[:-1], 2)
+    return int(s, 10)
+
+class _ExprParser:
+    ''' Recursive descent expression evaluator '''
+    def __init__(self, text, symbols, addr, deps):
+        self.tokens = self._tokenize(text)
+        self.pos = 0
+        self.symbols = symbols
+        self.addr = addr
+        self.deps = deps # symbols consulted, name -> value
+
+    def _tokenize(self, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            m = TOKEN_RE.match(text, pos)
+            if not m:
+                raise AsmError("Invalid expression '%s'" % text)
+            num, name, char, op = m.groups()
+            if num is not None:
+                try:
+                    tokens.append(('num', _parse_number(num)))
+                except ValueError:
+                    raise AsmError("Invalid number '%s'" % num)
+            elif name is not None:
+                tokens.append(('sym', name))
+            elif char is not None:
+                tokens.append(('num', ord(char[1])))
+            else:
+                tokens.append(('op', op))
+            pos = m.end()
+        return tokens
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def evaluate(self):
+        val = self._binary(0)
+        if self._peek() is not None:
+            raise AsmError("Unexpected '%s' in expression" % self._peek()[1])
+        return val
+
+    def _binary(self, level):
+        if level == len(BINARY_OPS):
+            return self._unary()
+        val = self._binary(level + 1)
+        while True:
+            tok = self._peek()
+            if tok is None or tok[0] != 'op' or tok[1] not in BINARY_OPS[level]:
+                return val
+            self.pos += 1
+            rhs = self._binary(level + 1)
+            op = tok[1]
+            if op in ('/', '%') and rhs == 0:
+                raise AsmError("Division by zero")
+            val = {'|': lambda a, b: a | b, '^': lambda a, b: a ^ b,
+                   '&': lambda a, b: a & b, '<<': lambda a, b: a << b,
+                   '>>': lambda a, b: a >> b, '+': lambda a, b: a + b,
+                   '-': lambda a, b: a - b, '*': lambda a, b: a * b,
+                   '/': lambda a, b: a // b, '%': lambda a, b: a % b}[op](val, rhs)
+
+    def _unary(self):
+        tok = self._peek()
+        if tok is None:
+            raise AsmError("Incomplete expression")
+        self.pos += 1
+        kind, val = tok
+        if kind == 'num':
+            return val
+        if kind == 'sym':
+            if val not in self.symbols:
+                raise AsmError("Undefined symbol '%s'" % val)
+            self.deps[val] = self.symbols[val]
+            return self.symbols[val]
+        if val == '$':
+            return self.addr
+        if val == '-':
+            return -self._unary()
+        if val == '+':
+            return self._unary()
+        if val == '~':
+            return ~self._unary()
+        if val == '(':
+            res = self._binary(0)
+            tok = self._peek()
+            if tok != ('op', ')'):
+                raise AsmError("Missing ')'")
+            self.pos += 1
+            return res
+        raise AsmError("Unexpected '%s' in expression" % val)
+
+def _split_operands(text):
+    ''' Split operand list at commas outside of quotes and parentheses '''
+    ops = []
+    depth = 0
+    quote = None
+    cur = ''
+    for c in text:
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            ops.append(cur.strip())
+            cur = ''
+            continue
+        cur += c
+    if quote:
+        raise AsmError("Unterminated string")
+    if cur.strip() or ops:
+        ops.append(cur.strip())
+    return ops
+
+def _strip_comment(line):
+    quote = None
+    for i, c in enumerate(line):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '\'"':
+            quote = c
+        elif c == ';':
+            return line[:i]
+    return line
+
+class _Stmt:
+    ''' Parsed source statement '''
+    def __init__(self, line_idx, label, kind, opcode=None, exprs=(), size=0):
+        self.line_idx = line_idx # line index within the section
+        self.label = label
+        self.kind = kind # instruction mnemonic or directive
+        self.opcode = opcode
+        self.exprs = exprs # operand expressions
+        self.size = size # number of bytes emitted
+
+def _parse_line(line, line_idx):
+    text = _strip_comment(line).strip()
+    if not text:
+        return None
+    label = None
+    m = re.match(r'([A-Za-z_.?][\w.?]*)\s*:\s*', text)
+    if m:
+        label = m.group(1)
+        text = text[m.end():]
+    else:
+        m = re.match(r'([A-Za-z_.?][\w.?]*)\s+equ\s+(.*)$', text, re.I)
+        if m:
+            return _Stmt(line_idx, m.group(1), 'equ', exprs=(m.group(2),))
+    if not text:
+        return _Stmt(line_idx, label, None)
+
+    parts = text.split(None, 1)
+    mnem = parts[0].lower()
+    ops = _split_operands(parts[1]) if len(parts) > 1 else []
+
+    if mnem == 'org':
+        if len(ops) != 1:
+            raise AsmError("org requires one operand")
+        return _Stmt(line_idx, label, 'org', exprs=tuple(ops))
+    if mnem == 'end':
+        return _Stmt(line_idx, label, 'end')
+    if mnem == 'db':
+        if not ops:
+            raise AsmError("db requires at least one operand")
+        size = 0
+        for op in ops:
+            if op[:1] in '\'"':
+                if len(op) < 2 or op[-1] != op[0]:
+                    raise AsmError("Invalid string %s" % op)
+                size += len(op) - 2
+            else:
+                size += 1
+        return _Stmt(line_idx, label, 'db', exprs=tuple(ops), size=size)
+
+    pattern = []
+    exprs = []
+    for op in ops:
+        if op.lower() in FIXED_OPERANDS:
+            pattern.append(op.lower())
+        elif op.startswith('#'):
+            pattern.append(IMM)
+            exprs.append(op[1:])
+        else:
+            pattern.append(ADDR)
+            exprs.append(op)
+    opcode = ENCODE_TABLE.get((mnem, tuple(pattern)))
+    if opcode is None:
+        if any(key[0] == mnem for key in ENCODE_TABLE):
+            raise AsmError("Invalid operands for %s: %s" % (mnem,
+                           ','.join(ops)))
+        raise AsmError("Unknown instruction '%s'" % mnem)
+    return _Stmt(line_idx, label, mnem, opcode, tuple(exprs),
+                 2 if exprs else 1)
+
+class _Section:
+    def __init__(self, first_line, lines):
+        self.first_line = first_line # index of the first source line
+        self.lines = lines
+
+class AsmResult:
+    def __init__(self, rom_size):
+        self.image = bytearray([FILL_BYTE]) * rom_size
+        self.defined = bytearray(rom_size) # 1 for bytes emitted by the source
+        self.line_map = {} # address -> source line number
+        self.symbols = {}
+        self.labels = {} # code labels only, without equ constants
+        self.ranges = [] # (start, end) of the emitted address ranges
+        self.num_emitted = 0 # sections emitted, not taken from the cache
+
+    def fill_from(self, rom_data):
+        ''' Take bytes not defined by the source from rom_data '''
+        for addr in range(min(len(rom_data), len(self.image))):
+            if not self.defined[addr]:
+                self.image[addr] = rom_data[addr]
+
+class Asm8048:
+    def __init__(self, rom_size=DEF_ROM_SIZE):
+        self.rom_size = rom_size
+        self.parse_cache = {} # section text -> list of _Stmt
+        self.emit_cache = {} # section text -> (start, deps, chunks)
+
+    def _split_sections(self, lines):
+        sections = []
+        first = 0
+        for idx, line in enumerate(lines):
+            if idx > first and re.match(r'\s*org\b', _strip_comment(line),
+                                        re.I):
+                sections.append(_Section(first, tuple(lines[first:idx])))
+                first = idx
+        sections.append(_Section(first, tuple(lines[first:])))
+        return sections
+
+    def _parse_section(self, sect, file_name):
+        stmts = self.parse_cache.get(sect.lines)
+        if stmts is None:
+            stmts = []
+            for idx, line in enumerate(sect.lines):
+                try:
+                    stmt = _parse_line(line, idx)
+                except AsmError as e:
+                    raise AsmError(e.msg, sect.first_line + idx + 1, file_name)
+                if stmt is not None:
+                    stmts.append(stmt)
+            self.parse_cache[sect.lines] = stmts
+        return stmts
+
+    def assemble(self, source, file_name=None):
+        ''' Assemble source text. Returns an AsmResult.
+            Raises AsmError on errors.
+        '''
+        lines = source.splitlines()
+        sections = self._split_sections(lines)
+        result = AsmResult(self.rom_size)
+        symbols = result.symbols
+
+        def evaluate(expr, addr, deps, line_num):
+            try:
+                return _ExprParser(expr, symbols, addr, deps).evaluate()
+            except AsmError as e:
+                raise AsmError(e.msg, line_num, file_name)
+
+        # pass 1: assign addresses to labels
+        addr = 0
+        layout = [] # (section, stmts, start address)
+        done = False
+        for sect in sections:
+            stmts = self._parse_section(sect, file_name)
+            start = addr
+            for stmt in stmts:
+                line_num = sect.first_line + stmt.line_idx + 1
+                if stmt.kind == 'org':
+                    addr = evaluate(stmt.exprs[0], addr, {}, line_num)
+                    if stmt is stmts[0]:
+                        start = addr
+                if stmt.label is not None:
+                    if stmt.label in symbols:
+                        raise AsmError("Duplicate symbol '%s'" % stmt.label,
+                                       line_num, file_name)
+                    if stmt.kind == 'equ':
+                        symbols[stmt.label] = evaluate(stmt.exprs[0], addr,
+                                                       {}, line_num)
+                    else:
+                        symbols[stmt.label] = addr
+                        result.labels[stmt.label] = addr
+                if stmt.kind == 'end':
+                    done = True
+                    break
+                addr += stmt.size
+            layout.append((sect, stmts, start))
+            if done:
+                break
+
+        # pass 2: emit code
+        emit_cache = {}
+        for sect, stmts, start in layout:
+            cached = self.emit_cache.get(sect.lines)
+            if (cached is not None and cached[0] == start and
+                all(symbols.get(name) == val for name, val in
+                    cached[1].items())):
+                chunks = cached[2]
+            else:
+                deps = {}
+                chunks = self._emit(sect, stmts, start, evaluate, deps)
+                cached = (start, deps, chunks)
+                result.num_emitted += 1
+            emit_cache[sect.lines] = cached
+
+            for addr, line_idx, data in chunks:
+                line_num = sect.first_line + line_idx + 1
+                if addr + len(data) > self.rom_size:
+                    raise AsmError("Address 0x%03X outside of ROM" %
+                                   (addr + len(data) - 1), line_num, file_name)
+                for i, val in enumerate(data):
+                    if result.defined[addr + i]:
+                        raise AsmError("Overlapping code at 0x%03X" %
+                                       (addr + i), line_num, file_name)
+                    result.defined[addr + i] = 1
+                    result.image[addr + i] = val
+                result.line_map[addr] = line_num
+                if result.ranges and result.ranges[-1][1] == addr:
+                    result.ranges[-1] = (result.ranges[-1][0],
+                                         addr + len(data))
+                else:
+                    result.ranges.append((addr, addr + len(data)))
+        self.emit_cache = emit_cache
+        return result
+
+    def _emit(self, sect, stmts, addr, evaluate, deps):
+        ''' Generate code for one section.
+            Returns list of (address, line index, bytes).
+        '''
+        chunks = []
+        for stmt in stmts:
+            line_num = sect.first_line + stmt.line_idx + 1
+            if stmt.kind == 'org':
+                addr = evaluate(stmt.exprs[0], addr, deps, line_num)
+                continue
+            if stmt.kind == 'end':
+                break
+            if stmt.kind == 'db':
+                data = bytearray()
+                for op in stmt.exprs:
+                    if op[:1] in '\'"':
+                        data += op[1:-1].encode('latin-1')
+                    else:
+                        data.append(self._byte(evaluate(op, addr, deps,
+                                               line_num), line_num))
+            elif stmt.kind in (None, 'equ'):
+                continue
+            else:
+                data = bytearray([stmt.opcode])
+                if stmt.exprs:
+                    val = evaluate(stmt.exprs[0], addr, deps, line_num)
+                    data.append(self._operand(stmt, addr, val, line_num))
+                    data[0] |= self._opcode_bits(stmt, val)
+            chunks.append((addr, stmt.line_idx, bytes(data)))
+            addr += len(data)
+        return chunks
+
+    def _byte(self, val, line_num):
+        if not -128 <= val <= 255:
+            raise AsmError("Value %d out of range" % val, line_num)
+        return val & 0xFF
+
+    def _operand(self, stmt, addr, val, line_num):
+        ops = OPCODE_TABLE[stmt.opcode][1]
+        if IMM in ops:
+            return self._byte(val, line_num)
+        if ADDR8 in ops:
+            if (val & ~0xFF) != ((addr + 1) & ~0xFF):
+                raise AsmError("Jump target 0x%03X not in current page" % val,
+                               line_num)
+            return val & 0xFF
+        if not 0 <= val < 0x1000:
+            raise AsmError("Jump target 0x%X out of range" % val, line_num)
+        return val & 0xFF
+
+    def _opcode_bits(self, stmt, val):
+        ''' Upper address bits of JMP/CALL stored in the opcode '''
+        if ADDR11 in OPCODE_TABLE[stmt.opcode][1]:
+            return (val >> 3) & 0xE0
+        return 0
+
+    def assemble_file(self, path):
+        with open(path, 'r', encoding='utf-8') as src_file:
+            return self.assemble(src_file.read(), path)
+
+def verify(result, rom_data):
+    ''' Compare assembled code with a reference ROM image.
+        Returns (number of matching bytes, list of mismatching addresses,
+        list of (start, end) ranges not covered by the source).
+    '''
+    matches = 0
+    mismatches = []
+    gaps = []
+    for addr in range(len(result.image)):
+        if not result.defined[addr]:
+            if gaps and gaps[-1][1] == addr:
+                gaps[-1] = (gaps[-1][0], addr + 1)
+            else:
+                gaps.append((addr, addr + 1))
+        elif addr < len(rom_data) and result.image[addr] == rom_data[addr]:
+            matches += 1
+        else:
+            mismatches.append(addr)
+    return matches, mismatches, gaps
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import sys
+
+    parser = ArgumentParser()
+    parser.add_argument('--src', type=str, dest='src_path',
+                        help='assembly source file',
+                        metavar='SRC_PATH', required=True)
+    parser.add_argument('--out', type=str, dest='out_path',
+                        help='write ROM image to OUT_PATH',
+                        metavar='OUT_PATH')
+    parser.add_argument('--rom_size', type=lambda s: int(s, 0),
+                        default=DEF_ROM_SIZE, help='ROM size in bytes')
+    parser.add_argument('--fill', type=str, dest='fill_path',
+                        help='take bytes missing in the source from this ROM',
+                        metavar='ROM_PATH')
+    parser.add_argument('--verify', type=str, dest='verify_path',
+                        help='compare result with this ROM',
+                        metavar='ROM_PATH')
+    parser.add_argument('--map', type=str, dest='map_path',
+                        help='write address to source line map',
+                        metavar='MAP_PATH')
+
+    opts = parser.parse_args()
+
+    try:
+        result = Asm8048(opts.rom_size).assemble_file(opts.src_path)
+    except AsmError as e:
+        print(e)
+        sys.exit(1)
+
+    print("Assembled %d bytes" % sum(result.defined))
+
+    status = 0
+    if opts.verify_path:
+        with open(opts.verify_path, 'rb') as rom_file:
+            rom_data = rom_file.read()
+        matches, mismatches, gaps = verify(result, rom_data)
+        print("%d bytes match %s" % (matches, opts.verify_path))
+        for start, end in gaps:
+            print("Not covered by the source: 0x%03X...0x%03X" % (start,
+                  end - 1))
+        for addr in mismatches:
+            instr_addr = max(a for a in result.line_map if a <= addr)
+            print("Mismatch at 0x%03X (line %d): 0x%02X != 0x%02X" % (addr,
+                  result.line_map[instr_addr], result.image[addr],
+                  rom_data[addr] if addr < len(rom_data) else 0))
+        if mismatches:
+            status = 1
+
+    if opts.fill_path:
+        with open(opts.fill_path, 'rb') as rom_file:
+            result.fill_from(rom_file.read())
+
+    if opts.out_path:
+        with open(opts.out_path, 'wb') as out_file:
+            out_file.write(result.image)
+
+    if opts.map_path:
+        with open(opts.map_path, 'w') as map_file:
+            for addr in sorted(result.line_map):
+                map_file.write("%03X %d\n" % (addr, result.line_map[addr]))
+
+    sys.exit(status)
@@ -0,0 +1,124 @@
+'''
+    Self-check of the memory bank switching of the MSC-48 emulator.
+
+    Assembles a small 4 KB image using both memory banks and checks
+    that MSC48_CPU follows the bank rules: SEL MB0/MB1 only take effect
+    with the next JMP or CALL, RET returns to the bank of the caller and
+    JMP/CALL stay in bank 0 while an interrupt routine is running.
+    The interrupt is entered with take_interrupt() as the emulator
+    doesn't deliver interrupts by itself.
+
+    When NumPy is available, BatchCPU is checked against the scalar CPU
+    on the same image, including a lane starting inside an interrupt
+    routine.
+
+    Usage:
+    python3 bankcheck8048.py
+'''
+
+import sys
+
+from asm8048 import Asm8048
+from emu8048 import MSC48_CPU
+
+ROM_SIZE = 4096
+
+CHECK_SRC = """
+    org 0
+    sel mb1
+    jmp Bank1       ; MB=1 -> 0x810
+    org 3
+    jmp Isr         ; stays in bank 0 although MB=1
+    org 20h
+Sub0:
+    mov r7,#55h
+    ret
+Isr:
+    mov r6,#66h
+    retr
+    org 810h
+Bank1:
+    sel mb0
+    call Sub0       ; MB=0 -> 0x020, returns into bank 1
+AfterCall:
+    sel mb1
+    sel rb1
+Loop1:
+    nop
+    jmp Loop1
+"""
+
+def _new_cpu(image):
+    cpu = MSC48_CPU(ROM_SIZE)
+    cpu.set_rom_data(bytearray(image), ROM_SIZE)
+    cpu.set_verbose(False)
+    return cpu
+
+def check_scalar(image, syms):
+    ''' Return a list of failed checks '''
+    errors = []
+
+    def expect(what, val, ref):
+        if val != ref:
+            errors.append("%s: 0x%03X instead of 0x%03X" % (what, val, ref))
+
+    cpu = _new_cpu(image)
+    cpu.exec_single() # SEL MB1
+    expect("PC after SEL MB1", cpu.pc, 1)
+    cpu.exec_single() # JMP Bank1
+    expect("JMP with MB=1", cpu.pc, syms['Bank1'])
+    cpu.exec_single() # SEL MB0
+    cpu.exec_single() # CALL Sub0
+    expect("CALL with MB=0", cpu.pc, syms['Sub0'])
+    cpu.exec_single() # MOV R7,#55h
+    cpu.exec_single() # RET
+    expect("RET to bank 1", cpu.pc, syms['AfterCall'])
+    cpu.exec_single() # SEL MB1
+    cpu.exec_single() # SEL RB1
+
+    ret_pc, psw = cpu.pc, cpu.psw
+    cpu.take_interrupt(3)
+    cpu.exec_single() # JMP Isr
+    expect("JMP inside interrupt routine", cpu.pc, syms['Isr'])
+    cpu.exec_single() # MOV R6,#66h
+    cpu.exec_single() # RETR
+    expect("RETR", cpu.pc, ret_pc)
+    expect("PSW after RETR", cpu.psw, psw)
+    expect("in_isr after RETR", cpu.in_isr, 0)
+    cpu.exec_single() # NOP
+    cpu.exec_single() # JMP Loop1
+    expect("JMP after RETR", cpu.pc, syms['Loop1'])
+    return errors
+
+def check_batch(image, num_steps=16):
+    ''' Compare BatchCPU lanes with the scalar CPU.
+        Returns a list of failed checks.
+    '''
+    import numpy as np
+    from batch8048 import BatchCPU
+
+    batch = BatchCPU(2, image)
+    batch.in_isr[1] = 1 # JMP/CALL of lane 1 stay in bank 0
+    cpus = [_new_cpu(image), _new_cpu(image)]
+    cpus[1].in_isr = 1
+    lanes = np.arange(2)
+    for step in range(num_steps):
+        batch.step(lanes)
+        for lane, cpu in enumerate(cpus):
+            cpu.exec_single()
+            if batch.lane_state(lane) != cpu.save_state():
+                return ["Lane %d differs from the scalar CPU after %d steps"
+                        % (lane, step + 1)]
+    return []
+
+if __name__ == "__main__":
+    result = Asm8048(ROM_SIZE).assemble(CHECK_SRC)
+    errors = check_scalar(result.image, result.symbols)
+    try:
+        errors += check_batch(result.image)
+    except ImportError:
+        print("NumPy not available, BatchCPU not checked")
+    for error in errors:
+        print(error)
+    print("Bank switching: %s" % ("FAILED" if errors else "OK"))
+    sys.exit(1 if errors else 0)
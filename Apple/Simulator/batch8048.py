@@ -0,0 +1,947 @@
+'''
+    Batched emulation of many MSC-48 keyboard instances using NumPy.
+
+    Intended for parameter sweeps running thousands of copies of the same
+    ROM that only differ in their inputs (ADB timing, key timing etc.).
+
+    The state of all instances (lanes) is kept in NumPy arrays.
+    In each step, every lane executes exactly one instruction: lanes are
+    grouped by their program counter and each group executes its opcode
+    in vectorized form. Lanes get regrouped in each step as they diverge.
+    The host side of the ADB bus is simulated for all lanes in the same
+    way after each step with its timing parameters being per-lane arrays.
+
+    The semantics mirror MSC48_CPU.exec_single() and ADBSim.adb_transact()
+    exactly so that each lane evolves like a scalar CPU + ADBSim pair
+    without peripherals: BUS instructions behave like the default BUS
+    handlers of MSC48_CPU, MOVX reads the floating bus and the 8243
+    expander instructions (MOVD, ORLD, ANLD) act on unconnected ports.
+    Devices attached with set_port_handlers()/set_ext_mem() aren't
+    modelled.
+
+    Requires NumPy.
+
+    Usage:
+    python3 batch8048.py --rom_path=[ROM] --lanes=1000 --jitter=3
+'''
+
+import numpy as np
+
+from emu8048 import STATE_REGS
+import ADB
+from ADB import (ADB_STATE_IDLE, ADB_STATE_START, ADB_STATE_ATT,
+                 ADB_STATE_SYNC, ADB_STATE_SEND_CMD, ADB_STATE_STOP,
+                 ADB_STATE_TLT, ADB_STATE_DATA, ADB_STATE_LISTEN)
+
+# ADB timing parameters that can be set per lane, see BatchADB.set_timing()
+TIMING_PARAMS = ('ATT_CYCLES', 'SYNC_CYCLES', 'BIT_CELL', 'BIT1_LOW',
+                 'BIT0_LOW', 'STOP_LOW', 'TLT_CYCLES', 'TALK_TIMEOUT',
+                 'MIN_CELL', 'MAX_CELL')
+
+MAX_LISTEN_BYTES = 8
+MAX_TALK_BYTES = 2 # ADBSim stops receiving after two bytes
+
+class BatchCPU:
+    def __init__(self, num_lanes, rom_data, ram_size=128):
+        self.num_lanes = num_lanes
+        self.rom_data = bytearray(rom_data)
+        self.rom_size = len(rom_data)
+        # padded copy for vectorized table lookups
+        self.rom_arr = np.zeros(max(0x400, self.rom_size + 0x100), np.int64)
+        self.rom_arr[:self.rom_size] = np.frombuffer(self.rom_data, np.uint8)
+        self.ram = np.zeros((num_lanes, ram_size), np.uint8)
+        for name in STATE_REGS:
+            setattr(self, name, np.zeros(num_lanes, np.int64))
+        self.post_step_cb = None
+        self.unknown_ops = set() # (opcode, addr) of unimplemented/unsupported ops
+        self.dispatch = [self._decode(op) for op in range(256)]
+        self.jump_tab = [0] * (self.rom_size + 1) # JMP/CALL dest. in bank 0
+        self._update_jump_table(0, self.rom_size)
+        self.reset()
+
+    def reset(self):
+        ''' Reset all lanes like MSC48_CPU.reset() + init_io() '''
+        for name in STATE_REGS:
+            getattr(self, name)[:] = 0
+        self.psw[:] = 8
+        self.bus[:] = 0xFF
+        self.irq[:] = 1
+        self.p2[:] = 0xFF
+        self.t0[:] = 1
+        self.t1[:] = 1
+        self.ram[:] = 0
+
+    def set_post_step_cb(self, cb):
+        ''' Set callback invoked after each step with the array of lanes
+            that have executed an instruction.
+        '''
+        self.post_step_cb = cb
+
+    def load_state(self, state, lanes=None):
+        ''' Initialize lanes from a state saved by MSC48_CPU.save_state() '''
+        if lanes is None:
+            lanes = slice(None)
+        regs, ram = state
+        for name, val in zip(STATE_REGS, regs):
+            getattr(self, name)[lanes] = val
+        self.ram[lanes] = np.frombuffer(ram, np.uint8)
+
+    def lane_state(self, lane):
+        ''' Return state of a lane in the format of MSC48_CPU.save_state() '''
+        return (tuple(int(getattr(self, name)[lane]) for name in STATE_REGS),
+                self.ram[lane].tobytes())
+
+    def patch_rom(self, addr, data):
+        ''' Overwrite ROM at addr with data in all lanes '''
+        end = addr + len(data)
+        if addr < 0 or end > self.rom_size:
+            raise ValueError("Patch 0x%03X...0x%03X outside of ROM" % (addr,
+                             end - 1))
+        self.rom_data[addr:end] = data
+        self.rom_arr[addr:end] = np.frombuffer(bytes(data), np.uint8)
+        self._update_jump_table(addr, end)
+
+    def _update_jump_table(self, start, end):
+        ''' Same as MSC48_CPU._update_jump_tables(), bank 1 destinations
+            are derived by setting A11.
+        '''
+        rom = self.rom_data
+        for addr in range(max(start - 1, 0), min(end, self.rom_size - 1)):
+            self.jump_tab[addr + 1] = ((rom[addr] & 0xE0) << 3) | rom[addr + 1]
+
+    def step(self, lanes):
+        ''' Execute one instruction in each of the given lanes '''
+        pcs = self.pc[lanes]
+        order = np.argsort(pcs, kind='stable')
+        lanes = lanes[order]
+        pcs = pcs[order]
+        bounds = np.flatnonzero(pcs[1:] != pcs[:-1]) + 1
+        starts = [0] + bounds.tolist()
+        ends = bounds.tolist() + [len(lanes)]
+        rom = self.rom_data
+        for start, end, pc in zip(starts, ends, pcs[starts].tolist()):
+            opcode = rom[pc]
+            self.dispatch[opcode](lanes[start:end], pc, opcode)
+        if self.post_step_cb:
+            self.post_step_cb(lanes)
+
+    def run(self, num_cycles):
+        ''' Run each lane until at least num_cycles machine cycles
+            have elapsed. Returns the number of instructions executed
+            summed over all lanes.
+        '''
+        end_cycles = self.cycles + num_cycles
+        count = 0
+        while True:
+            lanes = np.flatnonzero(self.cycles < end_cycles)
+            if not len(lanes):
+                return count
+            self.step(lanes)
+            count += len(lanes)
+
+    # ----- helpers -----
+    def _fetch(self, pc):
+        return self.rom_data[pc % self.rom_size]
+
+    def _reg_addr(self, idx, reg_num):
+        return self.rb[idx] * 24 + reg_num
+
+    def _ind_addr(self, idx, reg_num):
+        return self.ram[idx, self._reg_addr(idx, reg_num)].astype(np.int64)
+
+    def _write_port(self, idx, port, vals):
+        if port == 0:
+            self.bus[idx] = vals
+        elif port == 1:
+            self.p1[idx] = vals
+        elif port == 2:
+            self.p2[idx] = vals
+
+    def _cond_jump(self, idx, npc, cond):
+        taken = (npc & ~0xFF) | self._fetch(npc)
+        fall = npc & ~0xFF | ((npc + 1) & 0xFF)
+        self.pc[idx] = np.where(cond != 0, taken, fall)
+
+    def _set_carry(self, idx, tmp):
+        self.acc[idx] = tmp & 0xFF
+        self.psw[idx] = np.where(tmp > 0xFF, self.psw[idx] | 0x80,
+                                 self.psw[idx] & 0x7F)
+
+    # ----- instruction decoder, mirrors the if-chain of exec_single() -----
+    def _decode(self, op):
+        if op == 0x0:
+            return self._op_nop
+        elif op == 0xC5:
+            return self._op_sel_rb0
+        elif op == 0xD5:
+            return self._op_sel_rb1
+        elif op == 0xE5:
+            return self._op_sel_mb0
+        elif op == 0xF5:
+            return self._op_sel_mb1
+        elif (op & 0x1F) == 4:
+            return self._op_jmp
+        elif (op & 0x1F) == 0x12:
+            return self._op_jb
+        elif (op & 0xFC) == 0x88:
+            return self._op_orl_port
+        elif (op & 0xFC) == 0x98:
+            return self._op_anl_port
+        elif op == 0x15:
+            return self._op_dis_i
+        elif op == 0x25:
+            return self._op_en_tcnti
+        elif op == 0x35:
+            return self._op_dis_tcnti
+        elif op in (0x45, 0x65):
+            return self._op_nop # STRT CNT, STOP TCNT
+        elif op == 0x85:
+            return self._op_clr_f0
+        elif op == 0xA5:
+            return self._op_clr_f1
+        elif (op & 0x1F) == 0x14:
+            return self._op_call
+        elif op == 0x83:
+            return self._op_ret
+        elif op == 0x93:
+            return self._op_retr
+        elif op == 0x23:
+            return self._op_mov_a_imm
+        elif (op & 0xFC) == 0x38:
+            return self._op_outl
+        elif op == 0x02:
+            return self._op_outl_bus
+        elif op == 0x27:
+            return self._op_clr_a
+        elif op == 0x97:
+            return self._op_clr_c
+        elif op == 0xD7:
+            return self._op_mov_psw_a
+        elif op == 0x42:
+            return self._op_mov_a_t
+        elif op == 0x62:
+            return self._op_mov_t_a
+        elif (op & 0xF8) == 0xB8:
+            return self._op_mov_r_imm
+        elif (op & 0xFE) == 0x10:
+            return self._op_inc_ind
+        elif (op & 0xFE) == 0x20:
+            return self._op_xch_ind
+        elif (op & 0xFE) == 0x40:
+            return self._op_orl_ind
+        elif (op & 0xFE) == 0x60:
+            return self._op_add_ind
+        elif (op & 0xFE) == 0xD0:
+            return self._op_xrl_ind
+        elif (op & 0xFE) == 0x90:
+            return self._op_movx
+        elif (op & 0xFE) == 0x80:
+            return self._op_movx_a
+        elif (op & 0xFE) == 0xA0:
+            return self._op_mov_ind_a
+        elif (op & 0xFE) == 0xF0:
+            return self._op_mov_a_ind
+        elif (op & 0xFE) == 0xB0:
+            return self._op_mov_ind_imm
+        elif (op & 0xF8) == 0xE8:
+            return self._op_djnz
+        elif op in (0x26, 0x36, 0x46, 0x56, 0x76, 0x86, 0x96, 0xB6, 0xC6,
+                    0xE6, 0xF6):
+            return self._op_jcc
+        elif op == 0xB3:
+            return self._op_jmpp
+        elif (op & 0xF8) == 0xF8:
+            return self._op_mov_a_r
+        elif (op & 0xF8) == 0xA8:
+            return self._op_mov_r_a
+        elif (op & 0xF8) == 0x58:
+            return self._op_anl_r
+        elif (op & 0xF8) == 0x68:
+            return self._op_add_r
+        elif op in (0x03, 0x43, 0x53, 0xD3):
+            return self._op_alu_imm
+        elif op in (0x07, 0x17, 0x37, 0x47, 0x77, 0xE7, 0x67, 0xF7):
+            return self._op_alu_a
+        elif op in (0x95, 0xB5, 0xA7):
+            return self._op_cpl_flag
+        elif (op & 0xF8) in (0x18, 0xC8):
+            return self._op_inc_dec_r
+        elif (op & 0xF8) == 0x28:
+            return self._op_xch_r
+        elif (op & 0xF8) in (0xD8, 0x48):
+            return self._op_logic_r
+        elif (op & 0xFC) == 0x8:
+            return self._op_in
+        elif (op & 0xFC) in (0x0C, 0x3C, 0x8C, 0x9C):
+            return self._op_expander
+        elif op == 0xE3:
+            return self._op_movp3
+        return self._op_unknown
+
+    # ----- instruction handlers: (lanes, PC, opcode) -----
+    def _op_nop(self, idx, pc, op):
+        self.pc[idx] = pc + 1
+        self.cycles[idx] += 1
+
+    def _op_unknown(self, idx, pc, op):
+        if (op, pc) not in self.unknown_ops:
+            self.unknown_ops.add((op, pc))
+            print("Unknown opcode 0x%01X at 0x%03X" % (op, pc))
+        self._op_nop(idx, pc, op)
+
+    def _op_sel_rb0(self, idx, pc, op):
+        self.rb[idx] = 0
+        self.psw[idx] &= ~0x10
+        self._op_nop(idx, pc, op)
+
+    def _op_sel_rb1(self, idx, pc, op):
+        self.rb[idx] = 1
+        self.psw[idx] |= 0x10
+        self._op_nop(idx, pc, op)
+
+    def _op_sel_mb0(self, idx, pc, op):
+        self.mb[idx] = 0
+        self._op_nop(idx, pc, op)
+
+    def _op_sel_mb1(self, idx, pc, op):
+        self.mb[idx] = 1
+        self._op_nop(idx, pc, op)
+
+    def _op_dis_i(self, idx, pc, op):
+        self.eie[idx] = 0
+        self._op_nop(idx, pc, op)
+
+    def _op_en_tcnti(self, idx, pc, op):
+        self.tie[idx] = 1
+        self._op_nop(idx, pc, op)
+
+    def _op_dis_tcnti(self, idx, pc, op):
+        self.tie[idx] = 0
+        self._op_nop(idx, pc, op)
+
+    def _op_clr_f0(self, idx, pc, op):
+        self.f0[idx] = 0
+        self._op_nop(idx, pc, op)
+
+    def _op_clr_f1(self, idx, pc, op):
+        self.f1[idx] = 0
+        self._op_nop(idx, pc, op)
+
+    def _bank_bit(self, idx):
+        ''' A11 of JMP/CALL destinations: MB, 0 in interrupt routines '''
+        return (self.mb[idx] & (self.in_isr[idx] ^ 1)) << 11
+
+    def _op_jmp(self, idx, pc, op):
+        self.pc[idx] = self.jump_tab[pc + 1] | self._bank_bit(idx)
+        self.cycles[idx] += 2
+
+    def _op_jb(self, idx, pc, op):
+        self.cycles[idx] += 2
+        self._cond_jump(idx, pc + 1, self.acc[idx] & (1 << ((op >> 5) & 7)))
+
+    def _port_latch(self, idx, port):
+        if port == 0:
+            return self.bus[idx]
+        elif port == 1:
+            return self.p1[idx]
+        elif port == 2:
+            return self.p2[idx]
+        return None
+
+    def _op_orl_port(self, idx, pc, op):
+        port = op & 3
+        latch = self._port_latch(idx, port)
+        if latch is not None:
+            self._write_port(idx, port, latch | self._fetch(pc + 1))
+        self.pc[idx] = pc + 2
+        self.cycles[idx] += 2
+
+    def _op_anl_port(self, idx, pc, op):
+        port = op & 3
+        latch = self._port_latch(idx, port)
+        if latch is not None:
+            self._write_port(idx, port, latch & self._fetch(pc + 1))
+        self.pc[idx] = pc + 2
+        self.cycles[idx] += 2
+
+    def _op_call(self, idx, pc, op):
+        self.cycles[idx] += 2
+        addr = self.jump_tab[pc + 1] | self._bank_bit(idx)
+        npc = pc + 2
+        invalid = addr >= self.rom_size
+        if invalid.any():
+            print("Invalid destination addr 0x%03X!" % addr[invalid][0])
+            self.pc[idx[invalid]] = npc
+            idx = idx[~invalid]
+            addr = addr[~invalid]
+        psw = self.psw[idx]
+        ret = (npc & 0xFFF) | ((psw & 0xF0) << 8)
+        slot = (psw & 7) * 2 + 8
+        self.ram[idx, slot] = (ret >> 8) & 0xFF
+        self.ram[idx, slot + 1] = ret & 0xFF
+        self.psw[idx] = (psw & 0xF8) | ((psw + 1) & 7)
+        self.pc[idx] = addr
+
+    def _pop(self, idx):
+        stack_pos = (self.psw[idx] - 1) & 7
+        ret = ((self.ram[idx, stack_pos * 2 + 8].astype(np.int64) << 8) |
+               self.ram[idx, stack_pos * 2 + 9])
+        return stack_pos, ret
+
+    def _op_ret(self, idx, pc, op):
+        stack_pos, ret = self._pop(idx)
+        self.psw[idx] = (self.psw[idx] & 0xF8) | stack_pos
+        self.pc[idx] = ret & 0xFFF
+        self.cycles[idx] += 2
+
+    def _op_retr(self, idx, pc, op):
+        stack_pos, ret = self._pop(idx)
+        self.psw[idx] = (self.psw[idx] & 8) | ((ret >> 8) & 0xF0) | stack_pos
+        self.rb[idx] = (self.psw[idx] >> 4) & 1
+        self.pc[idx] = ret & 0xFFF
+        self.in_isr[idx] = 0
+        self.cycles[idx] += 2
+
+    def _op_mov_a_imm(self, idx, pc, op):
+        self.acc[idx] = self._fetch(pc + 1)
+        self.pc[idx] = pc + 2
+        self.cycles[idx] += 2
+
+    def _op_outl(self, idx, pc, op):
+        self._write_port(idx, op & 3, self.acc[idx])
+        self.pc[idx] = pc + 1
+        self.cycles[idx] += 2
+
+    def _op_outl_bus(self, idx, pc, op):
+        self.bus[idx] = self.acc[idx]
+        self.pc[idx] = pc + 1
+        self.cycles[idx] += 2
+
+    def _op_clr_a(self, idx, pc, op):
+        self.acc[idx] = 0
+        self._op_nop(idx, pc, op)
+
+    def _op_clr_c(self, idx, pc, op):
+        self.psw[idx] &= 0x7F
+        self._op_nop(idx, pc, op)
+
+    def _op_mov_psw_a(self, idx, pc, op):
+        self.psw[idx] = self.acc[idx]
+        self.rb[idx] = (self.acc[idx] >> 4) & 1
+        self._op_nop(idx, pc, op)
+
+    def _op_mov_a_t(self, idx, pc, op):
+        self.acc[idx] = self.tc[idx]
+        self._op_nop(idx, pc, op)
+
+    def _op_mov_t_a(self, idx, pc, op):
+        self.tc[idx] = self.acc[idx]
+        self._op_nop(idx, pc, op)
+
+    def _op_mov_r_imm(self, idx, pc, op):
+        self.ram[idx, self._reg_addr(idx, op & 7)] = self._fetch(pc + 1)
+        self.pc[idx] = pc + 2
+        self.cycles[idx] += 2
+
+    def _op_inc_ind(self, idx, pc, op):
+        addr = self._ind_addr(idx, op & 1)
+        self.ram[idx, addr] += 1
+        self._op_nop(idx, pc, op)
+
+    def _op_xch_ind(self, idx, pc, op):
+        addr = self._ind_addr(idx, op & 1)
+        tmp = self.ram[idx, addr].astype(np.int64)
+        self.ram[idx, addr] = self.acc[idx]
+        self.acc[idx] = tmp
+        self._op_nop(idx, pc, op)
+
+    def _op_orl_ind(self, idx, pc, op):
+        self.acc[idx] |= self.ram[idx, self._ind_addr(idx, op & 1)]
+        self._op_nop(idx, pc, op)
+
+    def _op_add_ind(self, idx, pc, op):
+        tmp = self.acc[idx] + self.ram[idx, self._ind_addr(idx, op & 1)]
+        self._set_carry(idx, tmp)
+        self._op_nop(idx, pc, op)
+
+    def _op_xrl_ind(self, idx, pc, op):
+        self.acc[idx] ^= self.ram[idx, self._ind_addr(idx, op & 1)]
+        self._op_nop(idx, pc, op)
+
+    def _op_movx(self, idx, pc, op):
+        self.pc[idx] = pc + 1
+        self.cycles[idx] += 2
+
+    def _op_movx_a(self, idx, pc, op):
+        self.acc[idx] = self.bus[idx] # no external memory
+        self.pc[idx] = pc + 1
+        self.cycles[idx] += 2
+
+    def _op_mov_ind_a(self, idx, pc, op):
+        self.ram[idx, self._ind_addr(idx, op & 1)] = self.acc[idx]
+        self._op_nop(idx, pc, op)
+
+    def _op_mov_a_ind(self, idx, pc, op):
+        self.acc[idx] = self.ram[idx, self._ind_addr(idx, op & 1)]
+        self._op_nop(idx, pc, op)
+
+    def _op_mov_ind_imm(self, idx, pc, op):
+        self.ram[idx, self._ind_addr(idx, op & 1)] = self._fetch(pc + 1)
+        self.pc[idx] = pc + 2
+        self.cycles[idx] += 2
+
+    def _op_djnz(self, idx, pc, op):
+        addr = self._reg_addr(idx, op & 7)
+        val = (self.ram[idx, addr].astype(np.int64) - 1) & 0xFF
+        self.ram[idx, addr] = val
+        npc = pc + 1
+        self.pc[idx] = np.where(val != 0, (npc & ~0xFF) | self._fetch(npc),
+                                npc + 1)
+        self.cycles[idx] += 2
+
+    def _op_jcc(self, idx, pc, op):
+        if op == 0x26: # JNT0
+            cond = self.t0[idx] ^ 1
+        elif op == 0x36: # JT0
+            cond = self.t0[idx]
+        elif op == 0x46: # JNT1
+            cond = self.t1[idx] ^ 1
+        elif op == 0x56: # JT1
+            cond = self.t1[idx]
+        elif op == 0x76: # JF1
+            cond = self.f1[idx]
+        elif op == 0x86: # JNI
+            cond = self.irq[idx] ^ 1
+        elif op == 0x96: # JNZ
+            cond = self.acc[idx]
+        elif op == 0xB6: # JF0
+            cond = self.f0[idx]
+        elif op == 0xC6: # JZ
+            cond = self.acc[idx] == 0
+        elif op == 0xE6: # JNC
+            cond = (self.psw[idx] & 0x80) ^ 0x80
+        else: # JC
+            cond = self.psw[idx] & 0x80
+        self.cycles[idx] += 2
+        self._cond_jump(idx, pc + 1, cond)
+
+    def _op_jmpp(self, idx, pc, op):
+        cur_page = (pc + 1) & 0xF00
+        self.pc[idx] = cur_page | self.rom_arr[cur_page | (self.acc[idx] & 0xFF)]
+        self.cycles[idx] += 2
+
+    def _op_mov_a_r(self, idx, pc, op):
+        self.acc[idx] = self.ram[idx, self._reg_addr(idx, op & 7)]
+        self._op_nop(idx, pc, op)
+
+    def _op_mov_r_a(self, idx, pc, op):
+        self.ram[idx, self._reg_addr(idx, op & 7)] = self.acc[idx] & 0xFF
+        self._op_nop(idx, pc, op)
+
+    def _op_anl_r(self, idx, pc, op):
+        self.acc[idx] &= self.ram[idx, self._reg_addr(idx, op & 7)]
+        self._op_nop(idx, pc, op)
+
+    def _op_add_r(self, idx, pc, op):
+        tmp = self.acc[idx] + self.ram[idx, self._reg_addr(idx, op & 7)]
+        self._set_carry(idx, tmp)
+        self._op_nop(idx, pc, op)
+
+    def _op_alu_imm(self, idx, pc, op):
+        imm = self._fetch(pc + 1)
+        if op == 0x03: # ADD A,imm
+            self._set_carry(idx, self.acc[idx] + imm)
+        elif op == 0x43: # ORL A,imm
+            self.acc[idx] |= imm
+        elif op == 0x53: # ANL A,imm
+            self.acc[idx] &= imm
+        else: # XRL A,imm
+            self.acc[idx] ^= imm
+        self.pc[idx] = pc + 2
+        self.cycles[idx] += 2
+
+    def _op_alu_a(self, idx, pc, op):
+        acc = self.acc[idx]
+        if op == 0x07: # DEC A
+            self.acc[idx] = (acc - 1) & 0xFF
+        elif op == 0x17: # INC A
+            self.acc[idx] = (acc + 1) & 0xFF
+        elif op == 0x37: # CPL A
+            self.acc[idx] = ~acc & 0xFF
+        elif op == 0x47: # SWAP A
+            self.acc[idx] = ((acc & 0xF) << 4) | ((acc & 0xF0) >> 4)
+        elif op == 0x77: # RR A
+            self.acc[idx] = ((acc >> 1) & 0x7F) | ((acc & 1) << 7)
+        elif op == 0xE7: # RL A
+            self.acc[idx] = ((acc << 1) & 0xFE) | ((acc >> 7) & 1)
+        elif op == 0x67: # RRC A
+            psw = self.psw[idx]
+            self.psw[idx] = (((acc & 1) << 7) | (psw & 0x7F)) & 0xFF
+            self.acc[idx] = ((acc >> 1) & 0xFF) | (psw & 0x80)
+        else: # RLC A
+            psw = self.psw[idx]
+            self.psw[idx] = ((acc & 0x80) | (psw & 0x7F)) & 0xFF
+            self.acc[idx] = ((acc << 1) & 0xFE) | ((psw >> 7) & 1)
+        self._op_nop(idx, pc, op)
+
+    def _op_cpl_flag(self, idx, pc, op):
+        if op == 0x95:
+            self.f0[idx] ^= 1
+        elif op == 0xB5:
+            self.f1[idx] ^= 1
+        else: # CPL C
+            self.psw[idx] = (self.psw[idx] ^ 0x80) & 0xFF
+        self._op_nop(idx, pc, op)
+
+    def _op_inc_dec_r(self, idx, pc, op):
+        addr = self._reg_addr(idx, op & 7)
+        delta = 1 if (op & 0xF8) == 0x18 else -1
+        self.ram[idx, addr] = (self.ram[idx, addr].astype(np.int64) +
+                               delta) & 0xFF
+        self._op_nop(idx, pc, op)
+
+    def _op_xch_r(self, idx, pc, op):
+        addr = self._reg_addr(idx, op & 7)
+        tmp = self.ram[idx, addr].astype(np.int64)
+        self.ram[idx, addr] = self.acc[idx] & 0xFF
+        self.acc[idx] = tmp
+        self._op_nop(idx, pc, op)
+
+    def _op_logic_r(self, idx, pc, op):
+        val = self.ram[idx, self._reg_addr(idx, op & 7)]
+        if (op & 0xF8) == 0xD8: # XRL A,reg
+            self.acc[idx] = (self.acc[idx] ^ val) & 0xFF
+        else: # ORL A,reg
+            self.acc[idx] = (self.acc[idx] | val) & 0xFF
+        self._op_nop(idx, pc, op)
+
+    def _op_in(self, idx, pc, op):
+        port = op & 3
+        if port == 0: # INS A,BUS
+            self.acc[idx] = self.bus[idx]
+        elif port == 1:
+            self.acc[idx] = self.p1[idx]
+        elif port == 2:
+            self.acc[idx] = self.p2[idx]
+        self.pc[idx] = pc + 1
+        self.cycles[idx] += 2
+
+    def _op_expander(self, idx, pc, op):
+        if (op, pc) not in self.unknown_ops:
+            self.unknown_ops.add((op, pc))
+            print("Unsupported port %d at 0x%03X" % ((op & 3) + 4, pc))
+        if (op & 0xFC) == 0x0C: # MOVD A,port reads the floating port
+            self.acc[idx] = 0xF
+        self.pc[idx] = pc + 1
+        self.cycles[idx] += 2
+
+    def _op_movp3(self, idx, pc, op):
+        self.acc[idx] = self.rom_arr[0x300 | (self.acc[idx] & 0xFF)]
+        self.pc[idx] = pc + 1
+        self.cycles[idx] += 2
+
+class BatchADB:
+    ''' Host side of the ADB bus for all lanes of a BatchCPU.
+        Mirrors ADBSim.adb_transact() with per-lane timing parameters.
+    '''
+    def __init__(self, cpu_obj, in_port=1, in_mask=0x80):
+        n = cpu_obj.num_lanes
+        self.cpu_obj = cpu_obj
+        self.in_port = in_port # port the device's ADB output is wired to
+        self.in_mask = in_mask
+        for name in ('state', 'next_state', 'cyc_cnt', 'cmd', 'bit',
+                     'low_time', 'high_time', 'phase', 'byte', 'bit_pos',
+                     'srq', 'timeout', 'data_len', 'listen_len',
+                     'listen_bits_len', 'num_xacts'):
+            setattr(self, name, np.zeros(n, np.int64))
+        self.data = np.zeros((n, MAX_TALK_BYTES), np.uint8)
+        self.listen_data = np.zeros((n, MAX_LISTEN_BYTES), np.uint8)
+        self.listen_bits = np.zeros((n, MAX_LISTEN_BYTES * 8 + 2), np.int64)
+        for param in TIMING_PARAMS:
+            setattr(self, param.lower(), np.full(n, getattr(ADB, 'ADB_' +
+                                                            param), np.int64))
+        cpu_obj.t1[:] = 1
+        cpu_obj.set_post_step_cb(self.adb_transact)
+
+    def set_timing(self, param, values):
+        ''' Set timing parameter (see TIMING_PARAMS) for all lanes.
+            values can be a scalar or an array with one value per lane.
+        '''
+        if param not in TIMING_PARAMS:
+            raise ValueError("Unknown ADB timing parameter %s" % param)
+        getattr(self, param.lower())[:] = values
+
+    def adb_send(self, adb_cmd, listen_data=None, lanes=None):
+        ''' Start a new ADB transaction in the given lanes (default: all) '''
+        if lanes is None:
+            lanes = slice(None)
+        listen_data = bytes(listen_data) if listen_data else bytes()
+        if len(listen_data) > MAX_LISTEN_BYTES:
+            raise ValueError("Too much Listen data")
+        self.cmd[lanes] = adb_cmd
+        self.data_len[lanes] = 0
+        self.listen_data[lanes] = 0
+        self.listen_data[lanes, :len(listen_data)] = np.frombuffer(listen_data,
+                                                                  np.uint8)
+        self.listen_len[lanes] = len(listen_data)
+        self.srq[lanes] = 0
+        self.timeout[lanes] = 0
+        self.state[lanes] = ADB_STATE_START
+
+    def idle_lanes(self):
+        return self.state == ADB_STATE_IDLE
+
+    def get_reply(self, lane):
+        return self.data[lane, :self.data_len[lane]].tobytes()
+
+    def lane_state(self, lane):
+        ''' Return state of a lane in the format of ADBSim.save_state() '''
+        return (int(self.state[lane]), int(self.next_state[lane]),
+                int(self.cyc_cnt[lane]), int(self.cmd[lane]),
+                int(self.bit[lane]), int(self.low_time[lane]),
+                int(self.high_time[lane]), int(self.phase[lane]),
+                int(self.byte[lane]), int(self.bit_pos[lane]),
+                bool(self.srq[lane]), bool(self.timeout[lane]),
+                self.get_reply(lane),
+                self.listen_data[lane, :self.listen_len[lane]].tobytes(),
+                tuple(self.listen_bits[lane, :self.listen_bits_len[lane]]
+                      .tolist()))
+
+    def _end_transaction(self, idx):
+        self.state[idx] = ADB_STATE_IDLE
+        self.num_xacts[idx] += 1
+
+    def _read_adb_in(self, idx):
+        port = self.cpu_obj.p1 if self.in_port == 1 else self.cpu_obj.p2
+        return (port[idx] & self.in_mask) != 0
+
+    def _drive_high(self, idx):
+        ''' Release the line in the given lanes (wired-AND with device).
+            Returns resulting line state.
+        '''
+        level = np.where(self._read_adb_in(idx), 0, 1)
+        self.cpu_obj.t1[idx] = level
+        return level
+
+    def _start_bit_rx(self, idx, next_state):
+        self.state[idx] = 9
+        self.next_state[idx] = next_state
+        self.low_time[idx] = 0
+        self.high_time[idx] = 0
+        self.phase[idx] = 0 # always start with the low phase
+
+    def adb_transact(self, lanes):
+        cpu = self.cpu_obj
+        states = self.state[lanes]
+        active = states != ADB_STATE_IDLE
+        if not active.any():
+            return
+        lanes = lanes[active]
+        states = states[active]
+        cycles = cpu.cycles[lanes]
+        # bucket lanes by the state they were in before this step
+        # so that each lane makes at most one transition
+        for state in np.unique(states).tolist():
+            sel = states == state
+            self._transact_state(state, lanes[sel], cycles[sel])
+
+    def _transact_state(self, state, idx, cycles):
+        cpu = self.cpu_obj
+        elapsed = cycles - self.cyc_cnt[idx]
+
+        if state == ADB_STATE_START:
+            self.cyc_cnt[idx] = cycles
+            cpu.t1[idx] = 0
+            self.state[idx] = ADB_STATE_ATT
+        elif state == ADB_STATE_ATT:
+            m = elapsed >= self.att_cycles[idx]
+            self.cyc_cnt[idx[m]] = cycles[m]
+            cpu.t1[idx[m]] = 1
+            self.state[idx[m]] = ADB_STATE_SYNC
+        elif state == ADB_STATE_SYNC:
+            m = elapsed >= self.sync_cycles[idx]
+            self.bit[idx[m]] = 7
+            self.cyc_cnt[idx[m]] = cycles[m]
+            cpu.t1[idx[m]] = 0
+            self.state[idx[m]] = ADB_STATE_SEND_CMD
+        elif state == ADB_STATE_SEND_CMD:
+            bit = self.bit[idx]
+            done = bit < 0
+            self._end_transaction(idx[done]) # command byte already completed
+            in_cell = ~done & (elapsed < self.bit_cell[idx])
+            val = (self.cmd[idx] >> np.maximum(bit, 0)) & 1
+            low_time = np.where(val != 0, self.bit1_low[idx],
+                                self.bit0_low[idx])
+            cpu.t1[idx[in_cell & (elapsed >= low_time)]] = 1
+            nxt = idx[~done & ~in_cell]
+            cpu.t1[nxt] = 0 # each bit cell starts low
+            self.bit[nxt] -= 1
+            self.state[nxt[self.bit[nxt] < 0]] = ADB_STATE_STOP
+            self.cyc_cnt[nxt] = cycles[~done & ~in_cell]
+        elif state == ADB_STATE_STOP:
+            m = elapsed >= self.stop_low[idx]
+            self._drive_high(idx[m])
+            self.cyc_cnt[idx[m]] = cycles[m]
+            self.state[idx[m]] = ADB_STATE_TLT
+        elif state == ADB_STATE_TLT:
+            low = self._drive_high(idx) == 0
+            # a device extends the stop bit by holding the line low
+            self.srq[idx[low]] = 1
+            self.cyc_cnt[idx[low]] = cycles[low]
+            m = ~low & (elapsed >= self.tlt_cycles[idx])
+            self.state[idx[m]] = ADB_STATE_DATA
+            self.cyc_cnt[idx[m]] = cycles[m]
+        elif state == ADB_STATE_DATA:
+            cmd = self.cmd[idx]
+            talk = (cmd & 0xC) == 0xC
+            self.state[idx[talk]] = 8
+            self.cyc_cnt[idx[talk]] = cycles[talk]
+            listen = (cmd & 0xC) == 0x8
+            li = idx[listen]
+            if len(li):
+                # start bit "1", data bits MSB first, stop bit "0"
+                bits = np.unpackbits(self.listen_data[li], axis=1)
+                num_bits = self.listen_len[li] * 8
+                self.listen_bits[li, 0] = 1
+                self.listen_bits[li, 1:bits.shape[1] + 1] = bits
+                self.listen_bits[li, num_bits + 1] = 0
+                self.listen_bits_len[li] = num_bits + 2
+                self.bit_pos[li] = 0
+                self.cyc_cnt[li] = cycles[listen]
+                cpu.t1[li] = 0 # each bit cell starts low
+                self.state[li] = ADB_STATE_LISTEN
+            # Flush completes, other commands aren't supported
+            self._end_transaction(idx[~talk & ~listen])
+        elif state == ADB_STATE_LISTEN:
+            in_cell = elapsed < self.bit_cell[idx]
+            val = self.listen_bits[idx, self.bit_pos[idx]]
+            low_time = np.where(val != 0, self.bit1_low[idx],
+                                self.bit0_low[idx])
+            cpu.t1[idx[in_cell & (elapsed >= low_time)]] = 1
+            nxt = idx[~in_cell]
+            self.bit_pos[nxt] += 1
+            self.cyc_cnt[nxt] = cycles[~in_cell]
+            more = self.bit_pos[nxt] < self.listen_bits_len[nxt]
+            cpu.t1[nxt[more]] = 0 # each bit cell starts low
+            self._end_transaction(nxt[~more])
+        elif state == 8: # wait for start bit
+            line = np.where(self._read_adb_in(idx), 0, 1)
+            cpu.t1[idx] = line
+            high = line != 0
+            m = high & (elapsed >= self.talk_timeout[idx])
+            self.timeout[idx[m]] = 1
+            self._end_transaction(idx[m])
+            start = idx[~high]
+            self._start_bit_rx(start, 10)
+            self.cyc_cnt[start] = cycles[~high]
+        elif state == 9: # receive one bit from device
+            line = np.where(self._read_adb_in(idx), 0, 1)
+            cpu.t1[idx] = line
+            phase = self.phase[idx]
+            low_time = self.low_time[idx]
+            next_state = self.next_state[idx]
+            max_cell = self.max_cell[idx]
+
+            # line low, high-to-low transition
+            m = (line == 0) & (phase != 0)
+            short = m & (elapsed < self.min_cell[idx])
+            self._end_transaction(idx[short])
+            m &= ~short
+            self.high_time[idx[m]] = elapsed[m] - low_time[m]
+            self.bit[idx[m]] = np.where(low_time[m] > self.bit1_low[idx[m]],
+                                        0, 1)
+            self.state[idx[m]] = next_state[m]
+            self.cyc_cnt[idx[m]] = cycles[m]
+
+            # line still low
+            m = (line == 0) & (phase == 0)
+            tmo = m & (elapsed > max_cell)
+            self._end_transaction(idx[tmo])
+            m &= ~tmo
+            self.low_time[idx[m]] = elapsed[m]
+
+            # line high
+            m = line != 0
+            rise = m & (phase == 0)
+            low_time = np.where(rise, elapsed, low_time)
+            self.low_time[idx[rise]] = elapsed[rise]
+            # the stop bit is decoded as soon as the line goes high again
+            stop = rise & (next_state == 12)
+            self.bit[idx[stop]] = np.where(low_time[stop] >
+                                           self.bit1_low[idx[stop]], 0, 1)
+            self.state[idx[stop]] = 12
+            self.phase[idx[m]] = 1
+            self.high_time[idx[m]] = elapsed[m] - low_time[m]
+            tmo = m & ~stop & (elapsed > max_cell)
+            self._end_transaction(idx[tmo])
+        elif state == 10: # check start bit
+            bad = self.bit[idx] == 0
+            self._end_transaction(idx[bad])
+            ok = idx[~bad]
+            self._start_bit_rx(ok, 11)
+            self.bit_pos[ok] = 0
+            self.byte[ok] = 0
+        elif state == 11: # receive data from device
+            self.byte[idx] = (self.byte[idx] << 1) | self.bit[idx]
+            more = self.bit_pos[idx] < 7
+            self.bit_pos[idx[more]] += 1
+            self._start_bit_rx(idx[more], 11)
+            full = idx[~more]
+            self.data[full, self.data_len[full]] = self.byte[full]
+            self.data_len[full] += 1
+            last = self.data_len[full] >= MAX_TALK_BYTES
+            next_byte = full[~last]
+            self._start_bit_rx(next_byte, 11)
+            self.bit_pos[next_byte] = 0
+            self.byte[next_byte] = 0
+            # go receive stop bit
+            self._start_bit_rx(full[last], 12)
+            self.cyc_cnt[full[last]] = cycles[~more][last]
+        elif state == 12: # stop bit received
+            self._end_transaction(idx)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from collections import Counter
+    import time
+
+    parser = ArgumentParser()
+    parser.add_argument('--rom_path', type=str, dest='rom_path',
+                        help='path to 8048/8049 ROM file',
+                        metavar='ROM_PATH', required=True)
+    parser.add_argument('--lanes', type=int, default=1000,
+                        help='number of keyboard instances')
+    parser.add_argument('--jitter', type=int, default=3,
+                        help='max. deviation of ADB bit cell timing in cycles')
+    parser.add_argument('--cmd', type=lambda s: int(s, 0), default=0x2E,
+                        help='ADB command to send to all lanes '
+                        '(default: Talk R2)')
+    parser.add_argument('--boot_cycles', type=int, default=100000,
+                        help='cycles to run before sending the command')
+
+    opts = parser.parse_args()
+
+    with open(opts.rom_path, 'rb') as rom_file:
+        rom_data = rom_file.read()
+
+    cpu = BatchCPU(opts.lanes, rom_data)
+    adb = BatchADB(cpu, in_port=1 if len(rom_data) >= 2048 else 2)
+
+    rng = np.random.default_rng(0)
+    jitter = rng.integers(-opts.jitter, opts.jitter + 1, opts.lanes)
+    adb.set_timing('BIT_CELL', ADB.ADB_BIT_CELL + jitter)
+    adb.set_timing('BIT1_LOW', ADB.ADB_BIT1_LOW + jitter // 2)
+    adb.set_timing('BIT0_LOW', ADB.ADB_BIT0_LOW + jitter // 2)
+
+    start = time.perf_counter()
+    num_instrs = cpu.run(opts.boot_cycles)
+    adb.adb_send(opts.cmd)
+    num_instrs += cpu.run(4000)
+    elapsed = time.perf_counter() - start
+
+    replies = Counter(adb.get_reply(lane) for lane in range(opts.lanes))
+    for reply, count in replies.most_common():
+        print("Reply %s: %d lanes" % (reply.hex() or "none", count))
+    print("Timeouts: %d lanes" % int(adb.timeout.sum()))
+    print("%d instructions in %f secs (%d instructions/sec)" % (num_instrs,
+          elapsed, num_instrs / elapsed))
@@ -0,0 +1,213 @@
+'''
+    Instruction-level code coverage for MSC-48 firmware.
+
+    Coverage is collected into two ROM-sized byte maps by the CPU core:
+     - exec map: 1 for each address an instruction was executed at,
+     - branch map: bit 0 - conditional jump taken, bit 1 - fell through.
+
+    Coverage files are just both maps stored back to back after a small
+    header so that merging results of parallel runs boils down to
+    a bytewise OR.
+
+    Usage:
+    python3 cov8048.py --rom_path=[ROM] --listing=[ASM] cov1.bin [cov2.bin...]
+'''
+
+import re
+import struct
+
+from dasm8048 import Dasm8048, is_cond_jump
+
+COV_MAGIC = b'AKCV'
+
+BRANCH_TAKEN     = 1
+BRANCH_NOT_TAKEN = 2
+
+class CodeCoverage:
+    def __init__(self, rom_size=2048):
+        self.rom_size = rom_size
+        self.exec_map = bytearray(rom_size)
+        self.branch_map = bytearray(rom_size)
+
+    def attach(self, cpu_obj):
+        ''' Start collecting coverage from the given CPU '''
+        cpu_obj.set_coverage_maps(self.exec_map, self.branch_map)
+
+    def detach(self, cpu_obj):
+        cpu_obj.set_coverage_maps(None, None)
+
+    def merge(self, other):
+        ''' Merge coverage from another CodeCoverage object '''
+        if other.rom_size != self.rom_size:
+            raise ValueError("Can't merge coverage of different ROM sizes")
+        # update in place as the maps may be attached to a CPU
+        self.exec_map[:] = _or_bytes(self.exec_map, other.exec_map)
+        self.branch_map[:] = _or_bytes(self.branch_map, other.branch_map)
+
+    def to_bytes(self):
+        return (COV_MAGIC + struct.pack('<I', self.rom_size) +
+                self.exec_map + self.branch_map)
+
+    def save(self, path):
+        with open(path, 'wb') as out_file:
+            out_file.write(self.to_bytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != COV_MAGIC:
+            raise ValueError("Not a coverage file")
+        if len(data) < 8:
+            raise ValueError("Truncated coverage file")
+        (rom_size,) = struct.unpack('<I', data[4:8])
+        if len(data) != 8 + rom_size * 2:
+            raise ValueError("Truncated coverage file")
+        cov = cls(rom_size)
+        cov.exec_map[:] = data[8:8 + rom_size]
+        cov.branch_map[:] = data[8 + rom_size:8 + rom_size * 2]
+        return cov
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as in_file:
+            return cls.from_bytes(in_file.read())
+
+    def num_executed(self):
+        return self.rom_size - self.exec_map.count(0)
+
+    def print_summary(self, rom_data):
+        ''' Print statistics about executed instructions and branches '''
+        num_instrs = 0
+        num_branches = 0
+        both_ways = 0
+        # walk instructions starting at executed addresses only because
+        # the ROM contains data tables that can't be told apart from code
+        for addr in range(self.rom_size):
+            if self.exec_map[addr]:
+                num_instrs += 1
+                if is_cond_jump(rom_data[addr]):
+                    num_branches += 1
+                    if self.branch_map[addr] == BRANCH_TAKEN | BRANCH_NOT_TAKEN:
+                        both_ways += 1
+        print("Executed instructions: %d" % num_instrs)
+        print("Conditional jumps: %d executed, %d went both ways" %
+              (num_branches, both_ways))
+
+    def annotate_listing(self, lines, rom_data):
+        ''' Generate listing lines annotated with coverage markers:
+            '+' - executed, '-' - never executed,
+            for conditional jumps: 'T' - taken, 'N' - fell through.
+        '''
+        for line, addr in zip(lines, map_listing(lines, rom_data)):
+            if addr is None:
+                mark = '     '
+            elif not self.exec_map[addr]:
+                mark = '-    '
+            elif is_cond_jump(rom_data[addr]):
+                outcome = self.branch_map[addr]
+                mark = '+ ' + ('T' if outcome & BRANCH_TAKEN else '-') + \
+                              ('N' if outcome & BRANCH_NOT_TAKEN else '-') + ' '
+            else:
+                mark = '+    '
+            yield mark + line
+
+def _or_bytes(a, b):
+    ''' Bytewise OR of two equally sized byte sequences '''
+    return bytearray((int.from_bytes(a, 'little') |
+                      int.from_bytes(b, 'little')).to_bytes(len(a), 'little'))
+
+def map_listing(lines, rom_data):
+    ''' Assign ROM addresses to the instruction lines of an annotated
+        listing. Returns a list containing the address of each line
+        or None for lines that don't produce code.
+
+        Addresses are taken from the line map of the assembled listing.
+        Listings the assembler can't handle are mapped heuristically.
+    '''
+    from asm8048 import Asm8048, AsmError # not needed for collecting
+
+    try:
+        result = Asm8048(len(rom_data)).assemble('\n'.join(lines))
+    except AsmError:
+        return _guess_listing_map(lines, rom_data)
+    addrs = [None] * len(lines)
+    for addr, line_num in result.line_map.items():
+        if not _is_data_line(lines[line_num - 1]):
+            addrs[line_num - 1] = addr
+    return addrs
+
+def _is_data_line(line):
+    text = line.split(';', 1)[0].strip()
+    return re.match(r'([A-Za-z_]\w*:)?\s*db\b', text, re.I) is not None
+
+def _guess_listing_map(lines, rom_data):
+    ''' map_listing() for listings not accepted by the assembler.
+        Instruction lengths are taken from the disassembly of the ROM.
+        Labels in the form LXXXX re-synchronize the address counter
+        because listings may omit uninteresting parts of the ROM.
+    '''
+    dasm = Dasm8048()
+    addr = 0
+    result = []
+    for line in lines:
+        text = line.split(';', 1)[0].strip()
+        label = re.match(r'([A-Za-z_]\w*):', text)
+        if label:
+            hint = re.fullmatch(r'L([0-9A-Fa-f]{4})', label.group(1))
+            if hint:
+                addr = int(hint.group(1), 16)
+            text = text[label.end():].strip()
+        if not text:
+            result.append(None)
+            continue
+        words = text.split(None, 2)
+        mnem = words[0].lower()
+        if mnem == 'end' or (len(words) > 1 and words[1].lower() == 'equ'):
+            result.append(None) # directives not emitting any bytes
+        elif mnem == 'org':
+            addr = int(words[1].rstrip('hH'), 16)
+            result.append(None)
+        elif mnem == 'db':
+            result.append(None) # data bytes aren't instructions
+            addr += 1
+        elif addr < len(rom_data):
+            result.append(addr)
+            s, length = dasm.dasm_single(addr, bytes([rom_data[addr],
+                rom_data[(addr + 1) % len(rom_data)]]))
+            addr += length
+        else:
+            result.append(None)
+    return result
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--rom_path', type=str, dest='rom_path',
+                        help='path to 8048/8049 ROM file',
+                        metavar='ROM_PATH', required=True)
+    parser.add_argument('--listing', type=str,
+                        help='annotated listing to print coverage against')
+    parser.add_argument('--out', type=str,
+                        help='save merged coverage to the specified file')
+    parser.add_argument('cov_files', nargs='+',
+                        help='coverage files to merge')
+
+    opts = parser.parse_args()
+
+    with open(opts.rom_path, 'rb') as rom_file:
+        rom_data = rom_file.read()
+
+    cov = CodeCoverage.load(opts.cov_files[0])
+    for path in opts.cov_files[1:]:
+        cov.merge(CodeCoverage.load(path))
+
+    if opts.out:
+        cov.save(opts.out)
+
+    if opts.listing:
+        with open(opts.listing, 'r') as asm_file:
+            lines = asm_file.read().splitlines()
+        for line in cov.annotate_listing(lines, rom_data):
+            print(line)
+
+    cov.print_summary(rom_data)
@@ -8,9 +8,124 @@
      - set_uppercase()
      - set_opcode_width()
 
+    Instruction encodings are described by OPCODE_TABLE that is shared
+    with the assembler (asm8048.py).
+
     Author: Max Poliakovski 2021
 '''
 
+# Operand placeholders used in OPCODE_TABLE
+IMM    = '{imm}'    # immediate byte, written as #value
+ADDR8  = '{addr8}'  # jump target within the current page
+ADDR11 = '{addr11}' # jump target encoded in opcode bits 5-7 + 2nd byte
+
+def _build_opcode_table():
+    ''' Build a list of (mnemonic, operands) tuples indexed by opcode.
+        Undefined opcodes are set to None.
+    '''
+    table = [None] * 256
+
+    def add(opcode, mnem, ops=''):
+        table[opcode] = (mnem, ops)
+
+    for n in range(8):
+        add(0x18 | n, 'inc', 'r%d' % n)
+        add(0x28 | n, 'xch', 'a,r%d' % n)
+        add(0x48 | n, 'orl', 'a,r%d' % n)
+        add(0x58 | n, 'anl', 'a,r%d' % n)
+        add(0x68 | n, 'add', 'a,r%d' % n)
+        add(0x78 | n, 'addc', 'a,r%d' % n)
+        add(0xA8 | n, 'mov', 'r%d,a' % n)
+        add(0xB8 | n, 'mov', 'r%d,' % n + IMM)
+        add(0xC8 | n, 'dec', 'r%d' % n)
+        add(0xD8 | n, 'xrl', 'a,r%d' % n)
+        add(0xE8 | n, 'djnz', 'r%d,' % n + ADDR8)
+        add(0xF8 | n, 'mov', 'a,r%d' % n)
+        add((n << 5) | 0x04, 'jmp', ADDR11)
+        add((n << 5) | 0x14, 'call', ADDR11)
+        add((n << 5) | 0x12, 'jb%d' % n, ADDR8)
+
+    for n in range(2):
+        add(0x10 | n, 'inc', '@r%d' % n)
+        add(0x20 | n, 'xch', 'a,@r%d' % n)
+        add(0x30 | n, 'xchd', 'a,@r%d' % n)
+        add(0x40 | n, 'orl', 'a,@r%d' % n)
+        add(0x50 | n, 'anl', 'a,@r%d' % n)
+        add(0x60 | n, 'add', 'a,@r%d' % n)
+        add(0x70 | n, 'addc', 'a,@r%d' % n)
+        add(0x80 | n, 'movx', 'a,@r%d' % n)
+        add(0x90 | n, 'movx', '@r%d,a' % n)
+        add(0xA0 | n, 'mov', '@r%d,a' % n)
+        add(0xB0 | n, 'mov', '@r%d,' % n + IMM)
+        add(0xD0 | n, 'xrl', 'a,@r%d' % n)
+        add(0xF0 | n, 'mov', 'a,@r%d' % n)
+
+    for n in range(4):
+        port = 'p%d' % (n + 4)
+        add(0x0C | n, 'movd', 'a,' + port)
+        add(0x3C | n, 'movd', port + ',a')
+        add(0x8C | n, 'orld', port + ',a')
+        add(0x9C | n, 'anld', port + ',a')
+
+    add(0x08, 'ins', 'a,bus')
+    for n in (1, 2):
+        port = 'p%d' % n
+        add(0x08 | n, 'in', 'a,' + port)
+        add(0x38 | n, 'outl', port + ',a')
+        add(0x88 | n, 'orl', port + ',' + IMM)
+        add(0x98 | n, 'anl', port + ',' + IMM)
+    add(0x88, 'orl', 'bus,' + IMM)
+    add(0x98, 'anl', 'bus,' + IMM)
+
+    for opcode, mnem in ((0x16, 'jtf'), (0x26, 'jnt0'), (0x36, 'jt0'),
+                         (0x46, 'jnt1'), (0x56, 'jt1'), (0x76, 'jf1'),
+                         (0x86, 'jni'), (0x96, 'jnz'), (0xB6, 'jf0'),
+                         (0xC6, 'jz'), (0xE6, 'jnc'), (0xF6, 'jc')):
+        add(opcode, mnem, ADDR8)
+
+    for opcode, mnem in ((0x03, 'add'), (0x13, 'addc'), (0x23, 'mov'),
+                         (0x43, 'orl'), (0x53, 'anl'), (0xD3, 'xrl')):
+        add(opcode, mnem, 'a,' + IMM)
+
+    for opcode, mnem, ops in (
+            (0x00, 'nop', ''),       (0x02, 'outl', 'bus,a'),
+            (0x05, 'en', 'i'),       (0x07, 'dec', 'a'),
+            (0x15, 'dis', 'i'),      (0x17, 'inc', 'a'),
+            (0x25, 'en', 'tcnti'),   (0x27, 'clr', 'a'),
+            (0x35, 'dis', 'tcnti'),  (0x37, 'cpl', 'a'),
+            (0x42, 'mov', 'a,t'),    (0x45, 'strt', 'cnt'),
+            (0x47, 'swap', 'a'),     (0x55, 'strt', 't'),
+            (0x57, 'da', 'a'),       (0x62, 'mov', 't,a'),
+            (0x65, 'stop', 'tcnt'),  (0x67, 'rrc', 'a'),
+            (0x75, 'ent0', 'clk'),   (0x77, 'rr', 'a'),
+            (0x83, 'ret', ''),       (0x85, 'clr', 'f0'),
+            (0x93, 'retr', ''),      (0x95, 'cpl', 'f0'),
+            (0x97, 'clr', 'c'),      (0xA3, 'movp', 'a,@a'),
+            (0xA5, 'clr', 'f1'),     (0xA7, 'cpl', 'c'),
+            (0xB3, 'jmpp', '@a'),    (0xB5, 'cpl', 'f1'),
+            (0xC5, 'sel', 'rb0'),    (0xC7, 'mov', 'a,psw'),
+            (0xD5, 'sel', 'rb1'),    (0xD7, 'mov', 'psw,a'),
+            (0xE3, 'movp3', 'a,@a'), (0xE5, 'sel', 'mb0'),
+            (0xE7, 'rl', 'a'),       (0xF5, 'sel', 'mb1'),
+            (0xF7, 'rlc', 'a')):
+        add(opcode, mnem, ops)
+
+    return table
+
+OPCODE_TABLE = _build_opcode_table()
+
+def instr_length(opcode):
+    ''' Return length in bytes of the instruction starting with opcode '''
+    entry = OPCODE_TABLE[opcode]
+    return 2 if entry and '{' in entry[1] else 1
+
+def is_cond_jump(opcode):
+    ''' Check if opcode is a conditional jump (JBb, DJNZ, Jcc) '''
+    if (opcode & 0x1F) == 0x12 or (opcode & 0xF8) == 0xE8: # JBb, DJNZ
+        return True
+    return opcode in (0x16, 0x26, 0x36, 0x46, 0x56, 0x76, 0x86, 0x96,
+                      0xB6, 0xC6, 0xE6, 0xF6)
+
 class Dasm8048:
     def __init__(self):
         self.uppercase = False
@@ -43,230 +158,19 @@ class Dasm8048:
            OUT: tuple(disassembly string, instruction length in bytes)
         '''
         opcode = bin[0]
+        entry = OPCODE_TABLE[opcode]
+        if entry is None:
+            return ("unknown", 1)
 
-        if opcode == 0x0:
-            return (self._fmt_instr("nop", ""), 1)
-        elif opcode == 0x2:
-            return (self._fmt_instr("outl", "bus,a"), 1)
-        elif opcode == 0x3:
-            return (self._fmt_instr("add", 'a,' + self._fmt_imm(bin[1])), 2)
-        elif (opcode & 0x1F) == 4:
-            dest = ((opcode & 0xE0) << 3) | bin[1]
-            return (self._fmt_instr("jmp", self._fmt_imm(dest)), 2)
-        elif opcode == 0x05:
-            return (self._fmt_instr("en", "i"), 1)
-        elif opcode == 0x7:
-            return (self._fmt_instr("dec", "a"), 1)
-        elif (opcode & 0xFC) == 0x8:
-            port = opcode & 3
-            if port == 0:
-                return (self._fmt_instr("ins", "a,bus"), 1)
-            elif port == 1:
-                return (self._fmt_instr("in", "a,p1"), 1)
-            elif port == 2:
-                return (self._fmt_instr("in", "a,p2"), 1)
-        elif (opcode & 0xFC) == 0x0C:
-            return (self._fmt_instr("movd", "a,p" + str((opcode & 3) + 4)), 1)
-        elif (opcode & 0xFE) == 0x10:
-            return (self._fmt_instr("inc", "@r" + str(opcode & 1)), 1)
-        elif (opcode & 0x1F) == 0x12:
-            bit_num = (opcode >> 5) & 7;
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jb" + str(bit_num), self._fmt_imm(dest)), 2)
-        elif opcode == 0x13:
-            return (self._fmt_instr("addc", "a," + self._fmt_imm(bin[1])), 2)
-        elif (opcode & 0x1F) == 0x14:
-            dest = ((opcode & 0xE0) << 3) | bin[1]
-            return (self._fmt_instr("call", self._fmt_imm(dest)), 2)
-        elif opcode == 0x15:
-            return (self._fmt_instr("dis", "i"), 1)
-        elif opcode == 0x16:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jtf", self._fmt_imm(dest)), 2)
-        elif opcode == 0x17:
-            return (self._fmt_instr("inc", "a"), 1)
-        elif (opcode & 0xF8) == 0x18:
-            return (self._fmt_instr("inc", "r" + str(opcode & 7)), 1)
-        elif (opcode & 0xFE) == 0x20:
-            return (self._fmt_instr("xch", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0x23:
-            return (self._fmt_instr("mov", "a," + self._fmt_imm(bin[1])), 2)
-        elif opcode == 0x25:
-            return (self._fmt_instr("en", "tcnti"), 1)
-        elif opcode == 0x26:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jnt0", self._fmt_imm(dest)), 2)
-        elif opcode == 0x27:
-            return (self._fmt_instr("clr", "a"), 1)
-        elif (opcode & 0xF8) == 0x28:
-            return (self._fmt_instr("xch", "a,r" + str(opcode & 7)), 1)
-        elif (opcode & 0xFE) == 0x30:
-            return (self._fmt_instr("xchd", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0x35:
-            return (self._fmt_instr("dis", "tcnti"), 1)
-        elif opcode == 0x36:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jt0", self._fmt_imm(dest)), 2)
-        elif opcode == 0x37:
-            return (self._fmt_instr("cpl", "a"), 1)
-        elif (opcode & 0xFC) == 0x38:
-            port_num = opcode & 3
-            if port_num == 1 or port_num == 2:
-                return (self._fmt_instr("outl", "p" + str(port_num) + ",a"), 1)
-        elif (opcode & 0xFC) == 0x3C:
-            return (self._fmt_instr("movd", "p" + str((opcode & 3) + 4) + ",a"), 1)
-        elif (opcode & 0xFE) == 0x40:
-            return (self._fmt_instr("orl", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0x42:
-            return (self._fmt_instr("mov", "a,t"), 1)
-        elif opcode == 0x43:
-            return (self._fmt_instr("orl", 'a,' + self._fmt_imm(bin[1])), 2)
-        elif opcode == 0x45:
-            return (self._fmt_instr("strt", "cnt"), 1)
-        elif opcode == 0x46:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jnt1", self._fmt_imm(dest)), 2)
-        elif opcode == 0x47:
-            return (self._fmt_instr("swap", "a"), 1)
-        elif (opcode & 0xF8) == 0x48:
-            return (self._fmt_instr("orl", "a,r" + str(opcode & 7)), 1)
-        elif (opcode & 0xFE) == 0x50:
-            return (self._fmt_instr("anl", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0x53:
-            return (self._fmt_instr("anl", 'a,' + self._fmt_imm(bin[1])), 2)
-        elif opcode == 0x55:
-            return (self._fmt_instr("strt", "t"), 1)
-        elif opcode == 0x56:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jt1", self._fmt_imm(dest)), 2)
-        elif opcode == 0x57:
-            return (self._fmt_instr("da", "a"), 1)
-        elif (opcode & 0xF8) == 0x58:
-            return (self._fmt_instr("anl", "a,r" + str(opcode & 7)), 1)
-        elif (opcode & 0xFE) == 0x60:
-            return (self._fmt_instr("add", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0x62:
-            return (self._fmt_instr("mov", "t,a"), 1)
-        elif opcode == 0x65:
-            return (self._fmt_instr("stop", "tcnt"), 1)
-        elif opcode == 0x67:
-            return (self._fmt_instr("rrc", "a"), 1)
-        elif (opcode & 0xF8) == 0x68:
-            return (self._fmt_instr("add", "a,r" + str(opcode & 7)), 1)
-        elif (opcode & 0xFE) == 0x70:
-            return (self._fmt_instr("addc", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0x75:
-            return (self._fmt_instr("ent0", "clk"), 1)
-        elif opcode == 0x76:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jf1", self._fmt_imm(dest)), 2)
-        elif opcode == 0x77:
-            return (self._fmt_instr("rr", "a"), 1)
-        elif (opcode & 0xF8) == 0x78:
-            return (self._fmt_instr("addc", "a,r" + str(opcode & 7)), 1)
-        elif (opcode & 0xFE) == 0x80:
-            return (self._fmt_instr("movx", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0x83:
-            return (self._fmt_instr("ret"), 1)
-        elif opcode == 0x85:
-            return (self._fmt_instr("clr", "f0"), 1)
-        elif opcode == 0x86:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jni", self._fmt_imm(dest)), 2)
-        elif (opcode & 0xFC) == 0x88:
-            port_num = opcode & 3
-            if port_num == 0:
-                return (self._fmt_instr("orl", "bus," + self._fmt_imm(bin[1])), 1)
-            elif port_num == 1 or port_num == 2:
-                return (self._fmt_instr("orl", "p" +
-                    str(port_num) + "," + self._fmt_imm(bin[1])), 2)
-        elif (opcode & 0xFC) == 0x8C:
-            return (self._fmt_instr("orld", "p" + str((opcode & 3) + 4) + ",a"), 1)
-        elif (opcode & 0xFE) == 0x90:
-            return (self._fmt_instr("movx", "@r" + str(opcode & 1) + ",a"), 1)
-        elif opcode == 0x93:
-            return (self._fmt_instr("retr"), 1)
-        elif opcode == 0x95:
-            return (self._fmt_instr("cpl", "f0"), 1)
-        elif opcode == 0x96:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jnz", self._fmt_imm(dest)), 2)
-        elif opcode == 0x97:
-            return (self._fmt_instr("clr", "c"), 1)
-        elif (opcode & 0xFC) == 0x98:
-            port_num = opcode & 3
-            if port_num == 0:
-                return (self._fmt_instr("anl", "bus," + self._fmt_imm(bin[1])), 1)
-            elif port_num == 1 or port_num == 2:
-                return (self._fmt_instr("anl", "p" +
-                    str(port_num) + "," + self._fmt_imm(bin[1])), 2)
-        elif (opcode & 0xFC) == 0x9C:
-            return (self._fmt_instr("anld", "p" + str((opcode & 3) + 4) + ",a"), 1)
-        elif (opcode & 0xFE) == 0xA0:
-            return (self._fmt_instr("mov", "@r" + str(opcode & 1) + ",a"), 1)
-        elif opcode == 0xA3:
-            return (self._fmt_instr("movp", "a,@a"), 1)
-        elif opcode == 0xA5:
-            return (self._fmt_instr("clr", "f1"), 1)
-        elif opcode == 0xA7:
-            return (self._fmt_instr("cpl", "c"), 1)
-        elif (opcode & 0xF8) == 0xA8:
-            return (self._fmt_instr("mov", "r" + str(opcode & 7) + ",a"), 1)
-        elif (opcode & 0xFE) == 0xB0:
-            return (self._fmt_instr("mov", "@r" + str(opcode & 1)
-                + "," + self._fmt_imm(bin[1])), 2)
-        elif opcode == 0xB3:
-            return (self._fmt_instr("jmpp", "@a"), 1)
-        elif opcode == 0xB5:
-            return (self._fmt_instr("cpl", "f1"), 1)
-        elif opcode == 0xB6:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jf0", self._fmt_imm(dest)), 2)
-        elif (opcode & 0xF8) == 0xB8:
-            return (self._fmt_instr("mov", "r" + str(opcode & 7)
-                + "," + self._fmt_imm(bin[1])), 2)
-        elif opcode == 0xC5:
-            return (self._fmt_instr("sel", "rb0"), 1)
-        elif opcode == 0xC6:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jz", self._fmt_imm(dest)), 2)
-        elif opcode == 0xC7:
-            return (self._fmt_instr("mov", "a,psw"), 1)
-        elif (opcode & 0xF8) == 0xC8:
-            return (self._fmt_instr("dec", "r" + str(opcode & 7)), 1)
-        elif (opcode & 0xFE) == 0xD0:
-            return (self._fmt_instr("xrl", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0xD3:
-            return (self._fmt_instr("xrl", 'a,' + self._fmt_imm(bin[1])), 2)
-        elif opcode == 0xD5:
-            return (self._fmt_instr("sel", "rb1"), 1)
-        elif opcode == 0xD7:
-            return (self._fmt_instr("mov", "psw,a"), 1)
-        elif (opcode & 0xF8) == 0xD8:
-            return (self._fmt_instr("xrl", "a,r" + str(opcode & 7)), 1)
-        elif opcode == 0xE3:
-            return (self._fmt_instr("movp3", "a,@a"), 1)
-        elif opcode == 0xE5:
-            return (self._fmt_instr("sel", "mb0"), 1)
-        elif opcode == 0xE6:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jnc", self._fmt_imm(dest)), 2)
-        elif opcode == 0xE7:
-            return (self._fmt_instr("rl", "a"), 1)
-        elif opcode == 0xF5:
-            return (self._fmt_instr("sel", "mb1"), 1)
-        elif opcode == 0xF7:
-            return (self._fmt_instr("rlc", "a"), 1)
-        elif (opcode & 0xF8) == 0xE8:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("djnz", "r" + str(opcode & 7) + ","
-                + self._fmt_imm(dest)), 2)
-        elif (opcode & 0xFE) == 0xF0:
-            return (self._fmt_instr("mov", "a,@r" + str(opcode & 1)), 1)
-        elif opcode == 0xF6:
-            dest = (pc & ~0xFF) | bin[1]
-            return (self._fmt_instr("jc", self._fmt_imm(dest)), 2)
-        elif (opcode & 0xF8) == 0xF8:
-            return (self._fmt_instr("mov", "a,r" + str(opcode & 7)), 1)
+        mnem, ops = entry
+        if '{' not in ops:
+            return (self._fmt_instr(mnem, ops), 1)
 
-        return ("unknown", 1)
+        if IMM in ops:
+            ops = ops.replace(IMM, self._fmt_imm(bin[1]))
+        elif ADDR8 in ops:
+            ops = ops.replace(ADDR8, self._fmt_imm((pc & ~0xFF) | bin[1]))
+        else:
+            dest = ((opcode & 0xE0) << 3) | bin[1]
+            ops = ops.replace(ADDR11, self._fmt_imm(dest))
+        return (self._fmt_instr(mnem, ops), 2)
@@ -4,6 +4,37 @@
     Author: Max Poliakovski 2020-2021
 '''
 
+from functools import partial
+
+# number of entries in the port dispatch tables
+NUM_PORTS = 8
+
+# CPU attributes making up the processor state besides internal RAM
+STATE_REGS = ('pc', 'psw', 'rb', 'mb', 'acc', 'f0', 'f1', 'tc', 'tf', 'eie',
+              'tie', 'irq', 't0', 't1', 'bus', 'p1', 'p2', 'cycles',
+              'in_isr')
+
+class TracingRAM(bytearray):
+    ''' Internal RAM replacement recording which instruction
+        accessed which location. Used for analyzing code behavior.
+    '''
+    def __init__(self, data):
+        super().__init__(data)
+        self.cur_pc = 0
+        self.reads = {} # address -> set of PCs reading it
+        self.writes = {} # address -> set of PCs writing it
+        self.inputs = set() # addresses read before being written
+
+    def __getitem__(self, idx):
+        self.reads.setdefault(idx, set()).add(self.cur_pc)
+        if idx not in self.writes:
+            self.inputs.add(idx)
+        return bytearray.__getitem__(self, idx)
+
+    def __setitem__(self, idx, val):
+        self.writes.setdefault(idx, set()).add(self.cur_pc)
+        bytearray.__setitem__(self, idx, val)
+
 class MSC48_CPU:
     def __init__(self, rom_size=2048, ram_size=128):
         self.rom_data = bytes()
@@ -11,18 +42,98 @@ class MSC48_CPU:
         self.ram_data = bytearray(ram_size)
         self.ram_size = ram_size
         self.post_instr_cb = None
+        self.verbose = True
+        self.cov_exec = None # coverage map of executed addresses
+        self.cov_branch = None # coverage map of conditional jump outcomes
+        self.event_sources = []
+        self.loop_detector = None
+        self.memo = None
+        self.history = None
+        self.journal = None
+        self.end_cycle = None # end of the slice being executed by exec_cycles
+        self.rom_listeners = []
+        self.jump_tabs = ([], []) # JMP/CALL destinations for each memory bank
+        self._init_ports()
         self.reset()
         self.init_io()
 
     def set_rom_data(self, rom_data, rom_size):
+        ''' A bytearray is used by reference so that its owner
+            sees changes made by patch_rom() and vice versa.
+        '''
+        if not isinstance(rom_data, bytearray):
+            rom_data = bytearray(rom_data)
         self.rom_data = rom_data
         self.rom_size = rom_size
+        self.jump_tabs = ([0] * (rom_size + 1), [0] * (rom_size + 1))
+        self._update_jump_tables(0, rom_size)
+
+    def _update_jump_tables(self, start, end):
+        ''' Precompute JMP/CALL destinations for ROM range start...end-1.
+            The tables are indexed by the address following the opcode.
+            Memory bank 1 destinations have A11 set.
+        '''
+        rom = self.rom_data
+        tab0, tab1 = self.jump_tabs
+        for addr in range(max(start - 1, 0), min(end, self.rom_size - 1)):
+            dest = ((rom[addr] & 0xE0) << 3) | rom[addr + 1]
+            tab0[addr + 1] = dest
+            tab1[addr + 1] = dest | 0x800
+
+    def add_rom_listener(self, cb):
+        ''' Register a callback invoked after ROM contents have changed.
+            cb(start, end) receives the range of changed addresses.
+        '''
+        self.rom_listeners.append(cb)
+
+    def remove_rom_listener(self, cb):
+        if cb in self.rom_listeners:
+            self.rom_listeners.remove(cb)
+
+    def patch_rom(self, addr, data):
+        ''' Overwrite ROM at addr with data keeping the CPU state.
+            Returns True if the ROM has been changed.
+        '''
+        end = addr + len(data)
+        if addr < 0 or end > self.rom_size:
+            raise ValueError("Patch 0x%03X...0x%03X outside of ROM" % (addr,
+                             end - 1))
+        if self.rom_data[addr:end] == data:
+            return False
+        self.rom_data[addr:end] = data
+        self._update_jump_tables(addr, end)
+        for cb in self.rom_listeners:
+            cb(addr, end)
+        return True
+
+    def reload_rom(self, rom_data):
+        ''' Replace ROM contents with rom_data of the same size
+            patching changed ranges only.
+            Returns the list of (start, end) ranges changed.
+        '''
+        if len(rom_data) != self.rom_size:
+            raise ValueError("ROM size mismatch: %d instead of %d bytes" %
+                             (len(rom_data), self.rom_size))
+        ranges = []
+        addr = 0
+        while addr < self.rom_size:
+            if self.rom_data[addr] == rom_data[addr]:
+                addr += 1
+                continue
+            start = addr
+            while addr < self.rom_size and self.rom_data[addr] != rom_data[addr]:
+                addr += 1
+            ranges.append((start, addr))
+        for start, end in ranges:
+            self.patch_rom(start, rom_data[start:end])
+        return ranges
 
     def reset(self):
         self.pc  = 0  # set program counter to zero
         self.psw = 8  # init PSW, reset stack pointer
         self.rb  = 0  # select register bank O
         self.mb  = 0  # selects memory bank O
+        self.in_isr = 0 # interrupt service routine in progress
         self.bus = 0xFF # set BUS to high impedance state
         self.eie = 0  # disable external interrupts
         self.irq = 1  # interrupt line status
@@ -46,20 +157,170 @@ class MSC48_CPU:
         ''' Set post-instruction callback '''
         self.post_instr_cb = cb
 
+    def set_coverage_maps(self, exec_map, branch_map):
+        ''' Enable code coverage collection into the given bytearrays.
+            exec_map[addr] is set to 1 for each executed instruction,
+            branch_map[addr] gets bit 0 set if the conditional jump at addr
+            was taken and bit 1 set if it fell through.
+            Pass None to disable coverage collection.
+        '''
+        self.cov_exec = exec_map
+        self.cov_branch = branch_map
+
+    def add_event_source(self, cb):
+        ''' Register a source of external events.
+            cb(cycles) must return the cycle at which it's going to change
+            any CPU input next or None if no change is pending.
+        '''
+        self.event_sources.append(cb)
+
+    def next_event(self):
+        ''' Return the cycle of the earliest pending external event
+            or None if there are no pending events.
+        '''
+        horizon = None
+        for cb in self.event_sources:
+            event_cycle = cb(self.cycles)
+            if event_cycle is not None and (horizon is None or
+                                            event_cycle < horizon):
+                horizon = event_cycle
+        return horizon
+
+    def set_loop_detector(self, detector):
+        ''' Install an object whose check_loop(branch_pc, end_cycle) method
+            will be called by exec_cycles() after each backward jump.
+        '''
+        self.loop_detector = detector
+
+    def set_memo(self, memo):
+        ''' Install a subroutine memoizer. Its on_call(addr) method will be
+            called right after a CALL has been executed. It returns True
+            if it has taken care of executing the subroutine. The memoizer
+            only acts on calls made by exec_cycles().
+        '''
+        self.memo = memo
+
+    def set_history(self, history):
+        ''' Install an execution history recorder. Its record(opcode) method
+            will be called before each instruction is executed.
+        '''
+        self.history = history
+
+    def set_journal(self, journal):
+        ''' Install an input journal. Its log_t1(level) method will be
+            called on each change of the T1 line, log_set(dst, val)
+            on each call of set_state().
+        '''
+        self.journal = journal
+
+    def save_state(self):
+        ''' Return an immutable snapshot of registers and internal RAM '''
+        return (tuple(getattr(self, name) for name in STATE_REGS),
+                bytes(self.ram_data))
+
+    def restore_state(self, state):
+        ''' Restore processor state saved by save_state() '''
+        regs, ram = state
+        for name, val in zip(STATE_REGS, regs):
+            setattr(self, name, val)
+        self.ram_data[:] = ram
+
+    def set_verbose(self, flag):
+        ''' Enable/disable logging of port state changes '''
+        self.verbose = flag
+
+    def _init_ports(self):
+        ''' Set up the I/O dispatch tables.
+            Ports are numbered like in the port instructions:
+            0 - BUS, 1 - P1, 2 - P2, 4...7 - 8243 expander ports.
+            port_readers return the pin state, latch_readers return
+            the output latch used by ORL/ANL, port_writers set it.
+        '''
+        self.port_readers = [partial(self._unsupported_read, port)
+                             for port in range(NUM_PORTS)]
+        self.latch_readers = list(self.port_readers)
+        self.port_writers = [partial(self._unsupported_write, port)
+                             for port in range(NUM_PORTS)]
+        self.set_port_handlers(0, self.read_bus, self.write_bus)
+        self.set_port_handlers(1, self.read_port1, self._write_port1)
+        self.set_port_handlers(2, self.read_port2, self._write_port2)
+        self.set_ext_mem(self.read_bus_ext, self._ignore_ext_write)
+        self.devices = [] # peripherals whose state is saved with the CPU's
+
+    def set_port_handlers(self, port, reader, writer, latch_reader=None):
+        ''' Route accesses to a port to the given callables.
+            reader() and latch_reader() return the port value,
+            writer(val) sets it. latch_reader defaults to reader.
+        '''
+        if port < 0 or port >= NUM_PORTS:
+            raise ValueError("Invalid port %d" % port)
+        self.port_readers[port] = reader
+        self.latch_readers[port] = latch_reader or reader
+        self.port_writers[port] = writer
+
+    def set_ext_mem(self, reader, writer):
+        ''' Route MOVX accesses to an external memory device.
+            reader(addr) returns a byte, writer(addr, val) stores one.
+        '''
+        self.ext_read = reader
+        self.ext_write = writer
+
+    def add_device(self, dev):
+        ''' Register a peripheral providing save_state()/restore_state()
+            so that its state is included in history checkpoints.
+        '''
+        self.devices.append(dev)
+
+    def save_periph_state(self):
+        return tuple(dev.save_state() for dev in self.devices)
+
+    def restore_periph_state(self, state):
+        for dev, dev_state in zip(self.devices, state):
+            dev.restore_state(dev_state)
+
+    def _unsupported_read(self, port):
+        print("Unsupported port %d" % port)
+        return 0xFF
+
+    def _unsupported_write(self, port, val):
+        print("Unsupported port %d" % port)
+
+    def read_bus(self):
+        return self.bus
+
+    def write_bus(self, val):
+        if self.verbose:
+            print("BUS state changed to 0x%01X" % val)
+        self.bus = val
+
+    def read_bus_ext(self, addr):
+        ''' MOVX without external memory reads the floating bus '''
+        return self.bus
+
+    def _ignore_ext_write(self, addr, val):
+        pass
+
+    def _write_port1(self, val):
+        if self.verbose:
+            print("Port 1 state changed to 0x%01X" % val)
+        self.p1 = val
+
+    def _write_port2(self, val):
+        if self.verbose:
+            print("Port 2 state changed to 0x%01X" % val)
+        self.p2 = val
+
     def write_port(self, port, val):
-        print("Port %d state changed to 0x%01X" % (port, val))
-        if port == 1:
-            self.p1 = val
-        elif port == 2:
-            self.p2 = val
-        else:
-            print("Unsupported port %d" % port)
+        self.port_writers[port](val)
 
     def get_t1_line(self):
         return self.t1
 
     def set_t1_line(self, val):
-        self.t1 = val & 1
+        val &= 1
+        if self.journal is not None and val != self.t1:
+            self.journal.log_t1(val)
+        self.t1 = val
 
     def read_port1(self):
         return self.p1
@@ -77,6 +338,8 @@ class MSC48_CPU:
         self.ram_data[self.rb * 24 + reg_num] = val & 0xFF
 
     def cond_jump(self, cond):
+        if self.cov_branch is not None:
+            self.cov_branch[self.pc - 1] |= 1 if cond else 2
         if cond:
             self.pc = (self.pc & ~0xFF) | self.rom_data[self.pc]
         else: # condition false --> fall through
@@ -110,6 +373,8 @@ class MSC48_CPU:
         print("")
 
     def set_state(self, dst, val):
+        if self.journal is not None:
+            self.journal.log_set(dst, val)
         if dst == "PC":
             if val < 0 or val > self.rom_size:
                 print("Invalid value 0x%04X" % val)
@@ -139,8 +404,48 @@ class MSC48_CPU:
         while self.pc != addr:
             self.exec_single()
 
+    def exec_cycles(self, num_cycles):
+        ''' Execute instructions until at least num_cycles machine cycles
+            have elapsed. Returns the number of instructions executed.
+        '''
+        end_cycle = self.cycles + num_cycles
+        count = 0
+        detector = self.loop_detector
+        self.end_cycle = end_cycle
+        while self.cycles < end_cycle:
+            pc = self.pc
+            self.exec_single()
+            count += 1
+            if detector is not None and self.pc < pc:
+                count += detector.check_loop(pc, end_cycle)
+        self.end_cycle = None
+        return count
+
+    def take_interrupt(self, vector):
+        ''' Enter an interrupt service routine at vector
+            (3 - external interrupt, 7 - timer/counter interrupt).
+            JMP and CALL stay in memory bank 0 until RETR.
+            Returns False if an interrupt routine is already running.
+            The emulator doesn't deliver interrupts itself yet: this is
+            a hook for callers only, see bankcheck8048.py.
+        '''
+        if self.in_isr:
+            return False
+        ret = (self.pc & 0xFFF) | ((self.psw & 0xF0) << 8)
+        self.ram_data[(self.psw & 7) * 2 + 8] = (ret >> 8) & 0xFF
+        self.ram_data[(self.psw & 7) * 2 + 9] = ret & 0xFF
+        self.psw = (self.psw & 0xF8) | ((self.psw + 1) & 0x7)
+        self.pc = vector
+        self.in_isr = 1
+        self.cycles += 2
+        return True
+
     def exec_single(self):
+        if self.cov_exec is not None:
+            self.cov_exec[self.pc] = 1
         opcode = self.rom_data[self.pc]
+        if self.history is not None:
+            self.history.record(opcode)
         self.pc += 1 # each instruction is at least one byte wide
         self.cycles += 1 # each instruction takes at least one cycle (2.5 usecs)
 
@@ -154,9 +459,12 @@ class MSC48_CPU:
             self.psw |= 0x10
         elif opcode == 0xE5: # SEL MB0
             self.mb = 0
+        elif opcode == 0xF5: # SEL MB1
+            self.mb = 1
         elif (opcode & 0x1F) == 4: # JMP addr
             self.cycles += 1 # add extra cycle
-            self.pc = (self.pc & ~0x7FF) | ((opcode & 0xE0) << 3) | self.rom_data[self.pc]
+            # A11 comes from MB, interrupt routines stay in bank 0
+            self.pc = self.jump_tabs[self.mb & (self.in_isr ^ 1)][self.pc]
         elif (opcode & 0x1F) == 0x12: # JBb addr
             self.cycles += 1 # add extra cycle
             bit_mask = 1 << ((opcode >> 5) & 7)
@@ -164,22 +472,14 @@ class MSC48_CPU:
         elif (opcode & 0xFC) == 0x88: # ORL port,imm
             self.cycles += 1 # add extra cycle
             port = opcode & 3
-            if port == 1:
-                self.write_port(port, self.p1 | self.rom_data[self.pc])
-            elif port == 2:
-                self.write_port(port, self.p2 | self.rom_data[self.pc])
-            else:
-                print("Invalid port %d" % port)
+            self.port_writers[port](self.latch_readers[port]() |
+                                    self.rom_data[self.pc])
             self.pc += 1
         elif (opcode & 0xFC) == 0x98: # ANL port,imm
             self.cycles += 1 # add extra cycle
             port = opcode & 3
-            if port == 1:
-                self.write_port(port, self.p1 & self.rom_data[self.pc])
-            elif port == 2:
-                self.write_port(port, self.p2 & self.rom_data[self.pc])
-            else:
-                print("Invalid port %d" % port)
+            self.port_writers[port](self.latch_readers[port]() &
+                                    self.rom_data[self.pc])
             self.pc += 1
         elif opcode == 0x15: # DIS I
             self.eie = 0
@@ -197,7 +497,7 @@ class MSC48_CPU:
             self.f1 = 0
         elif (opcode & 0x1F) == 0x14: # CALL addr
             self.cycles += 1 # add extra cycle
-            addr = (self.pc & ~0x7FF) | ((opcode & 0xE0) << 3) | self.rom_data[self.pc]
+            addr = self.jump_tabs[self.mb & (self.in_isr ^ 1)][self.pc]
             self.pc += 1
             #print("addr = 0x%03X" % addr)
             if addr < self.rom_size:
@@ -206,6 +506,8 @@ class MSC48_CPU:
                 self.ram_data[(self.psw & 7) * 2 + 9] = ret & 0xFF
                 self.psw = (self.psw & 0xF8) | ((self.psw + 1) & 0x7)
                 self.pc = addr
+                if self.memo is not None and self.memo.on_call(addr):
+                    return # subroutine already executed
             else:
                 print("Invalid destination addr 0x%03X!" % addr)
         elif opcode == 0x83: # RET
@@ -218,25 +520,27 @@ class MSC48_CPU:
             self.cycles += 1 # add extra cycle
             stack_pos = (self.psw - 1) & 0x7
             ret = ((self.ram_data[stack_pos * 2 + 8]) << 8) | self.ram_data[stack_pos * 2 + 9]
-            self.psw = (self.psw & 8) | ((ret & 0xF0) >> 8) | stack_pos
+            self.psw = (self.psw & 8) | ((ret >> 8) & 0xF0) | stack_pos
+            self.rb = (self.psw >> 4) & 1
             self.pc = ret & 0xFFF
+            self.in_isr = 0
         elif opcode == 0x23: # MOV A,imm
             self.cycles += 1 # add extra cycle
             self.acc = self.rom_data[self.pc]
             self.pc += 1
         elif (opcode & 0xFC) == 0x38: # OUTL port,A
             self.cycles += 1 # add extra cycle
-            port = opcode & 3
-            if port == 1 or port == 2:
-                self.write_port(port, self.acc)
-            else:
-                print("Invalid port %d" % port)
+            self.port_writers[opcode & 3](self.acc)
+        elif opcode == 0x02: # OUTL BUS,A
+            self.cycles += 1 # add extra cycle
+            self.port_writers[0](self.acc)
         elif opcode == 0x27: # CLR A
             self.acc = 0
         elif opcode == 0x97: # CLR C
             self.psw = self.psw & 0x7F
         elif opcode == 0xD7: # MOV PSW,A
             self.psw = self.acc
+            self.rb = (self.acc >> 4) & 1
         elif opcode == 0x42: # MOV A,T
             self.acc = self.tc
         elif opcode == 0x62: # MOV T,A
@@ -265,6 +569,10 @@ class MSC48_CPU:
             self.acc ^= self.ram_data[self.get_reg_val(opcode & 1)]
         elif (opcode & 0xFE) == 0x90: # MOVX @reg,A
             self.cycles += 1 # add extra cycle
+            self.ext_write(self.get_reg_val(opcode & 1), self.acc)
+        elif (opcode & 0xFE) == 0x80: # MOVX A,@reg
+            self.cycles += 1 # add extra cycle
+            self.acc = self.ext_read(self.get_reg_val(opcode & 1))
         elif (opcode & 0xFE) == 0xA0: # MOV @reg,A
             self.ram_data[self.get_reg_val(opcode & 1)] = self.acc
         elif (opcode & 0xFE) == 0xF0: # MOV A,@reg
@@ -278,8 +586,12 @@ class MSC48_CPU:
             reg_num = opcode & 7
             self.set_reg_val(reg_num, self.get_reg_val(reg_num) - 1)
             if self.get_reg_val(reg_num) != 0:
+                if self.cov_branch is not None:
+                    self.cov_branch[self.pc - 1] |= 1
                 self.pc = (self.pc & ~0xFF) | self.rom_data[self.pc]
             else:
+                if self.cov_branch is not None:
+                    self.cov_branch[self.pc - 1] |= 2
                 self.pc += 1
         elif opcode == 0x26: # JNT0 addr
             self.cycles += 1 # add extra cycle
@@ -402,17 +714,25 @@ class MSC48_CPU:
             self.acc = (self.acc ^ self.get_reg_val(opcode & 7)) & 0xFF
         elif (opcode & 0xF8) == 0x48: # ORL A,reg
             self.acc = (self.acc | self.get_reg_val(opcode & 7)) & 0xFF
-        elif (opcode & 0xFC) == 0x8:
+        elif (opcode & 0xFC) == 0x8: # INS A,BUS / IN A,port
             self.cycles += 1 # add extra cycle
-            port = opcode & 3
-            if port == 0: # INS A,BUS
-                self.acc = self.bus
-            elif port == 1: # IN A,p1
-                self.acc = self.p1
-            elif port == 2: # IN A,p2
-                self.acc = self.p2
-            else:
-                print("Invalid port %d" % port)
+            self.acc = self.port_readers[opcode & 3]()
+        elif (opcode & 0xFC) == 0x0C: # MOVD A,port
+            self.cycles += 1 # add extra cycle
+            self.acc = self.port_readers[(opcode & 3) + 4]() & 0xF
+        elif (opcode & 0xFC) == 0x3C: # MOVD port,A
+            self.cycles += 1 # add extra cycle
+            self.port_writers[(opcode & 3) + 4](self.acc & 0xF)
+        elif (opcode & 0xFC) == 0x8C: # ORLD port,A
+            self.cycles += 1 # add extra cycle
+            port = (opcode & 3) + 4
+            self.port_writers[port](self.latch_readers[port]() |
+                                    (self.acc & 0xF))
+        elif (opcode & 0xFC) == 0x9C: # ANLD port,A
+            self.cycles += 1 # add extra cycle
+            port = (opcode & 3) + 4
+            self.port_writers[port](self.latch_readers[port]() &
+                                    (self.acc & 0xF))
         elif opcode == 0xE3: # MOVP3 A, @A
             self.cycles += 1 # add extra cycle
             self.acc = self.rom_data[0x300 | self.acc]
@@ -0,0 +1,293 @@
+'''
+    Execution history for reverse debugging of MSC-48 firmware.
+
+    Two kinds of records are kept, both in bounded memory:
+     - an undo log containing one compact entry per executed instruction
+       with the old values of the registers, ADB bus state variables
+       and internal RAM bytes the instruction changed as well as
+       the old peripheral state for external bus accesses,
+     - full checkpoints of the CPU and ADB state taken every N
+       instructions and after each external input (ADB command,
+       register change from the debugger).
+
+    Stepping back within the undo log simply applies its entries.
+    Older states are reached by restoring the nearest preceding
+    checkpoint and replaying forward. As external inputs always start
+    a new checkpoint, replaying never crosses them.
+
+    Rewinding discards the recorded future: executing forward again
+    starts a new timeline. Patching the ROM discards the recorded past.
+'''
+
+from collections import deque
+
+from emu8048 import STATE_REGS
+from ADB import ADB_STATE_IDLE
+
+DEF_MAX_UNDO = 100000 # max. number of undo log entries
+CHECKPOINT_INTERVAL = 10000 # instructions between checkpoints
+MAX_CHECKPOINTS = 64
+
+RAM_BASE = 256 # undo entry index of the first internal RAM location
+PERIPH_IDX = -1 # undo entry index of the peripheral state
+
+# internal RAM locations written by each opcode
+WR_NONE     = 0
+WR_REG      = 1 # register Rn
+WR_INDIRECT = 2 # location pointed to by R0/R1
+WR_STACK    = 3 # return address pushed by CALL
+WR_PERIPH   = 4 # external memory or I/O expander, no internal RAM
+
+def _build_write_table():
+    table = bytearray(256)
+    for opcode in range(256):
+        if (opcode & 0xF8) in (0x18, 0x28, 0xA8, 0xB8, 0xC8, 0xE8):
+            table[opcode] = WR_REG # INC, XCH, MOV, DEC, DJNZ
+        elif (opcode & 0xFE) in (0x10, 0x20, 0x30, 0xA0, 0xB0):
+            table[opcode] = WR_INDIRECT # INC, XCH, XCHD, MOV
+        elif (opcode & 0x1F) == 0x14:
+            table[opcode] = WR_STACK
+        elif (opcode & 0xFE) == 0x90 or (opcode & 0xFC) in (0x0C, 0x3C,
+                                                           0x8C, 0x9C):
+            table[opcode] = WR_PERIPH # MOVX, MOVD, ORLD, ANLD
+    return bytes(table)
+
+WRITE_TABLE = _build_write_table()
+
+class ExecHistory:
+    def __init__(self, cpu_obj, adb_obj, max_undo=DEF_MAX_UNDO):
+        self.cpu_obj = cpu_obj
+        self.adb_obj = adb_obj
+        self.undo = deque(maxlen=max_undo)
+        self.checkpoints = deque(maxlen=MAX_CHECKPOINTS) # (step, cpu, adb, periph)
+        self.step = 0 # number of instructions executed since recording start
+        self.pending = None # state before the instruction being executed
+        self.adb_idle_state = None # bus state snapshot while ADB is idle
+        self.num_regs = len(STATE_REGS)
+        self.take_checkpoint()
+        cpu_obj.set_history(self)
+        cpu_obj.add_rom_listener(self.invalidate)
+
+    def detach(self):
+        self.cpu_obj.set_history(None)
+        self.cpu_obj.remove_rom_listener(self.invalidate)
+
+    def invalidate(self, start, end):
+        ''' Called after the ROM has been patched.
+            Replaying recorded history with different code would produce
+            a different past so the history is restarted from here.
+        '''
+        self.undo.clear()
+        self.checkpoints.clear()
+        self.pending = None
+        self.adb_idle_state = None
+        self.take_checkpoint()
+
+    def _state_vector(self):
+        cpu = self.cpu_obj
+        adb = self.adb_obj
+        # the bus state can't change while ADB is idle
+        # so avoid taking a fresh snapshot for each instruction
+        if adb.adb_state != ADB_STATE_IDLE:
+            self.adb_idle_state = None
+            adb_state = adb.save_state()
+        elif self.adb_idle_state is None:
+            adb_state = self.adb_idle_state = adb.save_state()
+        else:
+            adb_state = self.adb_idle_state
+        return (tuple(getattr(cpu, name) for name in STATE_REGS), adb_state)
+
+    def _set_state_vector(self, regs, adb_state):
+        cpu = self.cpu_obj
+        for name, val in zip(STATE_REGS, regs):
+            setattr(cpu, name, val)
+        self.adb_obj.restore_state(adb_state)
+        self.adb_idle_state = None
+
+    def record(self, opcode):
+        ''' Called by the CPU before executing opcode '''
+        cpu = self.cpu_obj
+        vec = self._state_vector()
+        if self.pending is not None:
+            self._finish(vec)
+        if self.step - self.checkpoints[-1][0] >= CHECKPOINT_INTERVAL:
+            self.take_checkpoint()
+
+        ram = cpu.ram_data
+        kind = WRITE_TABLE[opcode]
+        periph_old = None
+        if kind == WR_NONE:
+            ram_old = ()
+        elif kind == WR_REG:
+            addr = cpu.rb * 24 + (opcode & 7)
+            ram_old = ((addr, ram[addr]),)
+        elif kind == WR_INDIRECT:
+            addr = ram[cpu.rb * 24 + (opcode & 1)] % len(ram)
+            ram_old = ((addr, ram[addr]),)
+        elif kind == WR_STACK:
+            addr = (cpu.psw & 7) * 2 + 8
+            ram_old = ((addr, ram[addr]), (addr + 1, ram[addr + 1]))
+        else:
+            ram_old = ()
+            if cpu.devices:
+                periph_old = cpu.save_periph_state()
+        self.pending = (vec, ram_old, periph_old)
+        self.step += 1
+
+    def _finish(self, vec):
+        ''' Complete the undo entry of the last executed instruction '''
+        (old_regs, old_adb), ram_old, periph_old = self.pending
+        self.pending = None
+        regs, adb_state = vec
+        entry = []
+        for idx, old in enumerate(old_regs):
+            if regs[idx] != old:
+                entry += (idx, old)
+        if adb_state is not old_adb:
+            for idx, old in enumerate(old_adb):
+                if adb_state[idx] != old:
+                    entry += (self.num_regs + idx, old)
+        ram = self.cpu_obj.ram_data
+        for addr, old in ram_old:
+            if ram[addr] != old:
+                entry += (RAM_BASE + addr, old)
+        if periph_old is not None:
+            if self.cpu_obj.save_periph_state() != periph_old:
+                entry += (PERIPH_IDX, periph_old)
+        self.undo.append(tuple(entry))
+
+    def sync(self):
+        ''' Bring the undo log up to date with the current state '''
+        if self.pending is not None:
+            self._finish(self._state_vector())
+
+    def take_checkpoint(self):
+        self.sync()
+        if self.checkpoints and self.checkpoints[-1][0] == self.step:
+            self.checkpoints.pop()
+        self.checkpoints.append((self.step, self.cpu_obj.save_state(),
+                                 self.adb_obj.save_state(),
+                                 self.cpu_obj.save_periph_state()))
+
+    def note_input(self):
+        ''' Must be called after the state has been changed from outside,
+            e.g. by an ADB command or the user.
+        '''
+        self.undo.clear() # undo entries don't cover external changes
+        self.pending = None
+        self.adb_idle_state = None
+        self.take_checkpoint()
+
+    def oldest_step(self):
+        self.sync()
+        return min(self.checkpoints[0][0], self.step - len(self.undo))
+
+    def _undo_one(self):
+        entry = self.undo.pop()
+        regs, adb_state = self._state_vector()
+        vec = list(regs + adb_state)
+        ram = self.cpu_obj.ram_data
+        for i in range(len(entry) - 2, -1, -2):
+            idx, old = entry[i], entry[i + 1]
+            if idx >= RAM_BASE:
+                ram[idx - RAM_BASE] = old
+            elif idx == PERIPH_IDX:
+                self.cpu_obj.restore_periph_state(old)
+            else:
+                vec[idx] = old
+        self._set_state_vector(vec[:self.num_regs], vec[self.num_regs:])
+        self.step -= 1
+
+    def _restore(self, cp):
+        ''' Go back to checkpoint cp dropping all newer history '''
+        step, cpu_state, adb_state, periph_state = cp
+        while self.checkpoints[-1][0] > step:
+            self.checkpoints.pop()
+        self.cpu_obj.restore_state(cpu_state)
+        self.cpu_obj.restore_periph_state(periph_state)
+        self.adb_obj.restore_state(adb_state)
+        self.adb_idle_state = None
+        self.undo.clear()
+        self.pending = None
+        self.step = step
+
+    def _replay(self, end_step, addrs=None):
+        ''' Re-execute instructions until end_step is reached.
+            Returns the last step at which PC was in addrs or None.
+        '''
+        cpu = self.cpu_obj
+        adb = self.adb_obj
+        cpu_verbose, adb_verbose = cpu.verbose, adb.verbose
+        cpu.set_verbose(False)
+        adb.set_verbose(False)
+        adb.set_muted(True)
+        last_hit = None
+        try:
+            while self.step < end_step:
+                if addrs and cpu.pc in addrs:
+                    last_hit = self.step
+                cpu.exec_single()
+            self.sync()
+        finally:
+            cpu.set_verbose(cpu_verbose)
+            adb.set_verbose(adb_verbose)
+            adb.set_muted(False)
+        return last_hit
+
+    def goto(self, target):
+        ''' Rewind to the state before instruction number target.
+            Returns False if that state isn't available anymore.
+        '''
+        self.sync()
+        if target >= self.step:
+            return target == self.step
+        if target >= self.step - len(self.undo):
+            while self.step > target:
+                self._undo_one()
+            return True
+        for cp in reversed(self.checkpoints):
+            if cp[0] <= target:
+                self._restore(cp)
+                self._replay(target)
+                return True
+        return False
+
+    def reverse_step(self, count=1):
+        ''' Step back count instructions.
+            Returns the number of instructions actually stepped back.
+        '''
+        target = max(self.step - count, self.oldest_step())
+        start = self.step
+        self.goto(target)
+        return start - self.step
+
+    def reverse_continue(self, addrs):
+        ''' Step back to the last time an instruction at one of
+            the addresses in addrs was about to be executed.
+            Stops at the oldest recorded state and returns False
+            if there is no such instruction in the history.
+        '''
+        self.sync()
+        oldest = self.oldest_step()
+        while self.undo:
+            self._undo_one()
+            if self.cpu_obj.pc in addrs:
+                return True
+
+        # search older parts of the history segment by segment
+        end = self.step
+        for cp in [cp for cp in reversed(self.checkpoints) if cp[0] < end]:
+            self._restore(cp)
+            hit = self._replay(end, addrs)
+            if hit is not None:
+                self.goto(hit)
+                return True
+            end = cp[0]
+        self.goto(oldest)
+        return False
+
+    def print_stats(self):
+        print("Recorded instructions: %d, oldest reachable: %d" %
+              (self.step, self.oldest_step()))
+        print("Undo log entries: %d, checkpoints: %d" % (len(self.undo),
+              len(self.checkpoints)))
@@ -0,0 +1,200 @@
+'''
+    Idle loop detection and fast-forwarding for the MSC-48 emulator.
+
+    Keyboard firmware spends most of its time in busy waiting loops
+    that poll an input (T1 etc.) and/or count a register down using DJNZ.
+    As long as no external event occurs, such loops are fully deterministic.
+
+    After a backward jump, the loop body is checked statically for
+    instructions with external side effects first. If there are none,
+    the next iteration is executed while tracing RAM accesses. If the
+    iteration changed no state except for a single loop counter that
+    isn't consulted by any other instruction, all further iterations
+    up to the next external event, the loop exit or the end of the
+    current time slice are skipped by advancing the cycle counter and
+    updating the loop counter in one step.
+'''
+
+from emu8048 import TracingRAM
+from dasm8048 import Dasm8048
+
+MAX_BODY_INSTRS = 64 # max. number of instructions per loop iteration
+MAX_BACKOFF = 256 # max. number of loop entries to ignore after a failure
+
+# Opcodes that must not appear in a loop body: port/bus writes,
+# external memory and I/O expander accesses, subroutine calls and
+# returns, indirect jumps.
+# Timer/counter isn't emulated yet so its instructions only touch
+# internal state and are allowed.
+FORBIDDEN_OPCODES = frozenset([0x02, 0x39, 0x3A, 0x83, 0x93, 0xB3] +
+                              list(range(0x0C, 0x10)) +
+                              list(range(0x3C, 0x40)) +
+                              list(range(0x80, 0x82)) +
+                              list(range(0x88, 0x90)) +
+                              list(range(0x90, 0x92)) +
+                              list(range(0x98, 0xA0)) +
+                              [op for op in range(256) if (op & 0x1F) == 0x14])
+
+def _is_djnz(opcode):
+    return (opcode & 0xF8) == 0xE8
+
+class _LoopInfo:
+    def __init__(self, head, branch_pc):
+        self.head = head
+        self.branch_pc = branch_pc
+        self.failures = 0
+        self.backoff = 0
+
+def _cpu_regs(cpu):
+    ''' Registers and I/O lines that have to stay unchanged
+        across a loop iteration.
+    '''
+    return (cpu.acc, cpu.psw, cpu.rb, cpu.mb, cpu.f0, cpu.f1, cpu.tc,
+            cpu.eie, cpu.tie, cpu.t0, cpu.t1, cpu.irq, cpu.p1, cpu.p2,
+            cpu.bus)
+
+class IdleLoopDetector:
+    def __init__(self, cpu_obj):
+        self.cpu_obj = cpu_obj
+        self.dasm = Dasm8048()
+        self.loops = {} # (head, branch_pc) -> _LoopInfo or None
+        self.num_skips = 0 # number of fast-forwards performed
+        self.skipped_cycles = 0 # number of cycles fast-forwarded
+        cpu_obj.set_loop_detector(self)
+        cpu_obj.add_rom_listener(self.invalidate)
+
+    def detach(self):
+        self.cpu_obj.set_loop_detector(None)
+        self.cpu_obj.remove_rom_listener(self.invalidate)
+
+    def invalidate(self, start, end):
+        ''' Forget analysis results for loops overlapping
+            the address range start...end-1.
+        '''
+        for key in list(self.loops):
+            if key[0] < end and key[1] + 2 > start:
+                del self.loops[key]
+
+    def _analyze(self, head, branch_pc):
+        ''' Check if the code between head and branch_pc can form
+            a side-effect free loop.
+        '''
+        rom = self.cpu_obj.rom_data
+        addr = head
+        while addr <= branch_pc:
+            opcode = rom[addr]
+            if opcode in FORBIDDEN_OPCODES:
+                return None
+            s, length = self.dasm.dasm_single(addr,
+                bytes([opcode, rom[(addr + 1) % len(rom)]]))
+            if s == "unknown":
+                return None
+            addr += length
+        if addr - length != branch_pc:
+            return None # branch_pc isn't at an instruction boundary
+        return _LoopInfo(head, branch_pc)
+
+    def check_loop(self, branch_pc, end_cycle):
+        ''' Called by the CPU after a backward jump from branch_pc.
+            Returns the number of instructions executed for verification.
+        '''
+        cpu = self.cpu_obj
+        head = cpu.pc
+        key = (head, branch_pc)
+        if key in self.loops:
+            info = self.loops[key]
+        else:
+            info = self._analyze(head, branch_pc)
+            self.loops[key] = info
+        if info is None:
+            return 0
+        if info.backoff:
+            info.backoff -= 1
+            return 0
+
+        # execute one iteration while tracing RAM accesses
+        regs = _cpu_regs(cpu)
+        ram = cpu.ram_data
+        ram_before = bytes(ram)
+        tracer = TracingRAM(ram)
+        start_cycle = cpu.cycles
+        completed = False
+        count = 0
+        cpu.ram_data = tracer
+        try:
+            while count < MAX_BODY_INSTRS:
+                pc = cpu.pc
+                tracer.cur_pc = pc
+                cpu.exec_single()
+                count += 1
+                if cpu.pc == head and pc == branch_pc:
+                    completed = True
+                    break
+                if cpu.pc < head or cpu.pc > branch_pc:
+                    break # loop exited
+        finally:
+            ram[:] = tracer
+            cpu.ram_data = ram
+
+        counter = self._check_fixed_point(completed, regs, ram_before, tracer)
+        if counter is False:
+            info.failures += 1
+            info.backoff = min(1 << info.failures, MAX_BACKOFF)
+            return count
+        info.failures = 0
+
+        # determine how many iterations can be skipped
+        iter_cycles = cpu.cycles - start_cycle
+        limit = end_cycle
+        event_cycle = cpu.next_event()
+        if event_cycle is not None and event_cycle < limit:
+            limit = event_cycle
+        num_iters = (limit - cpu.cycles) // iter_cycles
+
+        if counter is not None:
+            addr, delta, writer_pc = counter
+            if _is_djnz(cpu.rom_data[writer_pc]):
+                # DJNZ changes its outcome when the counter reaches zero
+                num_iters = min(num_iters, (ram[addr] - 1) & 0xFF)
+        if num_iters <= 0:
+            return count
+
+        cpu.cycles += num_iters * iter_cycles
+        if counter is not None:
+            ram[addr] = (ram[addr] + num_iters * delta) & 0xFF
+        self.num_skips += 1
+        self.skipped_cycles += num_iters * iter_cycles
+        if cpu.post_instr_cb:
+            cpu.post_instr_cb(cpu.cycles)
+        return count
+
+    def _check_fixed_point(self, completed, regs, ram_before, tracer):
+        ''' Verify that a loop iteration didn't change anything except
+            for a single loop counter.
+            Returns False if the loop cannot be skipped, None if there is
+            no loop counter or (address, delta, writer_pc) of the counter.
+        '''
+        if not completed or _cpu_regs(self.cpu_obj) != regs:
+            return False
+        ram = self.cpu_obj.ram_data
+        changed = [addr for addr in tracer.writes
+                   if ram[addr] != ram_before[addr]]
+        if not changed:
+            return None
+        if len(changed) > 1:
+            return False
+        addr = changed[0]
+        delta = (ram[addr] - ram_before[addr]) & 0xFF
+        if delta == 0xFF:
+            delta = -1
+        elif delta != 1:
+            return False
+        writers = tracer.writes[addr]
+        # the counter may only be consulted by the instruction updating it
+        if len(writers) != 1 or not tracer.reads.get(addr, set()) <= writers:
+            return False
+        return (addr, delta, next(iter(writers)))
+
+    def print_stats(self):
+        print("Idle loops fast-forwarded: %d times, %d cycles skipped" %
+              (self.num_skips, self.skipped_cycles))
@@ -0,0 +1,432 @@
+'''
+    Deterministic record/replay of MSC-48 simulations.
+
+    The CPU core and the ADB host model are deterministic so a run is
+    fully described by the inputs injected from outside and the cycles
+    at which they arrived. JournalWriter records them as a compact
+    binary stream of cycle-stamped events:
+     - ADB commands and aborts issued to ADBSim,
+     - register changes made with set_state(),
+     - ROM patches,
+     - values read from port pins driven from outside (BUS and the
+       8243 expander ports by default), logged only when they change,
+     - changes of the T1 line.
+
+    T1 is driven by ADBSim from the commands so its changes aren't
+    needed for reproducing a run. They are kept for detecting the point
+    at which a replay diverges from the recording.
+
+    JournalReplayer feeds a journal back into a CPU set up the same way.
+    Snapshots of the CPU, ADB and peripheral state taken every
+    SEEK_INTERVAL cycles while recording are saved to a seek index
+    next to the journal (<journal>.idx) so that replay can start from
+    the middle of a long run.
+
+    Journal format (all integers are little-endian):
+
+    journal := magic, u8 version, u32 ROM CRC-32, u8 port mask,
+               u64 start cycle, event*
+    event   := varint cycle delta, u8 tag, payload
+
+    The low nibble of the tag is the event type, the high nibble holds
+    the T1 level or the port number.
+
+    The seek index is stored as JSON after its magic, byte strings as
+    {"hex": "..."}, so loading a shared index can't execute any code.
+'''
+
+import json
+import struct
+import zlib
+from collections import deque
+from functools import partial
+
+JOURNAL_MAGIC = b'AKJN'
+INDEX_MAGIC   = b'AKJI'
+JOURNAL_VERSION = 1
+HEADER_FORMAT = '<BIBQ'
+HEADER_SIZE = len(JOURNAL_MAGIC) + struct.calcsize(HEADER_FORMAT)
+
+SEEK_INTERVAL = 400000 # cycles between snapshots, 1 sec of simulated time
+FLUSH_SIZE = 4096 # bytes buffered before writing them out
+
+DEF_PORTS = (0, 4, 5, 6, 7) # BUS and expander ports
+
+# event types
+EV_T1        = 0 # T1 line changed, new level in the tag
+EV_PORT      = 1 # u8 value read from the port given in the tag
+EV_ADB_CMD   = 2 # u8 command, u8 length, Listen data
+EV_ADB_ABORT = 3
+EV_SET       = 4 # u8 length, destination name, s64 value
+EV_PATCH     = 5 # u16 address, u16 length, ROM bytes
+EV_END       = 6 # end of the recording
+
+def _put_varint(buf, val):
+    while val >= 0x80:
+        buf.append((val & 0x7F) | 0x80)
+        val >>= 7
+    buf.append(val)
+
+def _get_varint(data, pos):
+    ''' Returns (value, position after it) '''
+    val = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        val |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return val, pos
+        shift += 7
+
+def rom_crc(rom_data):
+    return zlib.crc32(rom_data) & 0xFFFFFFFF
+
+def index_path(path):
+    return path + '.idx'
+
+class JournalWriter:
+    def __init__(self, cpu_obj, adb_obj, path, ports=DEF_PORTS):
+        self.cpu_obj = cpu_obj
+        self.adb_obj = adb_obj
+        self.path = path
+        self.out_file = open(path, 'wb')
+        port_mask = 0
+        for port in ports:
+            port_mask |= 1 << port
+        self.buf = bytearray(JOURNAL_MAGIC + struct.pack(HEADER_FORMAT,
+                             JOURNAL_VERSION, rom_crc(cpu_obj.rom_data),
+                             port_mask, cpu_obj.cycles))
+        self.num_flushed = 0 # bytes already written to the file
+        self.last_cycle = cpu_obj.cycles
+        self.num_events = 0
+        self.port_vals = {} # last value logged for each port
+        self.index = [] # seek index, see take_snapshot()
+        self.orig_readers = {}
+        for port in ports:
+            reader = cpu_obj.port_readers[port]
+            self.orig_readers[port] = reader
+            cpu_obj.set_port_handlers(port, partial(self._read_port, port,
+                                      reader), cpu_obj.port_writers[port],
+                                      cpu_obj.latch_readers[port])
+        cpu_obj.set_journal(self)
+        cpu_obj.add_rom_listener(self._rom_changed)
+        adb_obj.set_journal(self)
+        self.take_snapshot()
+
+    def detach(self):
+        cpu = self.cpu_obj
+        for port, reader in self.orig_readers.items():
+            cpu.set_port_handlers(port, reader, cpu.port_writers[port],
+                                  cpu.latch_readers[port])
+        cpu.set_journal(None)
+        cpu.remove_rom_listener(self._rom_changed)
+        self.adb_obj.set_journal(None)
+
+    def _log(self, kind, arg=0, payload=b''):
+        cycles = self.cpu_obj.cycles
+        if cycles < self.last_cycle:
+            raise ValueError("Can't record going back in time")
+        _put_varint(self.buf, cycles - self.last_cycle)
+        self.buf.append(kind | (arg << 4))
+        self.buf += payload
+        self.last_cycle = cycles
+        self.num_events += 1
+        if len(self.buf) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.out_file.write(self.buf)
+        self.out_file.flush()
+        self.num_flushed += len(self.buf)
+        self.buf = bytearray()
+
+    def _read_port(self, port, reader):
+        val = reader()
+        if self.port_vals.get(port) != val:
+            self.port_vals[port] = val
+            self._log(EV_PORT, port, bytes([val & 0xFF]))
+        return val
+
+    def _rom_changed(self, start, end):
+        self._log(EV_PATCH, 0, struct.pack('<HH', start, end - start) +
+                  self.cpu_obj.rom_data[start:end])
+
+    def log_t1(self, level):
+        self._log(EV_T1, level)
+
+    def log_set(self, dst, val):
+        name = dst.encode('ascii')
+        self._log(EV_SET, 0, bytes([len(name)]) + name +
+                  struct.pack('<q', val))
+
+    def log_adb_cmd(self, cmd, listen_data):
+        data = bytes(listen_data) if listen_data else b''
+        self._log(EV_ADB_CMD, 0, bytes([cmd & 0xFF, len(data)]) + data)
+
+    def log_adb_abort(self):
+        self._log(EV_ADB_ABORT)
+
+    def take_snapshot(self):
+        ''' Add an entry to the seek index. It holds the state at the
+            current cycle and the journal position to continue from.
+        '''
+        cpu = self.cpu_obj
+        self.index.append((cpu.cycles, self.num_flushed + len(self.buf),
+                           self.last_cycle, rom_crc(cpu.rom_data),
+                           cpu.save_state(), self.adb_obj.save_state(),
+                           cpu.save_periph_state(),
+                           tuple(sorted(self.port_vals.items()))))
+
+    def on_slice(self, cycles):
+        ''' Slice callback of SimScheduler taking periodic snapshots '''
+        if cycles - self.index[-1][0] >= SEEK_INTERVAL:
+            self.take_snapshot()
+
+    def close(self):
+        ''' Finish the journal and write its seek index '''
+        self._log(EV_END)
+        self.flush()
+        self.out_file.close()
+        with open(index_path(self.path), 'wb') as idx_file:
+            idx_file.write(INDEX_MAGIC + json.dumps(self.index,
+                           default=_encode_bytes).encode('ascii'))
+        self.detach()
+
+    def print_stats(self):
+        print("Journal %s: %d events, %d bytes, %d snapshots" % (self.path,
+              self.num_events, self.num_flushed + len(self.buf),
+              len(self.index)))
+
+def _encode_bytes(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        return {'hex': obj.hex()}
+    raise TypeError("Can't store %s in a journal index" % type(obj).__name__)
+
+def _decode_value(val):
+    ''' Turn lists back into tuples and {"hex": ...} into bytes '''
+    if isinstance(val, list):
+        return tuple(_decode_value(item) for item in val)
+    if isinstance(val, dict):
+        return bytes.fromhex(val['hex'])
+    return val
+
+def load_index(path):
+    ''' Load the seek index of a journal. Returns [] if there is none. '''
+    try:
+        with open(index_path(path), 'rb') as idx_file:
+            data = idx_file.read()
+    except OSError:
+        return []
+    if data[:4] != INDEX_MAGIC:
+        raise ValueError("Not a journal index")
+    try:
+        index = [_decode_value(snap) for snap in json.loads(data[4:])]
+        if all(len(snap) == 8 for snap in index):
+            return index
+    except (ValueError, TypeError, KeyError):
+        pass
+    raise ValueError("Corrupted journal index")
+
+class JournalReplayer:
+    def __init__(self, cpu_obj, adb_obj, path, on_input=None):
+        ''' on_input() will be called after each input has been applied,
+            e.g. ExecHistory.note_input.
+        '''
+        self.cpu_obj = cpu_obj
+        self.adb_obj = adb_obj
+        self.path = path
+        self.on_input = on_input
+        with open(path, 'rb') as in_file:
+            self.data = in_file.read()
+        if self.data[:4] != JOURNAL_MAGIC:
+            raise ValueError("Not an input journal")
+        version, crc, port_mask, self.start_cycle = struct.unpack_from(
+            HEADER_FORMAT, self.data, len(JOURNAL_MAGIC))
+        if version != JOURNAL_VERSION:
+            raise ValueError("Unsupported journal version %d" % version)
+        if crc != rom_crc(cpu_obj.rom_data):
+            raise ValueError("Journal was recorded with a different ROM")
+        self.index = load_index(path)
+        self.divergence = None # (cycle, description) of the first mismatch
+        self.num_inputs = 0
+        self.orig_readers = {}
+        for port in range(8):
+            if port_mask & (1 << port):
+                reader = cpu_obj.port_readers[port]
+                self.orig_readers[port] = reader
+                cpu_obj.set_port_handlers(port, partial(self._read_port,
+                                          port, reader),
+                                          cpu_obj.port_writers[port],
+                                          cpu_obj.latch_readers[port])
+        cpu_obj.set_journal(self)
+        adb_obj.set_journal(self)
+        if self.index:
+            self._restore(self.index[0])
+        else:
+            if cpu_obj.cycles != self.start_cycle:
+                print("No seek index, replaying from cycle %d" %
+                      cpu_obj.cycles)
+            self._rewind(HEADER_SIZE, self.start_cycle, {})
+
+    def detach(self):
+        cpu = self.cpu_obj
+        for port, reader in self.orig_readers.items():
+            cpu.set_port_handlers(port, reader, cpu.port_writers[port],
+                                  cpu.latch_readers[port])
+        cpu.set_journal(None)
+        self.adb_obj.set_journal(None)
+
+    def _rewind(self, pos, last_cycle, port_vals):
+        self.pos = pos
+        self.last_cycle = last_cycle # stamp of the last decoded event
+        self.port_vals = dict(port_vals)
+        self.roots = deque() # inputs to apply: (cycle, type, payload)
+        self.t1_events = deque() # (cycle, level)
+        self.port_events = [deque() for port in range(8)] # (cycle, value)
+        self.cycle = self.cpu_obj.cycles # replayed so far
+
+    def _restore(self, snapshot):
+        cycle, pos, last_cycle, crc, cpu_state, adb_state, periph_state, \
+            port_vals = snapshot
+        cpu = self.cpu_obj
+        if crc != rom_crc(cpu.rom_data):
+            raise ValueError("ROM differs from the one at cycle %d" % cycle)
+        cpu.restore_state(cpu_state)
+        self.adb_obj.restore_state(adb_state)
+        cpu.restore_periph_state(periph_state)
+        self._rewind(pos, last_cycle, port_vals)
+        if self.on_input:
+            self.on_input()
+
+    def _decode_next(self):
+        ''' Decode the next event into its queue.
+            Returns False at the end of the journal.
+        '''
+        data = self.data
+        pos = self.pos
+        if pos >= len(data):
+            return False
+        delta, pos = _get_varint(data, pos)
+        tag = data[pos]
+        pos += 1
+        kind = tag & 0xF
+        self.last_cycle += delta
+        if kind == EV_T1:
+            self.t1_events.append((self.last_cycle, tag >> 4))
+        elif kind == EV_PORT:
+            self.port_events[tag >> 4].append((self.last_cycle, data[pos]))
+            pos += 1
+        else:
+            if kind == EV_ADB_CMD:
+                end = pos + 2 + data[pos + 1]
+            elif kind == EV_SET:
+                end = pos + 1 + data[pos] + 8
+            elif kind == EV_PATCH:
+                end = pos + 4 + struct.unpack_from('<H', data, pos + 2)[0]
+            else:
+                end = pos
+            self.roots.append((self.last_cycle, kind, data[pos:end]))
+            pos = end
+        self.pos = pos
+        return True
+
+    def _diverged(self, msg):
+        if self.divergence is None:
+            self.divergence = (self.cpu_obj.cycles, msg)
+            print("Replay diverged at cycle %d: %s" % self.divergence)
+
+    def _read_port(self, port, reader):
+        events = self.port_events[port]
+        cycles = self.cpu_obj.cycles
+        while events and events[0][0] < cycles:
+            self._diverged("read of port %d expected at cycle %d" % (port,
+                           events.popleft()[0]))
+        if events and events[0][0] == cycles:
+            self.port_vals[port] = events.popleft()[1]
+        if port in self.port_vals:
+            return self.port_vals[port]
+        return reader()
+
+    def log_t1(self, level):
+        events = self.t1_events
+        # changes caused by an input are stored after the input itself
+        while not events and self._decode_next():
+            pass
+        cycles = self.cpu_obj.cycles
+        if events and events[0] == (cycles, level):
+            events.popleft()
+        else:
+            self._diverged("unexpected T1 change to %d" % level)
+
+    def log_set(self, dst, val):
+        pass
+
+    def log_adb_cmd(self, cmd, listen_data):
+        pass
+
+    def log_adb_abort(self):
+        pass
+
+    def _run_to(self, cycle, exact=True):
+        cpu = self.cpu_obj
+        if cycle > cpu.cycles:
+            cpu.exec_cycles(cycle - cpu.cycles)
+        if exact and cpu.cycles != cycle:
+            self._diverged("no instruction boundary at cycle %d" % cycle)
+        self.cycle = cpu.cycles
+
+    def _apply(self, kind, payload):
+        cpu = self.cpu_obj
+        if kind == EV_ADB_CMD:
+            self.adb_obj.adb_send(payload[0], payload[2:])
+        elif kind == EV_ADB_ABORT:
+            self.adb_obj.adb_abort()
+        elif kind == EV_SET:
+            length = payload[0]
+            (val,) = struct.unpack_from('<q', payload, 1 + length)
+            cpu.set_state(payload[1:1 + length].decode('ascii'), val)
+        elif kind == EV_PATCH:
+            (addr,) = struct.unpack_from('<H', payload)
+            cpu.patch_rom(addr, payload[4:])
+        else:
+            return
+        self.num_inputs += 1
+        if self.on_input:
+            self.on_input()
+
+    def run(self, end_cycle=None):
+        ''' Replay until end_cycle or the end of the journal.
+            Returns True if the end of the journal has been reached.
+        '''
+        if self.cpu_obj.cycles < self.cycle: # e.g. after reverse stepping
+            self.seek(self.cpu_obj.cycles)
+        while True:
+            while not self.roots and self._decode_next():
+                pass
+            if not self.roots:
+                return True # journal wasn't closed properly
+            cycle, kind, payload = self.roots[0]
+            if end_cycle is not None and cycle > end_cycle:
+                self._run_to(end_cycle, exact=False)
+                return False
+            self._run_to(cycle)
+            self.roots.popleft()
+            if kind == EV_END:
+                return True
+            self._apply(kind, payload)
+
+    def seek(self, cycle):
+        ''' Continue replay from the nearest snapshot before cycle
+            and stop at cycle.
+        '''
+        snapshots = [snap for snap in self.index if snap[0] <= cycle]
+        if not snapshots:
+            raise ValueError("No snapshot before cycle %d" % cycle)
+        self._restore(snapshots[-1])
+        self.run(cycle)
+
+    def print_stats(self):
+        print("Replayed %d inputs up to cycle %d" % (self.num_inputs,
+              self.cycle))
+        if self.divergence:
+            print("Diverged at cycle %d: %s" % self.divergence)
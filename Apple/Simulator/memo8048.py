@@ -0,0 +1,219 @@
+'''
+    Subroutine result memoization for the MSC-48 emulator.
+
+    Many firmware subroutines are pure functions of the accumulator,
+    a few flags and a handful of RAM locations. The memoizer runs each
+    called subroutine once with RAM accesses traced to find out which
+    locations it consumes and produces. Subroutines executing instructions
+    with external side effects (port I/O, input pin tests, timer, stack
+    manipulation) are marked impure and always run normally.
+
+    Results of pure subroutines are stored in a bounded LRU cache keyed
+    on the input state. On later calls with the same inputs, the recorded
+    output state and cycle cost are applied instead of re-executing the
+    subroutine provided that neither an external event is due nor the
+    current time slice ends in the meantime.
+
+    Validation mode re-executes each hit through the interpreter and
+    compares the outcome with the cached result.
+'''
+
+from collections import OrderedDict
+
+from emu8048 import TracingRAM
+
+MAX_SUB_INSTRS = 4096 # give up recording subroutines running longer
+
+# Opcodes making a subroutine impure: bus/port/expander/external memory
+# accesses, tests of input pins and the timer flag, timer/counter and
+# interrupt control, direct PSW writes and interrupt returns.
+IMPURE_OPCODES = frozenset([0x02, 0x05, 0x08, 0x09, 0x0A, 0x15, 0x16,
+                            0x25, 0x26, 0x35, 0x36, 0x39, 0x3A, 0x42,
+                            0x45, 0x46, 0x55, 0x56, 0x62, 0x65, 0x86,
+                            0x93, 0xD7] +
+                           list(range(0x0C, 0x10)) +
+                           list(range(0x3C, 0x40)) +
+                           list(range(0x80, 0x82)) +
+                           list(range(0x88, 0x90)) +
+                           list(range(0x90, 0x92)) +
+                           list(range(0x98, 0xA0)))
+
+class _SubInfo:
+    def __init__(self):
+        self.pure = True
+        self.inputs = () # RAM locations consumed by the subroutine
+
+class _MemoEntry:
+    def __init__(self, regs, writes, cost):
+        self.regs = regs # (acc, psw, rb, mb, f0, f1) after return
+        self.writes = writes # tuple of (address, value) pairs
+        self.cost = cost # number of cycles between CALL and return
+
+    def __eq__(self, other):
+        return (self.regs == other.regs and self.writes == other.writes and
+                self.cost == other.cost)
+
+def _cpu_regs(cpu):
+    return (cpu.acc, cpu.psw, cpu.rb, cpu.mb, cpu.f0, cpu.f1)
+
+class SubroutineMemo:
+    def __init__(self, cpu_obj, max_entries=4096, validate=False):
+        self.cpu_obj = cpu_obj
+        self.max_entries = max_entries
+        self.validate = validate
+        self.subs = {} # subroutine address -> _SubInfo
+        self.cache = OrderedDict() # input state -> _MemoEntry
+        self.busy = False
+        self.hits = 0
+        self.misses = 0
+        self.deferred = 0 # hits not applied because an event was due
+        self.mismatches = 0
+        cpu_obj.set_memo(self)
+        cpu_obj.add_rom_listener(self.invalidate)
+
+    def detach(self):
+        self.cpu_obj.set_memo(None)
+        self.cpu_obj.remove_rom_listener(self.invalidate)
+
+    def set_validate(self, flag):
+        ''' Re-execute memoized calls and compare results when enabled '''
+        self.validate = flag
+
+    def invalidate(self, start=0, end=0x1000):
+        ''' Forget everything learned so far.
+            Subroutines can span several ROM regions so this
+            doesn't try to be selective about the address range.
+        '''
+        self.subs.clear()
+        self.cache.clear()
+
+    def _purge(self, target):
+        for key in [key for key in self.cache if key[0] == target]:
+            del self.cache[key]
+
+    def on_call(self, target):
+        ''' Called by the CPU right after a CALL to target.
+            Returns True if the subroutine has been executed or skipped.
+            Only calls made by exec_cycles() are handled so that single
+            stepping and exec_until() still see every instruction.
+        '''
+        if self.busy or self.cpu_obj.end_cycle is None:
+            return False # nested call within a subroutine being recorded
+        info = self.subs.get(target)
+        if info is None:
+            info = self.subs[target] = _SubInfo()
+        elif not info.pure:
+            return False
+
+        cpu = self.cpu_obj
+        ram = cpu.ram_data
+        key = (target, _cpu_regs(cpu), bytes(ram[a] for a in info.inputs))
+        entry = self.cache.get(key)
+        if entry is not None:
+            limit = cpu.next_event()
+            if limit is None or cpu.end_cycle < limit:
+                limit = cpu.end_cycle
+            if limit is None or limit >= cpu.cycles + entry.cost:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                if not self.validate:
+                    self._apply(entry)
+                    return True
+            else:
+                self.deferred += 1
+        else:
+            self.misses += 1
+
+        if cpu.post_instr_cb:
+            cpu.post_instr_cb(cpu.cycles) # finish CALL processing
+
+        self.busy = True
+        try:
+            new_entry = self._record(target, info)
+        finally:
+            self.busy = False
+
+        if entry is not None and new_entry is not None and self.validate:
+            if new_entry != entry:
+                print("Memo mismatch for subroutine at 0x%03X!" % target)
+                self.mismatches += 1
+                info.pure = False
+                self._purge(target)
+        return True
+
+    def _apply(self, entry):
+        cpu = self.cpu_obj
+        if cpu.post_instr_cb:
+            cpu.post_instr_cb(cpu.cycles) # finish CALL processing
+        ram = cpu.ram_data
+        for addr, val in entry.writes:
+            ram[addr] = val
+        ret_slot = (((cpu.psw & 7) - 1) & 7) * 2 + 8
+        cpu.pc = ((ram[ret_slot] << 8) | ram[ret_slot + 1]) & 0xFFF
+        cpu.acc, cpu.psw, cpu.rb, cpu.mb, cpu.f0, cpu.f1 = entry.regs
+        cpu.cycles += entry.cost
+        if cpu.post_instr_cb:
+            cpu.post_instr_cb(cpu.cycles)
+
+    def _record(self, target, info):
+        ''' Execute subroutine with RAM accesses traced.
+            Returns new cache entry or None if the subroutine
+            turned out to be impure or the time slice ended first.
+        '''
+        cpu = self.cpu_obj
+        ret_sp = ((cpu.psw & 7) - 1) & 7
+        ret_slot = ret_sp * 2 + 8
+        regs_before = _cpu_regs(cpu)
+        ram = cpu.ram_data
+        ram_before = bytes(ram)
+        tracer = TracingRAM(ram)
+        start_cycle = cpu.cycles
+        returned = False
+        aborted = False
+        cpu.ram_data = tracer
+        try:
+            for i in range(MAX_SUB_INSTRS):
+                if cpu.end_cycle is not None and cpu.cycles >= cpu.end_cycle:
+                    aborted = True # let exec_cycles() return in time
+                    break
+                opcode = cpu.rom_data[cpu.pc]
+                if opcode in IMPURE_OPCODES:
+                    break
+                tracer.cur_pc = cpu.pc
+                cpu.exec_single()
+                if opcode == 0x83 and (cpu.psw & 7) == ret_sp:
+                    returned = True
+                    break
+        finally:
+            ram[:] = tracer
+            cpu.ram_data = ram
+
+        if aborted:
+            return None
+        if not returned:
+            info.pure = False
+            self._purge(target)
+            return None
+
+        inputs = tracer.inputs - {ret_slot, ret_slot + 1}
+        if not inputs <= set(info.inputs):
+            # new inputs invalidate keys recorded so far
+            info.inputs = tuple(sorted(inputs | set(info.inputs)))
+            self._purge(target)
+
+        entry = _MemoEntry(_cpu_regs(cpu),
+                           tuple((a, ram[a]) for a in sorted(tracer.writes)),
+                           cpu.cycles - start_cycle)
+        key = (target, regs_before, bytes(ram_before[a] for a in info.inputs))
+        self.cache[key] = entry
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return entry
+
+    def print_stats(self):
+        num_pure = sum(1 for info in self.subs.values() if info.pure)
+        print("Memoized subroutines: %d pure of %d seen, %d cached results" %
+              (num_pure, len(self.subs), len(self.cache)))
+        print("Memo hits: %d, misses: %d, deferred: %d, mismatches: %d" % (
+              self.hits, self.misses, self.deferred, self.mismatches))
@@ -0,0 +1,169 @@
+'''
+    Runtime metrics for long-running simulations.
+
+    MetricsRegistry samples plain integer counters kept by the simulator
+    objects (scheduler, ADBSim, bridge) and turns them into a text
+    snapshot in the Prometheus exposition format. Nothing is counted
+    by the registry itself so the core loop isn't slowed down: sampling
+    takes place at slice boundaries of SimScheduler, at most once per
+    update interval.
+
+    The snapshot can be written to a file (replaced atomically) and
+    served over HTTP on localhost:
+
+    curl http://127.0.0.1:9048/metrics
+'''
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scheduler import CYCLE_TIME
+from ADB import END_REASON_NAMES
+
+DEF_UPDATE_INTERVAL = 1.0 # seconds between updates of the snapshot
+
+# metric kinds
+COUNTER = 'counter'
+GAUGE   = 'gauge'
+RATE    = 'rate' # change of the sampled value per second, exported as gauge
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.text.encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # don't clutter the console with requests
+
+class MetricsRegistry:
+    def __init__(self, interval=DEF_UPDATE_INTERVAL):
+        self.interval = interval
+        self.names = []
+        self.labels = []
+        self.kinds = []
+        self.helps = []
+        self.getters = []
+        self.scales = []
+        self.prev = [] # previous samples of RATE metrics
+        self.start_time = self.last_time = time.perf_counter()
+        self.next_update = self.start_time
+        self.snapshot_path = None
+        self.http_server = None
+        self.num_updates = 0
+        self.text = '' # last snapshot, replaced as a whole by update()
+
+    def add_metric(self, name, kind, getter, help_text, labels='',
+                   scale=1.0):
+        ''' Register a metric. getter() returns its current value.
+            labels is a Prometheus label list like 'reason="aborted"'.
+            RATE metrics report the change per second multiplied by scale.
+        '''
+        self.names.append(name)
+        self.labels.append('{%s}' % labels if labels else '')
+        self.kinds.append(kind)
+        self.helps.append(help_text)
+        self.getters.append(getter)
+        self.scales.append(scale)
+        self.prev.append(getter() if kind == RATE else 0)
+
+    def add_scheduler(self, sched):
+        ''' Register the metrics of the CPU driven by sched.
+            The registry is updated from the slice callback.
+        '''
+        cpu = sched.cpu_obj
+        self.add_metric('sim_cycles_total', COUNTER, lambda: cpu.cycles,
+                        'Machine cycles emulated')
+        self.add_metric('sim_instructions_total', COUNTER,
+                        lambda: sched.total_instrs, 'Instructions executed')
+        self.add_metric('sim_instructions_per_second', RATE,
+                        lambda: sched.total_instrs,
+                        'Instructions executed per second of real time')
+        self.add_metric('sim_speed_ratio', RATE, lambda: cpu.cycles,
+                        'Emulated time per real time', scale=CYCLE_TIME)
+        self.add_metric('sim_slips_total', COUNTER,
+                        lambda: sched.total_slips,
+                        'Times the simulation fell behind real time')
+        self.add_metric('sim_uptime_seconds', GAUGE,
+                        lambda: time.perf_counter() - self.start_time,
+                        'Seconds since the metrics registry was created')
+        sched.add_slice_cb(self.on_slice)
+
+    def add_adb(self, adb_obj):
+        for reason, name in enumerate(END_REASON_NAMES):
+            self.add_metric('adb_transactions_total', COUNTER,
+                            lambda reason=reason: adb_obj.xact_counts[reason],
+                            'ADB transactions by the way they ended',
+                            'reason="%s"' % name)
+        self.add_metric('adb_srq_total', COUNTER, lambda: adb_obj.num_srq,
+                        'ADB transactions with a service request')
+
+    def set_snapshot_file(self, path):
+        ''' Write each snapshot to path '''
+        self.snapshot_path = path
+
+    def start_http(self, port, host='127.0.0.1'):
+        ''' Serve the last snapshot over HTTP from a background thread '''
+        self.http_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self.http_server.registry = self
+        thread = threading.Thread(target=self.http_server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        print("Metrics available at http://%s:%d/metrics" % (host, port))
+
+    def stop_http(self):
+        if self.http_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+    def on_slice(self, cycles):
+        ''' Slice callback of SimScheduler '''
+        if time.perf_counter() >= self.next_update:
+            self.update()
+
+    def update(self):
+        ''' Sample all metrics and export a new snapshot '''
+        now = time.perf_counter()
+        elapsed = now - self.last_time
+        self.last_time = now
+        self.next_update = now + self.interval
+
+        lines = []
+        prev_name = None
+        for i, name in enumerate(self.names):
+            val = self.getters[i]()
+            kind = self.kinds[i]
+            if kind == RATE:
+                delta = val - self.prev[i]
+                self.prev[i] = val
+                val = delta * self.scales[i] / elapsed if elapsed > 0 else 0.0
+                kind = GAUGE
+            if name != prev_name:
+                lines.append('# HELP %s %s' % (name, self.helps[i]))
+                lines.append('# TYPE %s %s' % (name, kind))
+                prev_name = name
+            if isinstance(val, float):
+                lines.append('%s%s %.6g' % (name, self.labels[i], val))
+            else:
+                lines.append('%s%s %d' % (name, self.labels[i], val))
+        self.text = '\n'.join(lines) + '\n'
+        self.num_updates += 1
+
+        if self.snapshot_path:
+            tmp_path = self.snapshot_path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as out_file:
+                    out_file.write(self.text)
+                os.replace(tmp_path, self.snapshot_path)
+            except OSError as e:
+                print("Writing metrics to %s failed: %s" % (
+                      self.snapshot_path, e))
@@ -0,0 +1,80 @@
+'''
+    Hot reloading of firmware into a running MSC-48 simulation.
+
+    RomWatcher polls the modification time of a ROM image or of an
+    assembly source file. When the file changes, the new code is
+    compared with the ROM of the running CPU and only the changed
+    bytes are patched in. CPU and ADB state are kept.
+
+    Sources are assembled with Asm8048. Its section cache keeps
+    reassembly fast. Addresses not covered by the source keep their
+    current contents.
+'''
+
+import os
+import time
+
+POLL_INTERVAL = 0.25 # min. seconds between checks of the file
+
+class RomWatcher:
+    def __init__(self, cpu_obj, path, is_source=False):
+        self.cpu_obj = cpu_obj
+        self.path = path
+        self.is_source = is_source
+        self.asm = None # created by the first reload of a source
+        self.mtime = self._get_mtime()
+        self.last_poll = 0.0
+        self.num_reloads = 0
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None # the file may be temporarily gone while saving
+
+    def poll(self, cycles=None):
+        ''' Reload the file if it has changed since the last check.
+            Can be used as a slice callback of SimScheduler.
+        '''
+        now = time.perf_counter()
+        if now - self.last_poll < POLL_INTERVAL:
+            return
+        self.last_poll = now
+        mtime = self._get_mtime()
+        if mtime is not None and mtime != self.mtime:
+            self.mtime = mtime
+            self.reload()
+
+    def reload(self):
+        ''' Load the file and apply the changes.
+            Returns the list of (start, end) ranges changed or None
+            if the file couldn't be loaded.
+        '''
+        cpu = self.cpu_obj
+        try:
+            if self.is_source:
+                if self.asm is None:
+                    # not imported above: startup may get the assembled
+                    # source from the ROM cache
+                    from asm8048 import Asm8048
+                    self.asm = Asm8048(cpu.rom_size)
+                result = self.asm.assemble_file(self.path)
+                result.fill_from(cpu.rom_data)
+                rom_data = result.image
+            else:
+                with open(self.path, 'rb') as rom_file:
+                    rom_data = rom_file.read()
+            ranges = cpu.reload_rom(rom_data)
+        except (OSError, ValueError) as e: # AsmError is a ValueError
+            print("Reloading %s failed: %s" % (self.path, e))
+            return None
+
+        self.num_reloads += 1
+        if ranges:
+            print("Reloaded %s, %d bytes changed:" % (self.path,
+                  sum(end - start for start, end in ranges)))
+            for start, end in ranges:
+                print("    0x%03X...0x%03X" % (start, end - 1))
+        else:
+            print("Reloaded %s, no changes" % self.path)
+        return ranges
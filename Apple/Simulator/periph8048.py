@@ -0,0 +1,90 @@
+'''
+    External bus peripherals for the MSC-48 emulator.
+
+    Expander8243 models an Intel 8243 I/O expander connected to the
+    lower half of port 2 and PROG. It provides the 4-bit ports 4...7
+    accessed with MOVD, ORLD and ANLD.
+
+    ExternalRAM models a byte-wide memory accessed with MOVX.
+
+    Both hook themselves into the port and external memory dispatch
+    tables of MSC48_CPU so that the emulator itself doesn't need any
+    device specific code.
+'''
+
+from functools import partial
+
+EXP_FIRST_PORT = 4 # number of the first expander port
+EXP_NUM_PORTS  = 4
+
+class Expander8243:
+    def __init__(self):
+        self.latches = [0] * EXP_NUM_PORTS # output latches
+        self.drive = [False] * EXP_NUM_PORTS # port driven by its latch
+        self.inputs = [0xF] * EXP_NUM_PORTS # external pin levels
+        self.output_cbs = []
+
+    def attach(self, cpu_obj):
+        for port in range(EXP_FIRST_PORT, EXP_FIRST_PORT + EXP_NUM_PORTS):
+            cpu_obj.set_port_handlers(port, partial(self.read, port),
+                                      partial(self.write, port),
+                                      partial(self.read_latch, port))
+        cpu_obj.add_device(self)
+
+    def add_output_cb(self, cb):
+        ''' cb(port, val) will be called each time a port is written '''
+        self.output_cbs.append(cb)
+
+    def set_input(self, port, val):
+        ''' Set the level of the pins of a port driven from outside '''
+        self.inputs[port - EXP_FIRST_PORT] = val & 0xF
+
+    def get_output(self, port):
+        ''' Return the port value or None if the port is floating '''
+        idx = port - EXP_FIRST_PORT
+        return self.latches[idx] if self.drive[idx] else None
+
+    def read(self, port):
+        ''' MOVD A,Pp turns the port into an input '''
+        idx = port - EXP_FIRST_PORT
+        self.drive[idx] = False
+        return self.inputs[idx]
+
+    def read_latch(self, port):
+        return self.latches[port - EXP_FIRST_PORT]
+
+    def write(self, port, val):
+        idx = port - EXP_FIRST_PORT
+        self.latches[idx] = val & 0xF
+        self.drive[idx] = True
+        for cb in self.output_cbs:
+            cb(port, val & 0xF)
+
+    def save_state(self):
+        return (tuple(self.latches), tuple(self.drive))
+
+    def restore_state(self, state):
+        latches, drive = state
+        self.latches[:] = latches
+        self.drive[:] = drive
+
+class ExternalRAM:
+    def __init__(self, size=256):
+        self.data = bytearray(size)
+        self.size = size
+
+    def attach(self, cpu_obj):
+        cpu_obj.set_ext_mem(self.read, self.write)
+        cpu_obj.add_device(self)
+
+    def read(self, addr):
+        return self.data[addr % self.size]
+
+    def write(self, addr, val):
+        self.data[addr % self.size] = val
+
+    def save_state(self):
+        return bytes(self.data)
+
+    def restore_state(self, state):
+        self.data[:] = state
@@ -0,0 +1,195 @@
+'''
+    Persistent cache of data derived from an MSC-48 ROM image.
+
+    When a source listing is used, AK_sim reassembles it at each start
+    to get the ROM image and the labels. RomCache stores both in a file
+    named after the SHA-256 of the ROM and of the source listing so
+    a warm start just maps that file into memory.
+
+    The tables consist of fixed-size records in native byte order and
+    are accessed through memoryviews of the mapping without unpacking:
+     - LADR: u16 label addresses (sorted), LOFF: u32 offsets in LTXT,
+     - IMAG: ROM image assembled from the source listing.
+
+    Instructions aren't cached: decoding them is cheap and the ROM can
+    be patched at run time.
+
+    Usage:
+    python3 romcache8048.py --rom_path=[ROM] --src=[ASM] [--labels]
+'''
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+CACHE_MAGIC = b'AKRC'
+CACHE_VERSION = 3
+HEADER_FORMAT = '=4sHHcxxx32s32sI' # magic, version, sections, byte order,
+                                   # ROM SHA-256, source SHA-256, ROM size
+DIR_FORMAT = '=4sII' # tag, offset, length
+
+def default_cache_dir():
+    return os.environ.get('AK_CACHE_DIR', os.path.join(
+        os.path.expanduser('~'), '.cache', 'ak_sim'))
+
+def _pack_strings(strings):
+    ''' Return (u32 offsets incl. the end of the last string, blob) '''
+    offsets = array('I', [0])
+    blob = bytearray()
+    for s in strings:
+        blob += s.encode('utf-8')
+        offsets.append(len(blob))
+    return offsets.tobytes(), bytes(blob)
+
+def build_cache(rom_data, rom_sha, src_sha, image, labels):
+    ''' Compute all tables and return the contents of a cache file '''
+    rom_size = len(rom_data)
+    labels = sorted((addr, name) for name, addr in labels.items()
+                    if 0 <= addr < rom_size)
+    loff, ltxt = _pack_strings(name for addr, name in labels)
+
+    sections = [(b'LADR', array('H', [a for a, n in labels]).tobytes()),
+                (b'LOFF', loff), (b'LTXT', ltxt), (b'IMAG', bytes(image))]
+
+    header_size = struct.calcsize(HEADER_FORMAT)
+    pos = header_size + struct.calcsize(DIR_FORMAT) * len(sections)
+    directory = bytearray()
+    body = bytearray()
+    for tag, data in sections:
+        pad = -(pos + len(body)) % 4 # keep tables aligned
+        body += bytes(pad)
+        directory += struct.pack(DIR_FORMAT, tag, pos + len(body), len(data))
+        body += data
+    byte_order = b'<' if sys.byteorder == 'little' else b'>'
+    header = struct.pack(HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION,
+                         len(sections), byte_order, rom_sha, src_sha,
+                         rom_size)
+    return header + directory + body
+
+class RomCache:
+    def __init__(self, data):
+        ''' data is a mmap or bytes object holding a cache file '''
+        self.data = data
+        mv = memoryview(data)
+        header_size = struct.calcsize(HEADER_FORMAT)
+        magic, version, num_sections, byte_order, self.rom_sha, \
+            self.src_sha, self.rom_size = struct.unpack_from(HEADER_FORMAT,
+                                                             mv)
+        native = b'<' if sys.byteorder == 'little' else b'>'
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or \
+           byte_order != native:
+            raise ValueError("Incompatible ROM cache")
+        sect = {}
+        for i in range(num_sections):
+            tag, offset, length = struct.unpack_from(DIR_FORMAT, mv,
+                header_size + i * struct.calcsize(DIR_FORMAT))
+            if offset + length > len(mv):
+                raise ValueError("Truncated ROM cache")
+            sect[tag] = mv[offset:offset + length]
+        ladr, loff = sect[b'LADR'], sect[b'LOFF']
+        if len(ladr) % 2 or len(loff) != (len(ladr) // 2 + 1) * 4:
+            raise ValueError("Corrupted ROM cache")
+        self.label_addrs = ladr.cast('H')
+        self.label_offs = loff.cast('I')
+        self.label_text = sect[b'LTXT']
+        self.image = sect[b'IMAG']
+        if self.label_offs[-1] != len(self.label_text) or \
+           len(self.image) != self.rom_size:
+            raise ValueError("Corrupted ROM cache")
+        self.label_dict = None # name -> address, built on first lookup
+
+    def _label_index(self, addr):
+        lo, hi = 0, len(self.label_addrs)
+        while lo < hi: # binary search in the mapped table
+            mid = (lo + hi) // 2
+            if self.label_addrs[mid] < addr:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def label_at(self, addr):
+        ''' Return the name of the label at addr or None '''
+        idx = self._label_index(addr)
+        if idx < len(self.label_addrs) and self.label_addrs[idx] == addr:
+            return str(self.label_text[self.label_offs[idx]:
+                                       self.label_offs[idx + 1]], 'utf-8')
+        return None
+
+    def find_label(self, name):
+        ''' Return the address of a label or None '''
+        if self.label_dict is None:
+            self.label_dict = {}
+            for idx, addr in enumerate(self.label_addrs):
+                self.label_dict[str(self.label_text[self.label_offs[idx]:
+                    self.label_offs[idx + 1]], 'utf-8')] = addr
+        return self.label_dict.get(name)
+
+def _sha256(data):
+    return hashlib.sha256(data).digest()
+
+def load_cache(rom_data, src_path, cache_dir=None):
+    ''' Return the RomCache for rom_data and the source listing assembled
+        over it. It's built and saved to cache_dir if it doesn't exist yet.
+    '''
+    rom_sha = _sha256(rom_data)
+    with open(src_path, 'rb') as src_file:
+        src_sha = _sha256(src_file.read())
+    cache_dir = cache_dir or default_cache_dir()
+    name = rom_sha.hex() + '-' + src_sha.hex()[:16]
+    path = os.path.join(cache_dir, name + '.akc')
+
+    try:
+        with open(path, 'rb') as cache_file:
+            cache = RomCache(mmap.mmap(cache_file.fileno(), 0,
+                                       access=mmap.ACCESS_READ))
+        if cache.rom_sha == rom_sha and cache.src_sha == src_sha:
+            return cache
+    except (OSError, ValueError, TypeError, struct.error, KeyError):
+        pass # missing or stale, rebuild it
+
+    from asm8048 import Asm8048 # only needed on a cache miss
+    result = Asm8048(len(rom_data)).assemble_file(src_path)
+    result.fill_from(rom_data)
+    data = build_cache(rom_data, rom_sha, src_sha, result.image,
+                       result.labels)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print("Can't save ROM cache to %s: %s" % (path, e))
+    return RomCache(data)
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('--rom_path', type=str, dest='rom_path',
+                        help='path to 8048/8049 ROM file',
+                        metavar='ROM_PATH', required=True)
+    parser.add_argument('--src', type=str, dest='src_path',
+                        help='source listing providing labels',
+                        metavar='SRC_PATH', required=True)
+    parser.add_argument('--cache-dir', type=str, dest='cache_dir',
+                        help='cache directory (default: %s)' %
+                        default_cache_dir())
+    parser.add_argument('--labels', action='store_true',
+                        help='print the label index')
+
+    opts = parser.parse_args()
+
+    with open(opts.rom_path, 'rb') as rom_file:
+        rom_data = rom_file.read()
+
+    cache = load_cache(rom_data, opts.src_path, opts.cache_dir)
+    print("ROM SHA-256: %s" % cache.rom_sha.hex())
+    print("Labels: %d" % len(cache.label_addrs))
+    if opts.labels:
+        for idx, addr in enumerate(cache.label_addrs):
+            print("0x%03X  %s" % (addr, cache.label_at(addr)))
@@ -0,0 +1,141 @@
+'''
+    Cycle-driven scheduler for the MSC-48 simulator.
+
+    The CPU is always advanced in coarse slices of machine cycles so
+    that the simulation stays deterministic regardless of the run mode:
+     - unthrottled: slices are executed back to back,
+     - paced: simulated time is kept in sync with wall clock time
+       (or N times real time) by sleeping between slices.
+
+    Host time is never consulted inside a slice. No per-instruction
+    sleeping takes place.
+'''
+
+import time
+
+CYCLE_TIME = 2.5e-6 # duration of one machine cycle in seconds
+
+class SimScheduler:
+    def __init__(self, cpu_obj, slice_cycles=4000):
+        self.cpu_obj = cpu_obj
+        self.slice_cycles = slice_cycles # cycles executed between resyncs
+        self.speed = 0.0 # 0 - unthrottled, N - N times real time
+        self.max_lag = 0.1 # max. lag behind wall clock before slipping
+        self.slice_cbs = []
+        self.stop_req = False
+        self.total_instrs = 0 # instructions executed by this scheduler
+        self.total_slips = 0
+        self.start()
+
+    def set_speed(self, speed):
+        ''' Set pacing factor: 0 - run unthrottled,
+            1.0 - real time, N - N times real time.
+        '''
+        self.speed = float(speed)
+        self.start()
+
+    def set_slice_cycles(self, num_cycles):
+        self.slice_cycles = max(1, num_cycles)
+
+    def add_slice_cb(self, cb):
+        ''' Register a callback invoked at each slice boundary.
+            It receives the current cycle count.
+        '''
+        self.slice_cbs.append(cb)
+
+    def stop(self):
+        ''' Request the current run to stop at the next slice boundary '''
+        self.stop_req = True
+
+    def start(self):
+        ''' Establish a new reference point between
+            simulated and wall clock time.
+        '''
+        self.ref_cycles = self.cpu_obj.cycles
+        self.ref_time = time.perf_counter()
+        self.run_start = self.ref_time
+        self.run_cycles = 0 # cycles executed since start()
+        self.run_instrs = 0 # instructions executed since start()
+        self.run_time = 0.0 # wall clock time elapsed since start()
+        self.drift = 0.0 # wall clock minus simulated time, in seconds
+        self.max_drift = 0.0 # worst lag behind wall clock
+        self.slips = 0 # number of times real time couldn't be kept up
+
+    def run_slice(self, max_cycles=None):
+        ''' Execute a single slice of cycles.
+            Returns the amount of seconds simulation is ahead
+            of the wall clock, i.e. how long the caller should sleep
+            before running the next slice (always 0 when unthrottled).
+        '''
+        cpu = self.cpu_obj
+        num_cycles = self.slice_cycles
+        if max_cycles is not None and max_cycles < num_cycles:
+            num_cycles = max_cycles
+        start_cyc = cpu.cycles
+        num_instrs = cpu.exec_cycles(num_cycles)
+        self.run_instrs += num_instrs
+        self.total_instrs += num_instrs
+        self.run_cycles += cpu.cycles - start_cyc
+
+        for cb in self.slice_cbs:
+            cb(cpu.cycles)
+
+        now = time.perf_counter()
+        self.run_time = now - self.run_start
+
+        if not self.speed:
+            return 0.0
+
+        sim_time = (cpu.cycles - self.ref_cycles) * CYCLE_TIME / self.speed
+        self.drift = (now - self.ref_time) - sim_time
+        if self.drift > self.max_drift:
+            self.max_drift = self.drift
+        if self.drift > self.max_lag:
+            # host is too slow or was stalled: don't try to catch up
+            # with a burst of unpaced slices, rebase the reference instead
+            self.slips += 1
+            self.total_slips += 1
+            self.ref_cycles = cpu.cycles
+            self.ref_time = now
+            self.drift = 0.0
+        return max(0.0, -self.drift)
+
+    def run(self, num_cycles=None):
+        ''' Run num_cycles machine cycles or until stop() is called.
+            Returns the number of cycles executed.
+        '''
+        cpu = self.cpu_obj
+        end_cycle = None if num_cycles is None else cpu.cycles + num_cycles
+        self.stop_req = False
+        self.start()
+
+        while not self.stop_req:
+            if end_cycle is not None:
+                if cpu.cycles >= end_cycle:
+                    break
+                delay = self.run_slice(end_cycle - cpu.cycles)
+            else:
+                delay = self.run_slice()
+            if delay > 0:
+                time.sleep(delay)
+
+        self.run_time = time.perf_counter() - self.run_start
+        return self.run_cycles
+
+    def get_speed_factor(self):
+        ''' Achieved ratio of simulated time to wall clock time '''
+        if self.run_time <= 0:
+            return 0.0
+        return self.run_cycles * CYCLE_TIME / self.run_time
+
+    def print_report(self):
+        sim_time = self.run_cycles * CYCLE_TIME
+        print("Cycles executed: %d (%d instructions)" % (self.run_cycles,
+              self.run_instrs))
+        print("Simulated time: %f secs, wall time: %f secs" % (sim_time,
+              self.run_time))
+        print("Achieved speed: %.2fx real time" % self.get_speed_factor())
+        if self.speed:
+            print("Target speed: %.2fx real time" % self.speed)
+            print("Drift: %.3f ms, max. lag: %.3f ms, slips: %d" %
+                  (self.drift * 1000, self.max_drift * 1000, self.slips))
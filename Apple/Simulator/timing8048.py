@@ -0,0 +1,491 @@
+'''
+    Static cycle timing analyzer for MSC-48 firmware.
+
+    Computes best and worst case cycle counts of all paths between
+    two ROM addresses without running the firmware.
+
+    Instruction timing and jump targets are obtained by probing the
+    emulator core (MSC48_CPU.exec_single) so the analysis always agrees
+    with the simulator. The control flow graph is expanded per call stack:
+    CALL enters the callee and RET goes back to the right caller.
+
+    Loops need an iteration bound. DJNZ loops whose counter is loaded
+    by MOV Rn,#imm right before the loop are bounded automatically,
+    other bounds have to be specified by the user.
+
+    Paths are measured from the start of the first instruction
+    to the start of the last one. Port writes take effect at the end of
+    the instruction so that the time between two port writes of equal
+    length is measured correctly.
+
+    Without --path, the built-in ADB timing checks for 341-0731A are run
+    against the budgets of the ADB bus simulator.
+
+    Usage:
+    python3 timing8048.py --rom_path=[ROM]
+    python3 timing8048.py --rom_path=[ROM] --path 0x577 0x58B --avoid 0x5DC
+'''
+
+import contextlib
+import io
+
+from dasm8048 import is_cond_jump
+from emu8048 import MSC48_CPU
+import ADB
+from scheduler import CYCLE_TIME
+
+MAX_STACK = 8 # depth of the MSC-48 hardware stack
+MAX_NODES = 200000 # give up on larger expanded control flow graphs
+MAX_INIT_SEARCH = 64 # max. instructions searched for a loop counter init
+
+# instruction kinds
+K_SEQ  = 0 # falls through to the next instruction
+K_JMP  = 1
+K_COND = 2 # conditional jump incl. DJNZ
+K_CALL = 3
+K_RET  = 4
+K_JMPP = 5 # indirect jump
+K_PSW  = 6 # MOV PSW,A, assumed to unwind the stack
+
+END = ('end',) # sink node representing the end address
+
+def _writes_reg(opcode, reg_num):
+    ''' Check if opcode may change register reg_num of the current bank
+        or select another bank.
+    '''
+    if (opcode & 0xF8) in (0x18, 0x28, 0xA8, 0xB8, 0xC8, 0xE8):
+        return (opcode & 7) == reg_num
+    # indirect writes, bank switching, PSW writes
+    return ((opcode & 0xFE) in (0x10, 0x20, 0x30, 0xA0, 0xB0) or
+            opcode in (0xC5, 0xD5, 0xD7))
+
+def _tarjan(nodes, succ):
+    ''' Iterative Tarjan's algorithm. Returns the list of strongly
+        connected components in reverse topological order.
+    '''
+    index = {}
+    low = {}
+    on_stack = set()
+    stack = []
+    sccs = []
+    counter = 0
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(succ(root)))]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            v, it = work[-1]
+            for w in it:
+                if w not in index:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, iter(succ(w))))
+                    break
+                elif w in on_stack:
+                    low[v] = min(low[v], index[w])
+            else:
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[v])
+                if low[v] == index[v]:
+                    scc = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        scc.append(w)
+                        if w == v:
+                            break
+                    sccs.append(scc)
+    return sccs
+
+class PathTiming:
+    def __init__(self, best, worst):
+        self.best = best # None if end isn't reachable
+        self.worst = worst # None if unbounded or unreachable
+        self.unbounded = set() # headers of loops without iteration bound
+        self.warnings = set()
+
+class TimingAnalyzer:
+    def __init__(self, rom_data):
+        self.rom_data = rom_data
+        self.instrs = {} # addr -> (cycles, kind, targets)
+        self.warnings = {} # addr -> message
+        self.cpu = MSC48_CPU(len(rom_data))
+        self.cpu.set_verbose(False)
+        self.cpu.set_rom_data(rom_data, len(rom_data))
+
+    def _probe(self, addr):
+        ''' Execute the instruction at addr on a scratch CPU.
+            Returns (cycles, next_pc, log output).
+        '''
+        cpu = self.cpu
+        cpu.pc = addr
+        cpu.cycles = 0
+        cpu.psw = 8
+        cpu.rb = 0
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            cpu.exec_single()
+        return cpu.cycles, cpu.pc, out.getvalue()
+
+    def decode(self, addr):
+        ''' Return (cycles, kind, targets) of the instruction at addr '''
+        if addr in self.instrs:
+            return self.instrs[addr]
+        rom = self.rom_data
+        opcode = rom[addr]
+        cycles, next_pc, log = self._probe(addr)
+        if log:
+            self.warnings[addr] = log.strip()
+        if is_cond_jump(opcode):
+            if (opcode & 0xF8) == 0xE8: # DJNZ
+                fall = addr + 2
+            else: # fall-through wraps around within the page
+                fall = ((addr + 1) & ~0xFF) | ((addr + 2) & 0xFF)
+            info = (cycles, K_COND, (((addr + 1) & ~0xFF) | rom[addr + 1],
+                                     fall))
+        elif (opcode & 0x1F) == 0x14 and next_pc != addr + 2:
+            info = (cycles, K_CALL, (next_pc, addr + 2))
+        elif (opcode & 0x1F) == 4:
+            info = (cycles, K_JMP, (next_pc,))
+        elif opcode in (0x83, 0x93):
+            info = (cycles, K_RET, ())
+        elif opcode == 0xB3:
+            info = (cycles, K_JMPP, self._jmpp_targets(addr))
+        elif opcode == 0xD7:
+            info = (cycles, K_PSW, (next_pc,))
+        else:
+            info = (cycles, K_SEQ, (next_pc,))
+        self.instrs[addr] = info
+        return info
+
+    def _jmpp_targets(self, addr):
+        ''' Resolve JMPP @A preceded by ANL A,#mask '''
+        rom = self.rom_data
+        page = (addr + 1) & 0xF00
+        if addr >= 2 and rom[addr - 2] == 0x53:
+            mask = rom[addr - 1]
+            return tuple(sorted(set(page | rom[page | a] for a in range(256)
+                                    if (a & ~mask) == 0)))
+        self.warnings[addr] = "Unresolved indirect jump"
+        return ()
+
+    def _successors(self, node):
+        ''' Nodes are (address, return address stack, MB latch) '''
+        addr, stack, mb = node
+        cycles, kind, targets = self.decode(addr)
+        if kind == K_CALL:
+            if len(stack) >= MAX_STACK:
+                self.warnings[addr] = "Stack overflow"
+                return []
+            return [((targets[0] & 0x7FF) | (mb << 11), stack + (targets[1],),
+                     mb)]
+        elif kind == K_JMP:
+            return [((targets[0] & 0x7FF) | (mb << 11), stack, mb)]
+        elif kind == K_RET:
+            # returning from the function the path started in ends the path
+            return [(stack[-1], stack[:-1], mb)] if stack else []
+        elif kind == K_PSW:
+            return [(targets[0], (), mb)]
+        elif self.rom_data[addr] in (0xE5, 0xF5): # SEL MB0/MB1
+            mb = (self.rom_data[addr] >> 4) & 1
+        return [(t, stack, mb) for t in targets if t < len(self.rom_data)]
+
+    def analyze(self, start, end, avoid=(), bounds=None):
+        ''' Compute best/worst case number of cycles between the start
+            of the instruction at start and the start of the instruction
+            at end. Paths are measured from the last execution of start,
+            i.e. they never return to start. Paths through addresses
+            in avoid are ignored. The memory bank latch is assumed to
+            select the bank containing start.
+            bounds maps addresses of loop headers or loop branches
+            to the max. number of loop iterations.
+        '''
+        bounds = bounds or {}
+        src = (start, (), start >> 11)
+        succs = {}
+        preds = {}
+        todo = [src]
+        while todo:
+            node = todo.pop()
+            out = []
+            for nxt in self._successors(node):
+                if nxt[0] == end:
+                    nxt = END
+                elif nxt[0] in avoid or nxt == src:
+                    continue
+                out.append(nxt)
+                preds.setdefault(nxt, []).append(node)
+                if nxt not in succs and nxt is not END:
+                    succs[nxt] = None
+                    todo.append(nxt)
+            succs[node] = out
+            if len(succs) > MAX_NODES:
+                raise RuntimeError("Control flow graph too large")
+        succs[END] = []
+
+        result = PathTiming(None, None)
+        result.warnings = set("0x%03X: %s" % (addr, msg) for addr, msg in
+                              self.warnings.items()
+                              if any(n[0] == addr for n in succs if n != END))
+        if END not in preds:
+            return result
+
+        # restrict the graph to nodes lying on a path to the end
+        region = {END}
+        todo = [END]
+        while todo:
+            for p in preds.get(todo.pop(), []):
+                if p not in region:
+                    region.add(p)
+                    todo.append(p)
+
+        def succ(v):
+            return [w for w in succs[v] if w in region]
+
+        arr = self._solve(region, src, succ, preds, bounds, result)
+        result.best, result.worst = arr[END]
+        return result
+
+    def _cost(self, node):
+        return 0 if node is END else self.decode(node[0])[0]
+
+    def _solve(self, nodes, src, succ, preds, bounds, result):
+        ''' Compute earliest/latest arrival times relative to src
+            for all nodes of a graph that may contain loops.
+        '''
+        arr = {src: (0, 0)}
+
+        def merge(w, best, worst):
+            if w in arr:
+                b, wc = arr[w]
+                best = min(b, best)
+                worst = None if worst is None or wc is None else max(wc, worst)
+            arr[w] = (best, worst)
+
+        def propagate(v, inside):
+            best, worst = arr[v]
+            cost = self._cost(v)
+            for w in succ(v):
+                if w not in inside and w != src:
+                    merge(w, best + cost, None if worst is None else
+                          worst + cost)
+
+        sub_succ = lambda v: [w for w in succ(v) if w in nodes and w != src]
+        for scc in reversed(_tarjan([src], sub_succ)):
+            if len(scc) == 1 and scc[0] not in sub_succ(scc[0]):
+                if scc[0] in arr:
+                    propagate(scc[0], ())
+                continue
+
+            inside = set(scc)
+            headers = [v for v in scc if v in arr]
+            if len(headers) != 1:
+                # irreducible loop, only the best case can be estimated
+                result.unbounded.update(v[0] for v in headers)
+                for v in scc:
+                    if v not in arr:
+                        arr[v] = (min(b for b, w in arr.values()), None)
+                    arr[v] = (arr[v][0], None)
+                for v in scc:
+                    propagate(v, inside)
+                continue
+
+            head = headers[0]
+            body_succ = lambda v: [w for w in succ(v) if w in inside]
+            inner = self._solve(inside, head, body_succ, preds, bounds,
+                                result)
+            back = [v for v in scc if head in succ(v)]
+            iter_best = min(inner[v][0] + self._cost(v) for v in back)
+            iter_worst = [inner[v][1] for v in back]
+            if None in iter_worst:
+                iter_worst = None
+            else:
+                iter_worst = max(w + self._cost(v) for v, w in
+                                 zip(back, iter_worst))
+
+            count, exact = self._loop_bound(head, back, inside, succ, preds,
+                                            bounds)
+            if count is None:
+                result.unbounded.add(head[0])
+            min_count = count if exact else 1
+            h_best, h_worst = arr[head]
+            for v in scc:
+                best = h_best + (min_count - 1) * iter_best + inner[v][0]
+                if count is None or None in (h_worst, iter_worst, inner[v][1]):
+                    worst = None
+                else:
+                    worst = h_worst + (count - 1) * iter_worst + inner[v][1]
+                arr[v] = (best, worst)
+            for v in scc:
+                propagate(v, inside)
+        return arr
+
+    def _loop_bound(self, head, back, inside, succ, preds, bounds):
+        ''' Return (max. number of loop iterations, exact) or (None, False)
+            if the loop is unbounded.
+        '''
+        for addr in [head[0]] + [v[0] for v in back]:
+            if addr in bounds:
+                return bounds[addr], False
+        if len(back) != 1:
+            return None, False
+        branch = back[0]
+        opcode = self.rom_data[branch[0]]
+        if (opcode & 0xF8) != 0xE8: # DJNZ
+            return None, False
+        init = self._find_init(head, opcode & 7, inside, preds)
+        if init is None:
+            return None, False
+        # the iteration count is exact if DJNZ is the only way out
+        exact = all(w in inside for v in inside if v != branch
+                    for w in succ(v))
+        return init or 256, exact
+
+    def _find_init(self, head, reg_num, inside, preds):
+        ''' Find MOV Rn,#imm loading the loop counter before the loop '''
+        node = head
+        for i in range(MAX_INIT_SEARCH):
+            outside = [p for p in preds.get(node, []) if p not in inside]
+            if len(outside) != 1:
+                return None
+            node = outside[0]
+            inside = ()
+            opcode = self.rom_data[node[0]]
+            if opcode == 0xB8 | reg_num: # MOV Rn,#imm
+                return self.rom_data[node[0] + 1]
+            if _writes_reg(opcode, reg_num):
+                return None
+        return None
+
+# ADB timing checks for 341-0731A: (description, start, end, min, max, poll)
+# min/max are in cycles, taken from the budgets of the ADB simulator.
+# poll=True means start is a T1 polling loop whose period is added
+# to the worst case.
+MAIN_LOOP_0731A  = 0x04D
+ABORT_XMIT_0731A = 0x5DC
+
+ADB_CHECKS_0731A = [
+    ("Tlt: T1 rising edge to Talk start bit", 0x44B, 0x577,
+     ADB.ADB_TLT_CYCLES, ADB.ADB_TLT_CYCLES + ADB.ADB_TALK_TIMEOUT, True),
+    ("Start bit: low phase", 0x577, 0x57D, 0, ADB.ADB_BIT1_LOW, False),
+    ("Start bit: cell", 0x577, 0x58B, ADB.ADB_MIN_CELL, ADB.ADB_MAX_CELL,
+     False),
+    ("MSB bits: cell", 0x58B, 0x58B, ADB.ADB_MIN_CELL, ADB.ADB_MAX_CELL,
+     False),
+    ("MSB bits: '1' low phase", 0x58B, 0x5CA, 0, ADB.ADB_BIT1_LOW, False),
+    ("MSB bits: '0' low phase", 0x58B, 0x598, ADB.ADB_BIT1_LOW + 1,
+     ADB.ADB_MAX_CELL, False),
+    ("MSB to LSB: cell", 0x58B, 0x5AA, ADB.ADB_MIN_CELL, ADB.ADB_MAX_CELL,
+     False),
+    ("LSB bits: cell", 0x5AA, 0x5AA, ADB.ADB_MIN_CELL, ADB.ADB_MAX_CELL,
+     False),
+    ("LSB bits: '1' low phase", 0x5AA, 0x5D3, 0, ADB.ADB_BIT1_LOW, False),
+    ("LSB bits: '0' low phase", 0x5AA, 0x5B7, ADB.ADB_BIT1_LOW + 1,
+     ADB.ADB_MAX_CELL, False),
+    ("Last data bit to stop bit: cell", 0x5AA, 0x5BD, ADB.ADB_MIN_CELL,
+     ADB.ADB_MAX_CELL, False),
+    ("Stop bit: low phase", 0x5BD, 0x5C3, ADB.ADB_BIT1_LOW + 1,
+     ADB.ADB_MAX_CELL, False),
+]
+
+def poll_period(analyzer, addr):
+    ''' Return the period of a polling loop consisting of a conditional
+        jump at addr followed by a jump back to addr.
+    '''
+    cycles, kind, targets = analyzer.decode(addr)
+    if kind == K_COND:
+        next_cycles, next_kind, next_targets = analyzer.decode(targets[1])
+        if addr in next_targets:
+            return cycles + next_cycles
+    raise ValueError("No polling loop at 0x%03X" % addr)
+
+def format_cycles(cycles):
+    if cycles is None:
+        return "unbounded"
+    return "%d cycles (%.1f usecs)" % (cycles, cycles * CYCLE_TIME * 1e6)
+
+def run_checks(analyzer, checks, avoid=(), bounds=None):
+    ''' Run timing checks and print results.
+        Returns the number of violations.
+    '''
+    violations = 0
+    for desc, start, end, min_cyc, max_cyc, poll in checks:
+        timing = analyzer.analyze(start, end, avoid, bounds)
+        worst = timing.worst
+        if poll and worst is not None:
+            worst += poll_period(analyzer, start)
+        print("%s (0x%03X -> 0x%03X):" % (desc, start, end))
+        if timing.best is None:
+            print("    no path found")
+            violations += 1
+            continue
+        print("    best: %s, worst: %s" % (format_cycles(timing.best),
+                                           format_cycles(worst)))
+        print("    budget: %d...%d cycles" % (min_cyc, max_cyc))
+        for addr in sorted(timing.unbounded):
+            print("    unbounded loop at 0x%03X" % addr)
+        for msg in sorted(timing.warnings):
+            print("    warning: %s" % msg)
+        if timing.best < min_cyc or worst is None or worst > max_cyc:
+            print("    VIOLATION")
+            violations += 1
+    return violations
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import sys
+
+    def parse_bound(s):
+        addr, count = s.split('=')
+        return int(addr, 0), int(count, 0)
+
+    parser = ArgumentParser()
+    parser.add_argument('--rom_path', type=str, dest='rom_path',
+                        help='path to 8048/8049 ROM file',
+                        metavar='ROM_PATH', required=True)
+    parser.add_argument('--path', nargs=2, action='append',
+                        type=lambda s: int(s, 0), metavar=('START', 'END'),
+                        help='print timing of paths between START and END')
+    parser.add_argument('--avoid', action='append', default=[],
+                        type=lambda s: int(s, 0), metavar='ADDR',
+                        help='ignore paths through ADDR')
+    parser.add_argument('--bound', action='append', default=[],
+                        type=parse_bound, metavar='ADDR=N',
+                        help='max. iterations of the loop at ADDR')
+
+    opts = parser.parse_args()
+
+    with open(opts.rom_path, 'rb') as rom_file:
+        rom_data = rom_file.read()
+
+    analyzer = TimingAnalyzer(rom_data)
+    bounds = dict(opts.bound)
+
+    if opts.path:
+        for start, end in opts.path:
+            timing = analyzer.analyze(start, end, opts.avoid, bounds)
+            print("0x%03X -> 0x%03X:" % (start, end))
+            if timing.best is None:
+                print("    no path found")
+                continue
+            print("    best: %s, worst: %s" % (format_cycles(timing.best),
+                                               format_cycles(timing.worst)))
+            for addr in sorted(timing.unbounded):
+                print("    unbounded loop at 0x%03X" % addr)
+            for msg in sorted(timing.warnings):
+                print("    warning: %s" % msg)
+    elif len(rom_data) == 2048:
+        violations = run_checks(analyzer, ADB_CHECKS_0731A,
+                                opts.avoid + [MAIN_LOOP_0731A,
+                                              ABORT_XMIT_0731A], bounds)
+        print("%d timing violation(s) found" % violations)
+        sys.exit(1 if violations else 0)
+    else:
+        print("No built-in checks for this ROM, use --path")